@@ -4,7 +4,9 @@ dicom2nifti
 
 @author: abrys
 """
+import concurrent.futures
 import copy
+import hashlib
 import logging
 import os
 import struct
@@ -12,8 +14,10 @@ import struct
 import numpy
 import pydicom
 from pydicom import dcmread
+from pydicom.dataelem import RawDataElement
+from pydicom.filereader import read_deferred_data_element
 from pydicom.tag import Tag
-from pydicom.pixels import apply_modality_lut
+from pydicom.pixels import apply_modality_lut, as_pixel_options, get_decoder
 
 import dicom2nifti.settings
 from dicom2nifti.exceptions import ConversionValidationError, ConversionError
@@ -33,20 +37,55 @@ def read_dicom_directory(dicom_directory, stop_before_pixels=False):
     :param dicom_directory: Directory with dicom data
     :return: List of dicom objects
     """
+    def _read_file(file_path):
+        dicom_headers = read_dicom_file(file_path, stop_before_pixels=stop_before_pixels)
+        if dicom_headers is not None and is_valid_imaging_dicom(dicom_headers):
+            return dicom_headers
+        return None
+
     dicom_input = []
-    for root, _, files in os.walk(dicom_directory):
-        for dicom_file in files:
-            file_path = os.path.join(root, dicom_file)
-            if is_dicom_file(file_path):
-                dicom_headers = dcmread(file_path,
-                                                  defer_size="1 KB",
-                                                  stop_before_pixels=stop_before_pixels,
-                                                  force=dicom2nifti.settings.pydicom_read_force)
-                if is_valid_imaging_dicom(dicom_headers):
-                    dicom_input.append(dicom_headers)
+    for dicom_headers in map_files(_read_file, get_file_paths(dicom_directory)):
+        if dicom_headers is not None:
+            dicom_input.append(dicom_headers)
     return dicom_input
 
 
+def get_file_paths(directory):
+    """
+    List all files in a directory and its subdirectories (in os.walk order)
+
+    :param directory: directory to search
+    :return: list of file paths
+    """
+    file_paths = []
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            file_paths.append(os.path.join(root, file_name))
+    return file_paths
+
+
+def map_files(function, file_paths):
+    """
+    Apply a function to a list of files using a bounded thread pool (see settings.scan_threads)
+    This overlaps the file system latency of the individual reads, the results are yielded in the order of the input
+
+    :param function: function taking a file path
+    :param file_paths: list of file paths
+    :return: generator with the results of the function in the order of file_paths
+    """
+    if dicom2nifti.settings.scan_threads <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
+            yield function(file_path)
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=dicom2nifti.settings.scan_threads)
+    try:
+        for result in executor.map(function, file_paths):
+            yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def is_hitachi(dicom_input):
     """
     Use this function to detect if a dicom series is a hitachi dataset
@@ -236,6 +275,183 @@ def _get_t_position_index(multiframe_dicom):
     return None
 
 
+class MultiframeIndex(object):
+    """
+    Per frame information of a multiframe dicom (PerFrameFunctionalGroupsSequence) as numpy arrays
+    Walking the nested sequences is slow for large datasets so this is done only once per dataset,
+    use get_multiframe_index to get the (cached) index of a dataset
+    Missing values are NaN (or -1 for the integer arrays) and are marked in the has_* arrays
+    """
+
+    def __init__(self, multiframe_dicom):
+        frame_info = multiframe_dicom.PerFrameFunctionalGroupsSequence
+        shared_info = multiframe_dicom.get("SharedFunctionalGroupsSequence")
+        number_of_frames = len(frame_info)
+        self.number_of_frames = number_of_frames
+        self.t_position_index = _get_t_position_index(multiframe_dicom)
+
+        self.positions = numpy.full((number_of_frames, 3), numpy.nan)
+        self.has_position = numpy.zeros(number_of_frames, dtype=bool)
+        self.orientations = numpy.full((number_of_frames, 6), numpy.nan)
+        self.has_orientation = numpy.zeros(number_of_frames, dtype=bool)
+        self.pixel_spacings = numpy.full((number_of_frames, 2), numpy.nan)
+        self.has_pixel_spacing = numpy.zeros(number_of_frames, dtype=bool)
+        self.has_frame_content = numpy.zeros(number_of_frames, dtype=bool)
+        self.in_stack_positions = numpy.full(number_of_frames, -1)
+        self.has_in_stack_position = numpy.zeros(number_of_frames, dtype=bool)
+        self.temporal_position_indices = numpy.full(number_of_frames, -1)
+        self.has_temporal_position_index = numpy.zeros(number_of_frames, dtype=bool)
+        self.is_scaled = numpy.zeros(number_of_frames, dtype=bool)
+        self.rescale_slopes = numpy.ones(number_of_frames)
+        self.rescale_intercepts = numpy.zeros(number_of_frames)
+        dimension_index_values = []
+
+        # the shared values are used when a frame does not contain its own
+        shared_orientation = None
+        shared_plane_orientation = None
+        shared_pixel_spacing = None
+        if shared_info is not None:
+            if "PlaneOrientationSequence" in shared_info[0]:
+                shared_plane_orientation = shared_info[0].PlaneOrientationSequence[0].ImageOrientationPatient
+            if "ImageOrientationPatient" in shared_info[0]:
+                shared_orientation = shared_info[0].ImageOrientationPatient
+            if "PixelMeasuresSequence" in shared_info[0]:
+                shared_pixel_spacing = shared_info[0].PixelMeasuresSequence[0].PixelSpacing
+        if shared_pixel_spacing is None and "PixelSpacing" in multiframe_dicom:
+            shared_pixel_spacing = multiframe_dicom.PixelSpacing
+
+        for frame_index, frame in enumerate(frame_info):
+            if "PlanePositionSequence" in frame:
+                self.positions[frame_index] = frame.PlanePositionSequence[0].ImagePositionPatient
+                self.has_position[frame_index] = True
+            elif "ImagePositionPatient" in frame:
+                self.positions[frame_index] = frame.ImagePositionPatient
+                self.has_position[frame_index] = True
+
+            orientation = None
+            if "PlaneOrientationSequence" in frame:
+                orientation = frame.PlaneOrientationSequence[0].ImageOrientationPatient
+            elif shared_plane_orientation is not None:
+                orientation = shared_plane_orientation
+            elif "ImageOrientationPatient" in frame:
+                orientation = frame.ImageOrientationPatient
+            elif shared_orientation is not None:
+                orientation = shared_orientation
+            if orientation is not None:
+                self.orientations[frame_index] = orientation[0:6]
+                self.has_orientation[frame_index] = True
+
+            pixel_spacing = shared_pixel_spacing
+            if "PixelMeasuresSequence" in frame:
+                pixel_spacing = frame.PixelMeasuresSequence[0].PixelSpacing
+            if pixel_spacing is not None:
+                self.pixel_spacings[frame_index] = pixel_spacing[0:2]
+                self.has_pixel_spacing[frame_index] = True
+
+            frame_dimension_index_values = []
+            if "FrameContentSequence" in frame:
+                self.has_frame_content[frame_index] = True
+                frame_content = frame.FrameContentSequence[0]
+                if "InStackPositionNumber" in frame_content:
+                    self.in_stack_positions[frame_index] = frame_content.InStackPositionNumber
+                    self.has_in_stack_position[frame_index] = True
+                if "TemporalPositionIndex" in frame_content:
+                    self.temporal_position_indices[frame_index] = frame_content.TemporalPositionIndex
+                    self.has_temporal_position_index[frame_index] = True
+                if "DimensionIndexValues" in frame_content:
+                    frame_dimension_index_values = frame_content.DimensionIndexValues
+                    if isinstance(frame_dimension_index_values, int):
+                        frame_dimension_index_values = [frame_dimension_index_values]
+            dimension_index_values.append(list(frame_dimension_index_values))
+
+            if "PixelValueTransformationSequence" in frame:
+                self.is_scaled[frame_index] = True
+                self.rescale_slopes[frame_index] = frame.PixelValueTransformationSequence[0].RescaleSlope
+                self.rescale_intercepts[frame_index] = frame.PixelValueTransformationSequence[0].RescaleIntercept
+
+        # dimension index values as a 2D array padded with -1
+        max_dimensions = max([len(values) for values in dimension_index_values] + [0])
+        self.dimension_index_values = numpy.full((number_of_frames, max_dimensions), -1)
+        for frame_index, values in enumerate(dimension_index_values):
+            self.dimension_index_values[frame_index, :len(values)] = values
+        self.dimension_index_count = numpy.array([len(values) for values in dimension_index_values], dtype=int)
+
+    def get_image_position(self, frame_number=0):
+        """
+        Get the ImagePositionPatient of a frame
+
+        :param frame_number: index of the frame (negative to count from the end)
+        """
+        if not self.has_position[frame_number]:
+            logger.warning('Unsupported or missing PlanePositionSequence/ImagePositionPatient')
+            raise ConversionError('Unsupported or missing PlanePositionSequence/ImagePositionPatient')
+        return self.positions[frame_number].copy()
+
+    def get_image_orientations(self, frame_number=0):
+        """
+        Get the row and column direction cosines of a frame
+
+        :param frame_number: index of the frame (negative to count from the end)
+        """
+        if not self.has_orientation[frame_number]:
+            logger.warning('Unsupported or missing PlaneOrientationSequence/ImageOrientationPatient')
+            raise ConversionError('Unsupported or missing PlaneOrientationSequence/ImageOrientationPatient')
+        return self.orientations[frame_number, 0:3].copy(), self.orientations[frame_number, 3:6].copy()
+
+    def get_t_locations(self, number_of_frames=None):
+        """
+        Get the (zero based) time point of each frame
+
+        :param number_of_frames: only get the time points of the first frames (all frames if None)
+        """
+        frames = slice(0, number_of_frames)
+        if self.t_position_index is not None:
+            if numpy.any(self.dimension_index_count[frames] <= self.t_position_index):
+                logger.warning('Unsupported or missing DimensionIndexValues')
+                raise ConversionError('Unsupported or missing DimensionIndexValues')
+            return self.dimension_index_values[frames, self.t_position_index] - 1
+        return numpy.where(self.has_temporal_position_index[frames], self.temporal_position_indices[frames] - 1, 0)
+
+    def get_z_locations(self, number_of_frames=None):
+        """
+        Get the (zero based) slice location of each frame within its stack
+        Frames without FrameContentSequence are located at their frame index
+
+        :param number_of_frames: only get the slice locations of the first frames (all frames if None)
+        """
+        frames = slice(0, number_of_frames)
+        if numpy.any(self.has_frame_content[frames] & ~self.has_in_stack_position[frames]):
+            logger.warning('Unsupported or missing InStackPositionNumber')
+            raise ConversionError('Unsupported or missing InStackPositionNumber')
+        return numpy.where(self.has_in_stack_position[frames],
+                           self.in_stack_positions[frames] - 1,
+                           numpy.arange(self.number_of_frames)[frames])
+
+
+def get_multiframe_index(multiframe_dicom):
+    """
+    Get the MultiframeIndex of a multiframe dicom, this is created once and cached on the dataset
+
+    :param multiframe_dicom: multiframe dicom dataset
+    :return: MultiframeIndex
+    """
+    multiframe_index = getattr(multiframe_dicom, '_multiframe_index', None)
+    if multiframe_index is None:
+        multiframe_index = MultiframeIndex(multiframe_dicom)
+        multiframe_dicom._multiframe_index = multiframe_index
+    return multiframe_index
+
+
+def _first_true(mask):
+    """
+    Index of the first True value in a boolean array or None
+    """
+    indices = numpy.flatnonzero(mask)
+    if len(indices) == 0:
+        return None
+    return int(indices[0])
+
+
 def multiframe_to_block(multiframe_dicom):
     """
     Generate a full datablock containing all stacks
@@ -248,91 +464,338 @@ def multiframe_to_block(multiframe_dicom):
     size_y = multiframe_dicom.pixel_array.shape[1]
     size_z = number_of_stack_slices
     size_t = number_of_stacks
+    number_of_frames = size_z * size_t
+    frames = multiframe_dicom.pixel_array[:number_of_frames]
     # get the format
     format_string = get_numpy_type(multiframe_dicom)
 
-    # get header info needed for ordering
-    frame_info = multiframe_dicom.PerFrameFunctionalGroupsSequence
-
-    data_4d = numpy.zeros((size_z, size_y, size_x, size_t), dtype=format_string)
-
-    # loop over each slice and insert in datablock
-    t_location_index = _get_t_position_index(multiframe_dicom)
-    for slice_index in range(0, size_t * size_z):
-
-        if "FrameContentSequence" in frame_info[slice_index]:
-            z_location = frame_info[slice_index].FrameContentSequence[0].InStackPositionNumber - 1
+    # get header info needed for ordering and scaling
+    multiframe_index = get_multiframe_index(multiframe_dicom)
+    z_locations = multiframe_index.get_z_locations(number_of_frames)
+    t_locations = multiframe_index.get_t_locations(number_of_frames)
+    is_scaled = multiframe_index.is_scaled[:number_of_frames]
+    rescale_slopes = multiframe_index.rescale_slopes[:number_of_frames]
+    rescale_intercepts = multiframe_index.rescale_intercepts[:number_of_frames]
+
+    # determine the dtype each frame gets from do_scaling and the dtype of the full block
+    frame_dtypes = numpy.full(number_of_frames, frames.dtype, dtype=object)
+    if numpy.any(is_scaled):
+        frame_minima = frames.min(axis=(1, 2))
+        frame_maxima = frames.max(axis=(1, 2))
+        for frame_index in numpy.nonzero(is_scaled)[0]:
+            frame_dtypes[frame_index] = numpy.dtype(_get_scaling_dtype(frames.dtype,
+                                                                       frame_minima[frame_index],
+                                                                       frame_maxima[frame_index],
+                                                                       rescale_slopes[frame_index],
+                                                                       rescale_intercepts[frame_index]))
+    block_dtype = numpy.dtype(format_string)
+    for frame_dtype in set(frame_dtypes):
+        block_dtype = numpy.promote_types(block_dtype, frame_dtype)
+
+    # if multiple frames have the same location the last one wins
+    linear_locations = t_locations * size_z + z_locations
+    _, last_reversed = numpy.unique(linear_locations[::-1], return_index=True)
+    is_used = numpy.zeros(number_of_frames, dtype=bool)
+    is_used[number_of_frames - 1 - last_reversed] = True
+
+    # scatter the (scaled) frames in the datablock
+    data_4d = numpy.zeros((size_t, size_z, size_y, size_x), dtype=block_dtype)
+    selection = is_used & ~is_scaled
+    if numpy.any(selection):
+        data_4d[t_locations[selection], z_locations[selection]] = frames[selection]
+    for frame_dtype in set(frame_dtypes[is_used & is_scaled]):
+        selection = is_used & is_scaled & (frame_dtypes == frame_dtype)
+        if frame_dtype.kind == 'f':
+            # scale in the same floating point precision as do_scaling
+            block_data = frames[selection].astype(frame_dtype)
+            block_data *= rescale_slopes[selection].astype(frame_dtype)[:, None, None]
+            block_data += rescale_intercepts[selection].astype(frame_dtype)[:, None, None]
         else:
-            z_location = slice_index
+            block_data = frames[selection].astype(numpy.int64)
+            block_data *= rescale_slopes[selection].astype(numpy.int64)[:, None, None]
+            block_data += rescale_intercepts[selection].astype(numpy.int64)[:, None, None]
+            block_data = block_data.astype(frame_dtype)
+        data_4d[t_locations[selection], z_locations[selection]] = block_data
+        del block_data
 
-        if t_location_index is not None:
-            t_location = frame_info[slice_index].FrameContentSequence[0].DimensionIndexValues[t_location_index] - 1
-        elif "FrameContentSequence" in frame_info[slice_index] and \
-                "TemporalPositionIndex" in frame_info[slice_index].FrameContentSequence[0]:
-            t_location = frame_info[slice_index].FrameContentSequence[0].TemporalPositionIndex - 1
-        else:
-            t_location = 0
-
-        block_data = multiframe_dicom.pixel_array[slice_index, :, :]
-        # apply scaling
-        if "PixelValueTransformationSequence" in frame_info[slice_index]:
-            rescale_intercept = frame_info[slice_index].PixelValueTransformationSequence[0].RescaleIntercept
-            rescale_slope = frame_info[slice_index].PixelValueTransformationSequence[0].RescaleSlope
-            block_data = do_scaling(block_data, rescale_slope, rescale_intercept)
-        # switch to float if needed
-        if block_data.dtype != data_4d.dtype:
-            new_dtype = numpy.promote_types(block_data.dtype, data_4d.dtype)
-            data_4d = data_4d.astype(new_dtype)
-            block_data = block_data.astype(new_dtype)
-        data_4d[z_location, :, :, t_location] = block_data
-
-    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=data_4d.dtype)
-
-    # loop over each stack and reorganize the data
-    for t_index in range(0, size_t):
-        # transpose the block so the directions are correct
-        data_3d = numpy.transpose(data_4d[:, :, :, t_index], (2, 1, 0))
-        # add the block the full data
-        full_block[:, :, :, t_index] = data_3d
+    # transpose the block so the directions are correct (x, y, z, t)
+    full_block = numpy.transpose(data_4d, (3, 2, 1, 0))
 
     return numpy.squeeze(full_block)
 
 
-def get_volume_pixeldata(sorted_slices):
+def get_volume_pixeldata(sorted_slices, out=None):
     """
     the slice and intercept calculation can cause the slices to have different dtypes
     we should get the correct dtype that can cover all of them
+    the dtype is determined up front from the headers so the volume is allocated only once (in x, y, z order)
+    and each slice is written directly into place
 
     :type sorted_slices: list of slices
     :param sorted_slices: sliced sored in the correct order to create volume
-    """
+    :param out: optional (x, y, z) array to write the volume to (for example a timepoint of a 4D block),
+                every slice must have the size of out and a dtype that can be safely cast to its dtype
+    """
+    if out is not None:
+        for i, slice_ in enumerate(sorted_slices):
+            slice_data = _get_slice_pixeldata(slice_)
+            if slice_data.shape[::-1] != out.shape[:2]:
+                logger.warning('Slice size mismatch (slice %s)' % i)
+                logger.warning('---------------------------------------------------------')
+                logger.warning(out.shape[:2])
+                logger.warning(slice_data.shape[::-1])
+                logger.warning('---------------------------------------------------------')
+                raise ConversionValidationError('IMAGE_SIZE_INCONSISTENT')
+            if not numpy.can_cast(slice_data.dtype, out.dtype):
+                logger.warning('Slice %s with dtype %s does not fit in %s' % (i, slice_data.dtype, out.dtype))
+                raise ConversionValidationError('IMAGE_DTYPE_INCONSISTENT')
+            out[:, :, i] = slice_data.T
+            del slice_data
+        return out
+
+    volume_dtype = _get_volume_dtype(sorted_slices)
     combined_dtype = None
     volume = None
+    is_rgb = False
     for i, slice_ in enumerate(sorted_slices):
-        # create copy so we don't load all pixel data on the original slice that is kept in memory
-        slice_copy = copy.deepcopy(slice_)
-        slice_data = _get_slice_pixeldata(slice_copy)
-        del slice_copy
+        slice_data = _get_slice_pixeldata(slice_)
         if combined_dtype is None:
             combined_dtype = slice_data.dtype
         else:
             combined_dtype = numpy.promote_types(combined_dtype, slice_data.dtype)
         if volume is None:
-            volume = numpy.zeros((len(sorted_slices), ) + slice_data.shape,
-                                 combined_dtype)
-        if volume.dtype != combined_dtype:
-            volume = volume.astype(combined_dtype)
-        volume[i] = slice_data
+            if volume_dtype != slice_data.dtype:
+                # the headers did not predict the dtype of the data, allocate in the dtype of the data instead
+                # so the volume only needs to be converted if a later slice does not fit
+                volume_dtype = slice_data.dtype
+            is_rgb = len(slice_data.shape) == 3 and slice_data.shape[2] == 3
+            if is_rgb:
+                volume = numpy.empty((len(sorted_slices),) + slice_data.shape, volume_dtype)
+            else:
+                volume = numpy.empty(slice_data.shape[::-1] + (len(sorted_slices),), volume_dtype, order='F')
+        if not numpy.can_cast(slice_data.dtype, volume.dtype):
+            # the headers did not predict the dtype of this slice
+            volume = volume.astype(numpy.promote_types(volume.dtype, slice_data.dtype), order='K')
+        if is_rgb:
+            volume[i] = slice_data
+        else:
+            volume[:, :, i] = slice_data.T
+        del slice_data
+
+    # make sure the dtype is the same as when promoting the dtypes of the individual slices
+    # (the volume normally already has this dtype as it is allocated in the dtype of the first slice)
+    if volume.dtype != combined_dtype:
+        volume = volume.astype(combined_dtype, order='K')
 
     # Done
     # if rgb data do separate transpose
-    if len(volume.shape) == 4 and volume.shape[3] == 3:
+    if is_rgb:
         volume = numpy.transpose(volume, (2, 1, 0, 3))
-    else:
-        volume = numpy.transpose(volume, (2, 1, 0))
     return volume
 
 
+def create_4d_block(timepoint_shape, number_of_timepoints, dtype):
+    """
+    Allocate the (x, y, z, t) block of a 4D series once
+    The block is fortran ordered so every timepoint block[..., t] is a contiguous slot that can be filled in place
+
+    :param timepoint_shape: (x, y, z) shape of one timepoint
+    :param number_of_timepoints: number of timepoints
+    :param dtype: dtype of the block
+    """
+    return numpy.empty(tuple(timepoint_shape) + (number_of_timepoints,), dtype=dtype, order='F')
+
+
+def get_4d_pixeldata(grouped_dicoms):
+    """
+    Create the (x, y, z, t) block of a 4D series of single frame slices
+    The dtype is determined up front from the headers of all slices so the block is allocated only once
+    and each timepoint is written directly into its slot
+
+    :param grouped_dicoms: list with the sorted slices of every timepoint
+    """
+    first_dicoms = grouped_dicoms[0]
+    all_dicoms = [dicom_ for timepoint_dicoms in grouped_dicoms for dicom_ in timepoint_dicoms]
+    volume_dtype = _get_volume_dtype(all_dicoms)
+    if volume_dtype is None or any(dicom_.get('SamplesPerPixel', 1) != 1 for dicom_ in all_dicoms):
+        # the dtype can not be predicted from the headers or the data is rgb
+        return _get_4d_pixeldata_per_timepoint(grouped_dicoms)
+    timepoint_shape = (first_dicoms[0].Columns, first_dicoms[0].Rows, len(first_dicoms))
+    full_block = create_4d_block(timepoint_shape, len(grouped_dicoms), volume_dtype)
+
+    for index, timepoint_dicoms in enumerate(grouped_dicoms):
+        logger.info('Creating block %s of %s' % (index + 1, len(grouped_dicoms)))
+        if len(timepoint_dicoms) != timepoint_shape[2]:
+            logger.warning('Missing slices (slice count mismatch between timepoint %s and %s)' % (index - 1, index))
+            logger.warning('---------------------------------------------------------')
+            logger.warning(timepoint_shape)
+            logger.warning((timepoint_shape[0], timepoint_shape[1], len(timepoint_dicoms)))
+            logger.warning('---------------------------------------------------------')
+            raise ConversionError("MISSING_DICOM_FILES")
+        get_volume_pixeldata(timepoint_dicoms, out=full_block[..., index])
+    return full_block
+
+
+def _get_4d_pixeldata_per_timepoint(grouped_dicoms):
+    """
+    Create the 4D block from the separately created volumes of the timepoints (see get_4d_pixeldata)
+    The dtype of the block covers the dtypes of all timepoints, rgb volumes result in an (x, y, z, t, 3) block
+
+    :param grouped_dicoms: list with the sorted slices of every timepoint
+    """
+    data_blocks = []
+    block_dtype = None
+    for index, timepoint_dicoms in enumerate(grouped_dicoms):
+        logger.info('Creating block %s of %s' % (index + 1, len(grouped_dicoms)))
+        data_block = get_volume_pixeldata(timepoint_dicoms)
+        if data_blocks and data_block.shape != data_blocks[0].shape:
+            logger.warning('Missing slices (slice count mismatch between timepoint %s and %s)' % (index - 1, index))
+            logger.warning('---------------------------------------------------------')
+            logger.warning(data_blocks[0].shape)
+            logger.warning(data_block.shape)
+            logger.warning('---------------------------------------------------------')
+            raise ConversionError("MISSING_DICOM_FILES")
+        block_dtype = data_block.dtype if block_dtype is None else numpy.promote_types(block_dtype, data_block.dtype)
+        data_blocks.append(data_block)
+
+    block_shape = data_blocks[0].shape
+    full_block = numpy.empty(block_shape[:3] + (len(data_blocks),) + block_shape[3:], dtype=block_dtype, order='F')
+    for index in range(len(data_blocks)):
+        full_block[:, :, :, index] = data_blocks[index]
+        data_blocks[index] = None
+    return full_block
+
+
+def _get_volume_dtype(sorted_slices):
+    """
+    Determine the dtype of the volume based on the headers (BitsAllocated, PixelRepresentation and rescale)
+    this results in the same dtype as promoting the dtypes of all the rescaled slices
+
+    :param sorted_slices: list of dicom slices
+    :return: numpy dtype or None if it can not be determined from the headers
+    """
+    volume_dtype = None
+    for dicom_slice in sorted_slices:
+        if 'ModalityLUTSequence' in dicom_slice:
+            return None
+        if 'RescaleSlope' in dicom_slice and 'RescaleIntercept' in dicom_slice:
+            slice_dtype = numpy.dtype(numpy.float64)
+        else:
+            try:
+                slice_dtype = numpy.dtype(get_numpy_type(dicom_slice))
+            except (TypeError, AttributeError):
+                return None
+        if volume_dtype is None:
+            volume_dtype = slice_dtype
+        else:
+            volume_dtype = numpy.promote_types(volume_dtype, slice_dtype)
+    return volume_dtype
+
+
+def get_pixel_array(dicom_slice):
+    """
+    Decode the pixel data of a slice without keeping the (decoded) pixel data on the slice
+    the slices are kept in memory during the conversion so we don't want to load all pixel data on them
+
+    :param dicom_slice: slice to get the pixel array for (dicom object or SliceReference)
+    """
+    if isinstance(dicom_slice, SliceReference):
+        return dicom_slice.get_pixel_array()
+    pixel_data = dicom_slice.get_item(Tag(0x7fe0, 0x0010), keep_deferred=True)
+    if pixel_data is None or pixel_data.value is not None:
+        # pixel data is already in memory, decode it without caching the array on the slice
+        return pydicom.pixels.pixel_array(dicom_slice)
+    slice_reference = get_slice_reference(dicom_slice)
+    if slice_reference is not None:
+        # deferred pixel data, decode it directly from its position in the file
+        return slice_reference.get_pixel_array()
+    # create copy so we don't load all pixel data on the original slice that is kept in memory
+    return copy.deepcopy(dicom_slice).pixel_array
+
+
+class SliceReference(object):
+    """
+    Lightweight reference to the pixel data of a single slice in a dicom file
+    Only the file path, the offset of the pixel data, the decoding options and the geometry are kept,
+    the pixel data is read and decoded from the file when needed and nothing is kept afterwards
+    """
+
+    def __init__(self, filename, offset, pixel_options, image_position=None, image_orientation=None):
+        """
+        :param filename: path of the dicom file
+        :param offset: position of the pixel data value in the file
+        :param pixel_options: pydicom decoding options (including the transfer syntax)
+        :param image_position: ImagePositionPatient of the slice
+        :param image_orientation: ImageOrientationPatient of the slice
+        """
+        self.filename = filename
+        self.offset = offset
+        self.pixel_options = pixel_options
+        self.transfer_syntax = pixel_options['transfer_syntax_uid']
+        self.image_position = image_position
+        self.image_orientation = image_orientation
+
+    def get_pixel_array(self):
+        """
+        Read and decode the pixel data (the same array as pydicom's pixel_array)
+        """
+        decoder = get_decoder(self.transfer_syntax)
+        with open(self.filename, 'rb') as file_stream:
+            file_stream.seek(self.offset)
+            return decoder.as_array(file_stream, validate=True, **self.pixel_options)[0]
+
+
+def get_slice_reference(dicom_slice):
+    """
+    Create a SliceReference for a slice of which the pixel data was not read (deferred)
+    This is the adapter from the dicom objects used by the converters to the slice references
+
+    :param dicom_slice: dicom object read with deferred pixel data
+    :return: SliceReference or None if the pixel data can not be referenced in a file
+    """
+    pixel_data = dicom_slice.get_item(Tag(0x7fe0, 0x0010), keep_deferred=True)
+    if not isinstance(pixel_data, RawDataElement) or pixel_data.value is not None or pixel_data.value_tell is None:
+        return None
+    if not isinstance(dicom_slice.filename, str) or not os.path.isfile(dicom_slice.filename):
+        return None
+    transfer_syntax = getattr(getattr(dicom_slice, 'file_meta', None), 'TransferSyntaxUID', None)
+    if transfer_syntax is None:
+        return None
+    pixel_options = as_pixel_options(dicom_slice)
+    pixel_options['transfer_syntax_uid'] = transfer_syntax
+    pixel_options['pixel_keyword'] = 'PixelData'
+    if not pixel_data.is_implicit_VR and pixel_data.VR is not None:
+        pixel_options['pixel_vr'] = pixel_data.VR
+    return SliceReference(dicom_slice.filename,
+                          pixel_data.value_tell,
+                          pixel_options,
+                          dicom_slice.get('ImagePositionPatient'),
+                          dicom_slice.get('ImageOrientationPatient'))
+
+
+def get_pixel_data_digest(dicom_slice):
+    """
+    Calculate a digest of the raw (still encoded) pixel data of a slice without decoding it
+    Deferred pixel data is read from the file without keeping it on the slice
+
+    :param dicom_slice: slice to get the digest for
+    :return: digest bytes or None if there is no pixel data
+    """
+    pixel_data = dicom_slice.get_item(Tag(0x7fe0, 0x0010), keep_deferred=True)
+    if pixel_data is None:
+        return None
+    value = pixel_data.value
+    if value is None and isinstance(pixel_data, RawDataElement) and \
+            isinstance(dicom_slice.filename, str) and os.path.isfile(dicom_slice.filename):
+        value = read_deferred_data_element(dicom_slice.fileobj_type,
+                                           dicom_slice.filename,
+                                           getattr(dicom_slice, 'timestamp', None),
+                                           pixel_data).value
+    if value is None:
+        return None
+    return hashlib.blake2b(value, digest_size=16).digest()
+
+
 def _get_slice_pixeldata(dicom_slice):
     """
     the slice and intercept calculation can cause the slices to have different dtypes
@@ -341,7 +804,7 @@ def _get_slice_pixeldata(dicom_slice):
     :type dicom_slice: pydicom object
     :param dicom_slice: slice to get the pixeldata for
     """
-    data = dicom_slice.pixel_array
+    data = get_pixel_array(dicom_slice)
     # fix overflow issues for signed data where BitsStored is lower than BitsAllocated and PixelReprentation = 1 (signed)
     # for example a hitachi mri scan can have BitsAllocated 16 but BitsStored is 12 and HighBit 11
     if dicom_slice.BitsAllocated != dicom_slice.BitsStored and \
@@ -514,36 +977,7 @@ def do_scaling(data, rescale_slope, rescale_intercept, private_scale_slope=1.0,
     elif need_floats:
         data = data.astype(numpy.float32)
     else:
-        # Determine required range
-        minimum_required, maximum_required = data.min(), data.max()
-        minimum_required = min([minimum_required, minimum_required * rescale_slope + rescale_intercept,
-                                maximum_required * rescale_slope + rescale_intercept])
-        maximum_required = max([maximum_required, minimum_required * rescale_slope + rescale_intercept,
-                                maximum_required * rescale_slope + rescale_intercept])
-
-        # Determine required datatype from that
-        if minimum_required < 0:
-            # Signed integer type
-            maximum_required = max([-(minimum_required + 1), maximum_required])
-            if maximum_required < 2 ** 7:
-                dtype = numpy.int8
-            elif maximum_required < 2 ** 15:
-                dtype = numpy.int16
-            elif maximum_required < 2 ** 31:
-                dtype = numpy.int32
-            else:
-                dtype = numpy.float32
-        else:
-            # Unsigned integer type
-            if maximum_required < 2 ** 8:
-                dtype = numpy.uint8
-            elif maximum_required < 2 ** 16:
-                dtype = numpy.uint16
-            elif maximum_required < 2 ** 32:
-                dtype = numpy.uint32
-            else:
-                dtype = numpy.float32
-
+        dtype = _get_scaling_dtype(data.dtype, data.min(), data.max(), rescale_slope, rescale_intercept)
         # Change datatype
         if dtype != data.dtype:
             data = data.astype(dtype)
@@ -564,6 +998,95 @@ def do_scaling(data, rescale_slope, rescale_intercept, private_scale_slope=1.0,
     return data
 
 
+def _get_scaling_dtype(data_dtype, data_minimum, data_maximum, rescale_slope, rescale_intercept):
+    """
+    Determine the datatype do_scaling uses for data with the given range and scaling
+
+    :param data_dtype: dtype of the unscaled data
+    :param data_minimum: minimum of the unscaled data
+    :param data_maximum: maximum of the unscaled data
+    :param rescale_slope: rescale slope
+    :param rescale_intercept: rescale intercept
+    :return: numpy dtype
+    """
+    if data_dtype in [numpy.float32, numpy.float64]:
+        return data_dtype
+    if int(rescale_slope) != rescale_slope or int(rescale_intercept) != rescale_intercept:
+        return numpy.float32
+    rescale_slope = int(rescale_slope)
+    rescale_intercept = int(rescale_intercept)
+
+    # Determine required range
+    minimum_required, maximum_required = data_minimum, data_maximum
+    minimum_required = min([minimum_required, minimum_required * rescale_slope + rescale_intercept,
+                            maximum_required * rescale_slope + rescale_intercept])
+    maximum_required = max([maximum_required, minimum_required * rescale_slope + rescale_intercept,
+                            maximum_required * rescale_slope + rescale_intercept])
+
+    # Determine required datatype from that
+    if minimum_required < 0:
+        # Signed integer type
+        maximum_required = max([-(minimum_required + 1), maximum_required])
+        if maximum_required < 2 ** 7:
+            return numpy.int8
+        elif maximum_required < 2 ** 15:
+            return numpy.int16
+        elif maximum_required < 2 ** 31:
+            return numpy.int32
+        return numpy.float32
+    # Unsigned integer type
+    if maximum_required < 2 ** 8:
+        return numpy.uint8
+    elif maximum_required < 2 ** 16:
+        return numpy.uint16
+    elif maximum_required < 2 ** 32:
+        return numpy.uint32
+    return numpy.float32
+
+
+def get_gradient_table(headers, get_bval, get_bvec):
+    """
+    Gather the raw diffusion values of all volumes in arrays in one pass over the headers
+    so the projections and corrections can be done as array operations afterwards
+
+    :param headers: list with one header (dicom or sequence item) per volume
+    :param get_bval: function that reads the bval from a header
+    :param get_bvec: function that reads the bvec (3 values) from a header
+    :return: array with the bvals and N x 3 array with the bvecs (float64)
+    """
+    bvals = numpy.zeros(len(headers))
+    bvecs = numpy.zeros((len(headers), 3))
+    for index, header in enumerate(headers):
+        bvals[index] = get_bval(header)
+        bvecs[index] = get_bvec(header)
+    return bvals, bvecs
+
+
+def project_bvecs(bvals, bvecs, image_orientation):
+    """
+    Project the bvecs from patient space on the read, phase (inverted) and slice direction of the image
+    and normalize them, bvecs of volumes without diffusion weighting or direction are 0
+
+    :param bvals: array with the bvals
+    :param bvecs: N x 3 array with the bvecs in patient space
+    :param image_orientation: ImageOrientationPatient of the image
+    :return: N x 3 array with the projected bvecs
+    """
+    read_vector = numpy.array(image_orientation[0:3], dtype=float)
+    phase_vector = numpy.array(image_orientation[3:6], dtype=float)
+    slice_vector = numpy.cross(read_vector, phase_vector)
+    projection = numpy.array([read_vector / numpy.linalg.norm(read_vector),
+                              -phase_vector / numpy.linalg.norm(phase_vector),
+                              slice_vector / numpy.linalg.norm(slice_vector)])
+
+    bvecs = numpy.asarray(bvecs, dtype=float)
+    is_weighted = (numpy.asarray(bvals) > 0) & numpy.any(bvecs != 0, axis=1)
+    projected_bvecs = numpy.zeros(bvecs.shape)
+    projected_bvecs[is_weighted] = bvecs[is_weighted].dot(projection.T)
+    projected_bvecs[is_weighted] /= numpy.linalg.norm(projected_bvecs[is_weighted], axis=1)[:, numpy.newaxis]
+    return projected_bvecs
+
+
 def write_bvec_file(bvecs, bvec_file):
     """
     Write an array of bvecs to a bvec file
@@ -603,31 +1126,22 @@ def multiframe_create_affine(dicoms, data_block):
 
     :param sorted_dicoms: list with sorted dicom files
     """
+    multiframe_index = get_multiframe_index(dicoms[0])
 
     # Create affine matrix (http://nipy.sourceforge.net/nibabel/dicom/dicom_orientation.html#dicom-slice-affine)
-    frame_info = dicoms[0].PerFrameFunctionalGroupsSequence
-    image_orient1, image_orient2 = _multiframe_get_image_orientations(dicoms[0], 0)
-
-    if 'PixelMeasuresSequence' in frame_info[0]:
-        delta_r = float(frame_info[0].PixelMeasuresSequence[0].PixelSpacing[0])
-        delta_c = float(frame_info[0].PixelMeasuresSequence[0].PixelSpacing[1])
-    elif "SharedFunctionalGroupsSequence" in dicoms[0] and \
-            "PixelMeasuresSequence" in dicoms[0].SharedFunctionalGroupsSequence[0]:
-        shared_frame_info = dicoms[0].SharedFunctionalGroupsSequence
-        delta_r = numpy.array(shared_frame_info[0].PixelMeasuresSequence[0].PixelSpacing[0])
-        delta_c = numpy.array(shared_frame_info[0].PixelMeasuresSequence[0].PixelSpacing[1])
-    elif "PixelSpacing" in dicoms[0]:
-        delta_r = numpy.array(dicoms[0].PixelSpacing[0])
-        delta_c = numpy.array(dicoms[0].PixelSpacing[1])
-    else:
+    image_orient1, image_orient2 = multiframe_index.get_image_orientations(0)
+
+    if not multiframe_index.has_pixel_spacing[0]:
         logger.warning('Unsupported or missing PixelMeasuresSequence')
         raise ConversionError('Unsupported or missing PixelMeasuresSequence')
+    delta_r, delta_c = multiframe_index.pixel_spacings[0]
 
-    image_pos = _multiframe_get_image_position(dicoms[0], 0)
-    last_image_pos = _multiframe_get_image_position(dicoms[0], -1)
+    image_pos = multiframe_index.get_image_position(0)
+    last_image_pos = multiframe_index.get_image_position(-1)
 
-    if len(frame_info) == 1:
+    if multiframe_index.number_of_frames == 1:
         # Single slice
+        frame_info = dicoms[0].PerFrameFunctionalGroupsSequence
         slice_thickness = 1
         if "SliceThickness" in frame_info[0].PixelMeasuresSequence[0]:
             slice_thickness = frame_info[0].PixelMeasuresSequence[0].SliceThickness
@@ -720,9 +1234,10 @@ def multiframe_is_orthogonal(dicoms, log_details=False):
 
     :param dicoms: check that we have a volume without skewing
     """
-    first_image_orient1, first_image_orient2 = _multiframe_get_image_orientations(dicoms[0], 0)
-    first_image_pos = _multiframe_get_image_position(dicoms[0], 0)
-    last_image_pos = _multiframe_get_image_position(dicoms[0], -1)
+    multiframe_index = get_multiframe_index(dicoms[0])
+    first_image_orient1, first_image_orient2 = multiframe_index.get_image_orientations(0)
+    first_image_pos = multiframe_index.get_image_position(0)
+    last_image_pos = multiframe_index.get_image_position(-1)
 
     first_image_dir = numpy.cross(first_image_orient1, first_image_orient2)
     first_image_dir /= numpy.linalg.norm(first_image_dir)
@@ -797,28 +1312,222 @@ def is_orthogonal_nifti(nifti_image):
     return True
 
 
+class SliceGeometry(object):
+    """
+    Geometry of a list of single frame dicoms as numpy arrays (one row per slice)
+    The headers are read once so the validations can be done as vectorised array operations
+    Missing values are NaN (or 0 for the instance numbers and marked in has_instance_number),
+    use get_positions and get_orientations to get the values of slices that must have them
+    """
+
+    def __init__(self, dicoms, positions=None, orientations=None, instance_numbers=None, has_instance_number=None):
+        self.dicoms = list(dicoms)
+        if positions is None:
+            number_of_slices = len(self.dicoms)
+            positions = numpy.full((number_of_slices, 3), numpy.nan)
+            orientations = numpy.full((number_of_slices, 6), numpy.nan)
+            instance_numbers = numpy.zeros(number_of_slices, dtype=numpy.int64)
+            has_instance_number = numpy.zeros(number_of_slices, dtype=bool)
+            for slice_index, dicom_ in enumerate(self.dicoms):
+                if 'ImagePositionPatient' in dicom_:
+                    positions[slice_index] = dicom_.ImagePositionPatient[0:3]
+                if 'ImageOrientationPatient' in dicom_:
+                    orientations[slice_index] = dicom_.ImageOrientationPatient[0:6]
+                if 'InstanceNumber' in dicom_ and dicom_.InstanceNumber is not None:
+                    instance_numbers[slice_index] = dicom_.InstanceNumber
+                    has_instance_number[slice_index] = True
+        self.positions = positions
+        self.orientations = orientations
+        self.instance_numbers = instance_numbers
+        self.has_instance_number = has_instance_number
+
+    def __len__(self):
+        return len(self.dicoms)
+
+    def get_positions(self):
+        """
+        Get the ImagePositionPatient of all slices, raises a ConversionValidationError if a slice has none
+        """
+        _check_missing(self.positions, 'ImagePositionPatient', 'IMAGE_POSITION_MISSING')
+        return self.positions
+
+    def get_orientations(self):
+        """
+        Get the ImageOrientationPatient of all slices, raises a ConversionValidationError if a slice has none
+        """
+        _check_missing(self.orientations, 'ImageOrientationPatient', 'IMAGE_ORIENTATION_MISSING')
+        return self.orientations
+
+    def subset(self, indices):
+        """
+        Get the geometry of a subset of the slices (in the order of the indices)
+
+        :param indices: list or array with the indices of the slices
+        """
+        indices = numpy.asarray(indices, dtype=int)
+        return SliceGeometry([self.dicoms[index] for index in indices],
+                             self.positions[indices],
+                             self.orientations[indices],
+                             self.instance_numbers[indices],
+                             self.has_instance_number[indices])
+
+    def reorder(self, dicoms):
+        """
+        Get the geometry for the same slices in a different order (for example after sorting)
+
+        :param dicoms: list with (a subset of) the dicoms of this geometry
+        """
+        slice_indices = {id(dicom_): slice_index for slice_index, dicom_ in enumerate(self.dicoms)}
+        return self.subset([slice_indices[id(dicom_)] for dicom_ in dicoms])
+
+
+def _check_missing(values, tag_name, error):
+    """
+    Raise a ConversionValidationError for the first slice with missing (NaN) values
+    """
+    slice_index = _first_true(numpy.any(numpy.isnan(values), axis=1))
+    if slice_index is not None:
+        logger.warning('Missing %s (slice %s)' % (tag_name, slice_index))
+        raise ConversionValidationError(error)
+
+
+def get_slice_geometry(dicoms):
+    """
+    Get the SliceGeometry of a list of dicoms, if a SliceGeometry is passed it is returned as is
+
+    :param dicoms: list of dicoms or SliceGeometry
+    """
+    if isinstance(dicoms, SliceGeometry):
+        return dicoms
+    return SliceGeometry(dicoms)
+
+
+def get_stack_groups(positions, stack_positions=None):
+    """
+    Split the sorted slices of a 4D series in stacks (timepoints) with vectorised operations
+
+    Without stack positions a new stack starts where the direction between consecutive slice positions changes
+    (the direction of the first slice of a stack is not compared with the previous stack)
+    With stack positions (philips) every slice with the same stack position as the previous slice goes to the next
+    stack and every slice with a different stack position goes back to the first stack
+
+    :param positions: N x 3 array with the image positions of the sorted slices (can be None with stack positions)
+    :param stack_positions: optional array with the stack position of each sorted slice
+    :return: list with an array of slice indices per stack
+    """
+    if stack_positions is not None:
+        stack_positions = numpy.asarray(stack_positions)
+        slice_indices = numpy.arange(len(stack_positions))
+        previous_stack_positions = numpy.concatenate(([-1], stack_positions[:-1]))
+        # count the slices since the last change of stack position
+        change_indices = numpy.where(stack_positions != previous_stack_positions, slice_indices, -1)
+        group_indices = slice_indices - numpy.maximum.accumulate(change_indices)
+    else:
+        group_indices = numpy.cumsum(_get_stack_boundaries(numpy.asarray(positions, dtype=float)))
+
+    if len(group_indices) == 0:
+        return [group_indices]
+    number_of_groups = int(group_indices.max()) + 1
+    sorted_indices = numpy.argsort(group_indices, kind='stable')
+    group_sizes = numpy.bincount(group_indices, minlength=number_of_groups)
+    return numpy.split(sorted_indices, numpy.cumsum(group_sizes)[:-1])
+
+
+def _get_stack_boundaries(positions):
+    """
+    Find the slices that start a new stack based on the direction between consecutive slice positions
+
+    :param positions: N x 3 array with the image positions of the sorted slices
+    :return: boolean array that is True for the first slice of every stack (except the first one)
+    """
+    number_of_slices = len(positions)
+    boundaries = numpy.zeros(number_of_slices, dtype=bool)
+    if number_of_slices < 3:
+        return boundaries
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        directions = numpy.diff(positions, axis=0)
+        directions /= numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+    # slice i is a candidate when the direction from i-1 to i differs from the direction from i-2 to i-1
+    candidates = numpy.zeros(number_of_slices, dtype=bool)
+    candidates[2:] = ~numpy.all(numpy.isclose(directions[1:], directions[:-1], rtol=0.05, atol=0.05), axis=1)
+    # the direction is not compared for the slice after a new stack so in a run of candidates
+    # only every other slice starts a new stack
+    slice_indices = numpy.arange(number_of_slices)
+    run_starts = candidates & ~numpy.concatenate(([False], candidates[:-1]))
+    run_start_indices = numpy.maximum.accumulate(numpy.where(run_starts, slice_indices, 0))
+    boundaries[:] = candidates & ((slice_indices - run_start_indices) % 2 == 0)
+    return boundaries
+
+
+def _get_inconsistent_increment(positions):
+    """
+    Find the first slice where the increment with the previous slice differs from the increment of the first slices
+
+    :param positions: N x 3 array with the image positions
+    :return: index of the first inconsistent slice or None if the increment is consistent
+    """
+    increment = positions[0] - positions[1]
+    increments = positions[1:-1] - positions[2:]
+    is_inconsistent = ~numpy.all(numpy.isclose(increment, increments, rtol=0.05, atol=0.1), axis=1)
+    first_inconsistent = _first_true(is_inconsistent)
+    if first_inconsistent is None:
+        return None
+    return first_inconsistent + 2
+
+
+def is_same_orientation(orientations, reference_orientation):
+    """
+    Check which orientations are the same as the reference orientation (both direction cosines within tolerance)
+
+    :param orientations: N x 6 array with the image orientations
+    :param reference_orientation: array with the 6 values of the reference orientation
+    :return: boolean array
+    """
+    return numpy.all(numpy.isclose(orientations[:, 0:3], reference_orientation[0:3], rtol=0.001, atol=0.001),
+                     axis=1) & \
+        numpy.all(numpy.isclose(orientations[:, 3:6], reference_orientation[3:6], rtol=0.001, atol=0.001), axis=1)
+
+
 def sort_dicoms(dicoms):
     """
     Sort the dicoms based om the image possition patient
 
-    :param dicoms: list of dicoms
+    :param dicoms: list of dicoms or SliceGeometry (the same type is returned)
     """
+    geometry = get_slice_geometry(dicoms)
     # find most significant axis to use during sorting
     # the original way of sorting (first x than y than z) does not work in certain border situations
     # where for exampe the X will only slightly change causing the values to remain equal on multiple slices
     # messing up the sorting completely)
-    dicom_input_sorted_x = sorted(dicoms, key=lambda x: (x.ImagePositionPatient[0]))
-    dicom_input_sorted_y = sorted(dicoms, key=lambda x: (x.ImagePositionPatient[1]))
-    dicom_input_sorted_z = sorted(dicoms, key=lambda x: (x.ImagePositionPatient[2]))
-    diff_x = abs(dicom_input_sorted_x[-1].ImagePositionPatient[0] - dicom_input_sorted_x[0].ImagePositionPatient[0])
-    diff_y = abs(dicom_input_sorted_y[-1].ImagePositionPatient[1] - dicom_input_sorted_y[0].ImagePositionPatient[1])
-    diff_z = abs(dicom_input_sorted_z[-1].ImagePositionPatient[2] - dicom_input_sorted_z[0].ImagePositionPatient[2])
-    if diff_x >= diff_y and diff_x >= diff_z:
-        return dicom_input_sorted_x
-    if diff_y >= diff_x and diff_y >= diff_z:
-        return dicom_input_sorted_y
-    if diff_z >= diff_x and diff_z >= diff_y:
-        return dicom_input_sorted_z
+    # on ties x is preferred over y and y over z
+    positions = geometry.get_positions()
+    extents = numpy.ptp(positions, axis=0)
+    axis = int(numpy.argmax(extents))
+    order = numpy.argsort(positions[:, axis], kind='stable')
+    return _sorted_like(dicoms, geometry, order)
+
+
+def sort_dicoms_by_normal(dicoms):
+    """
+    Sort the dicoms based on the projection of the image position patient on the slice normal (of the first slice)
+    This is robust for oblique stacks where no axis is clearly dominant, the slices are sorted along the normal
+
+    :param dicoms: list of dicoms or SliceGeometry (the same type is returned)
+    """
+    geometry = get_slice_geometry(dicoms)
+    orientations = geometry.get_orientations()
+    normal = numpy.cross(orientations[0, 0:3], orientations[0, 3:6])
+    order = numpy.argsort(geometry.get_positions().dot(normal), kind='stable')
+    return _sorted_like(dicoms, geometry, order)
+
+
+def _sorted_like(dicoms, geometry, order):
+    """
+    Return the sorted slices as the same type as the input (list of dicoms or SliceGeometry)
+    """
+    if isinstance(dicoms, SliceGeometry):
+        return geometry.subset(order)
+    return [geometry.dicoms[index] for index in order]
 
 
 def multiframe_validate_slice_increment(dicoms):
@@ -827,77 +1536,87 @@ def multiframe_validate_slice_increment(dicoms):
 
     :param dicoms: list of dicoms
     """
+    multiframe_index = get_multiframe_index(dicoms[0])
+    frame_number = _multiframe_get_inconsistent_increment(multiframe_index)
+    if frame_number is not None:
+        previous_image_position = multiframe_index.positions[frame_number - 1]
+        current_image_position = multiframe_index.positions[frame_number]
+        increment = multiframe_index.positions[0] - multiframe_index.positions[1]
+        logger.warning('Slice increment not consistent through all slices')
+        logger.warning('---------------------------------------------------------')
+        logger.warning('%s %s' % (previous_image_position, increment))
+        logger.warning('%s %s' % (current_image_position, previous_image_position - current_image_position))
+        logger.warning('---------------------------------------------------------')
+        raise ConversionValidationError('SLICE_INCREMENT_INCONSISTENT')
 
-    frame_info = dicoms[0].PerFrameFunctionalGroupsSequence
-    first_image_position = _multiframe_get_image_position(dicoms[0], 0)
-    previous_image_position = _multiframe_get_image_position(dicoms[0], 1)
 
-    increment = first_image_position - previous_image_position
-    for frame_number in range(2, len(frame_info)):
-        current_image_position = _multiframe_get_image_position(dicoms[0], frame_number)
-        current_increment = previous_image_position - current_image_position
-        if not numpy.allclose(increment, current_increment, rtol=0.05, atol=0.1):
-            logger.warning('Slice increment not consistent through all slices')
-            logger.warning('---------------------------------------------------------')
-            logger.warning('%s %s' % (previous_image_position, increment))
-            logger.warning('%s %s' % (current_image_position, current_increment))
-            logger.warning('---------------------------------------------------------')
-            raise ConversionValidationError('SLICE_INCREMENT_INCONSISTENT')
-        previous_image_position = current_image_position
+def _multiframe_get_inconsistent_increment(multiframe_index):
+    """
+    Find the first frame where the increment with the previous frame differs from the increment of the first frames
+
+    :param multiframe_index: MultiframeIndex of the dicom
+    :return: index of the first inconsistent frame or None if the increment is consistent
+    """
+    multiframe_index.get_image_position(0)
+    multiframe_index.get_image_position(1)
+    first_inconsistent = _get_inconsistent_increment(multiframe_index.positions)
+    first_missing = _first_true(~multiframe_index.has_position)
+    # frames are checked in order so a missing position before the first inconsistency is an error
+    if first_missing is not None and (first_inconsistent is None or first_missing <= first_inconsistent):
+        multiframe_index.get_image_position(first_missing)
+    return first_inconsistent
 
 
 def validate_slice_increment(dicoms):
     """
     Validate that the distance between all slices is equal (or very close to)
 
-    :param dicoms: list of dicoms
+    :param dicoms: list of dicoms or SliceGeometry
     """
+    geometry = get_slice_geometry(dicoms)
 
     # if only one slice we do not need to run the checks
-    if len(dicoms) == 1:
+    if len(geometry) == 1:
         return
 
-    first_image_position = numpy.array(dicoms[0].ImagePositionPatient)
-    previous_image_position = numpy.array(dicoms[1].ImagePositionPatient)
-
-    increment = first_image_position - previous_image_position
-    for dicom_ in dicoms[2:]:
-        current_image_position = numpy.array(dicom_.ImagePositionPatient)
-        current_increment = previous_image_position - current_image_position
-        if not numpy.allclose(increment, current_increment, rtol=0.05, atol=0.1):
-            logger.warning('Slice increment not consistent through all slices')
-            logger.warning('---------------------------------------------------------')
-            logger.warning('%s %s' % (previous_image_position, increment))
-            logger.warning('%s %s' % (current_image_position, current_increment))
-            if 'InstanceNumber' in dicom_:
-                logger.warning('Instance Number: %s' % dicom_.InstanceNumber)
-            logger.warning('---------------------------------------------------------')
-            raise ConversionValidationError('SLICE_INCREMENT_INCONSISTENT')
-        previous_image_position = current_image_position
+    positions = geometry.get_positions()
+    slice_index = _get_inconsistent_increment(positions)
+    if slice_index is not None:
+        increment = positions[0] - positions[1]
+        previous_image_position = positions[slice_index - 1]
+        current_image_position = positions[slice_index]
+        logger.warning('Slice increment not consistent through all slices')
+        logger.warning('---------------------------------------------------------')
+        logger.warning('%s %s' % (previous_image_position, increment))
+        logger.warning('%s %s' % (current_image_position, previous_image_position - current_image_position))
+        if geometry.has_instance_number[slice_index]:
+            logger.warning('Instance Number: %s' % geometry.instance_numbers[slice_index])
+        logger.warning('---------------------------------------------------------')
+        raise ConversionValidationError('SLICE_INCREMENT_INCONSISTENT')
 
 
 def validate_instance_number(dicoms):
     """
     Validate that the instance number is consistent through all slices
 
-    :param dicoms: list of dicoms
+    :param dicoms: list of dicoms or SliceGeometry
     """
-    if "InstanceNumber" not in dicoms[0]:
+    geometry = get_slice_geometry(dicoms)
+    if len(geometry) < 2 or not geometry.has_instance_number[0]:
         return
-    first_instance_number = numpy.array(dicoms[0].InstanceNumber)
-    previous_instance_number = numpy.array(dicoms[1].InstanceNumber)
-
-    instance_number_increment = first_instance_number - previous_instance_number
-    for dicom_ in dicoms[2:]:
-        current_instance_number = numpy.array(dicom_.InstanceNumber)
-        current_instance_number_increment = previous_instance_number - current_instance_number
-        if not instance_number_increment == current_instance_number_increment:
-            logger.warning('Instance Number not consistent through all slices')
-            logger.warning('---------------------------------------------------------')
-            logger.warning('%s %s' % (previous_instance_number, current_instance_number))
-            logger.warning('---------------------------------------------------------')
-            raise ConversionValidationError('INSTANCE_NUMBER_INCONSISTENT')
-        previous_instance_number = current_instance_number
+    instance_numbers = geometry.instance_numbers
+
+    instance_number_increment = instance_numbers[0] - instance_numbers[1]
+    is_inconsistent = (instance_numbers[1:-1] - instance_numbers[2:] != instance_number_increment) | \
+        ~geometry.has_instance_number[1:-1] | ~geometry.has_instance_number[2:]
+    slice_index = _first_true(is_inconsistent)
+    if slice_index is not None:
+        slice_index += 2
+        logger.warning('Instance Number not consistent through all slices')
+        logger.warning('---------------------------------------------------------')
+        logger.warning('%s %s' % (instance_numbers[slice_index - 1], instance_numbers[slice_index]))
+        logger.warning('---------------------------------------------------------')
+        raise ConversionValidationError('INSTANCE_NUMBER_INCONSISTENT')
 
 
 def multiframe_is_slice_increment_inconsistent(dicoms):
@@ -906,43 +1625,19 @@ def multiframe_is_slice_increment_inconsistent(dicoms):
 
     :param dicoms: list of dicoms
     """
-    sliceincrement_inconsistent = False
-    frame_info = dicoms[0].PerFrameFunctionalGroupsSequence
-    first_image_position = _multiframe_get_image_position(dicoms[0], 0)
-    previous_image_position = _multiframe_get_image_position(dicoms[0], 1)
-
-    increment = first_image_position - previous_image_position
-    for frame_number in range(2, len(frame_info)):
-        current_image_position = _multiframe_get_image_position(dicoms[0], frame_number)
-        current_increment = previous_image_position - current_image_position
-        if not numpy.allclose(increment, current_increment, rtol=0.05, atol=0.1):
-            sliceincrement_inconsistent = True
-            break
-        previous_image_position = current_image_position
-    return sliceincrement_inconsistent
+    return _multiframe_get_inconsistent_increment(get_multiframe_index(dicoms[0])) is not None
 
 
 def is_slice_increment_inconsistent(dicoms):
     """
     Validate that the distance between all slices is equal (or very close to)
 
-    :param dicoms: list of dicoms
+    :param dicoms: list of dicoms or SliceGeometry
     """
-    if len(dicoms) == 1:
+    geometry = get_slice_geometry(dicoms)
+    if len(geometry) == 1:
         return True
-    sliceincrement_inconsistent = False
-    first_image_position = numpy.array(dicoms[0].ImagePositionPatient)
-    previous_image_position = numpy.array(dicoms[1].ImagePositionPatient)
-
-    increment = first_image_position - previous_image_position
-    for dicom_ in dicoms[2:]:
-        current_image_position = numpy.array(dicom_.ImagePositionPatient)
-        current_increment = previous_image_position - current_image_position
-        if not numpy.allclose(increment, current_increment, rtol=0.05, atol=0.1):
-            sliceincrement_inconsistent = True
-            break
-        previous_image_position = current_image_position
-    return sliceincrement_inconsistent
+    return _get_inconsistent_increment(geometry.get_positions()) is not None
 
 
 def multiframe_validate_slicecount(dicoms):
@@ -952,8 +1647,7 @@ def multiframe_validate_slicecount(dicoms):
 
     :param dicoms: list of dicoms
     """
-    frame_info = dicoms[0].PerFrameFunctionalGroupsSequence
-    if len(frame_info) <= 3:
+    if get_multiframe_index(dicoms[0]).number_of_frames <= 3:
         logger.warning('At least 3 slices are needed for correct conversion')
         logger.warning('---------------------------------------------------------')
         raise ConversionValidationError('TOO_FEW_SLICES/LOCALIZER')
@@ -964,30 +1658,24 @@ def multiframe_get_stack_count(dicoms):
     Count the number of 3D stacks in a 4D multiframe dicom, for example fmri or DTI
     Not to be confused with multiframe dicoms containing multiple unrelated stacks
     """
-    temporal_position_indices = []
-    in_stack_position_numbers = []
-    for functional_group_sequence in dicoms[0].PerFrameFunctionalGroupsSequence:
-        if "FrameContentSequence" not in functional_group_sequence:
-            continue
-        if "TemporalPositionIndex" in functional_group_sequence.FrameContentSequence[0]:
-            temporal_position_indices.append(functional_group_sequence.FrameContentSequence[0].TemporalPositionIndex)
-        if "InStackPositionNumber" in functional_group_sequence.FrameContentSequence[0]:
-            in_stack_position_numbers.append(functional_group_sequence.FrameContentSequence[0].InStackPositionNumber)
-    temporal_position_indices = list(set(temporal_position_indices))
+    multiframe_index = get_multiframe_index(dicoms[0])
+    temporal_position_indices = numpy.unique(
+        multiframe_index.temporal_position_indices[multiframe_index.has_temporal_position_index])
+    in_stack_position_numbers = multiframe_index.in_stack_positions[multiframe_index.has_in_stack_position]
 
     # try based on temporal position index first but is not always correctly used
     if len(temporal_position_indices) > 1:
         return len(temporal_position_indices), int(
-            len(dicoms[0].PerFrameFunctionalGroupsSequence) / len(temporal_position_indices))
+            multiframe_index.number_of_frames / len(temporal_position_indices))
 
     # try based on the in stack position index
     if len(in_stack_position_numbers) > 1:
-        values, count = numpy.unique(numpy.array(in_stack_position_numbers), return_counts=True)
+        values, count = numpy.unique(in_stack_position_numbers, return_counts=True)
         return count[0], len(values)
 
     # assume 3D block so 1 stack
     else:
-        return 1, len(dicoms[0].PerFrameFunctionalGroupsSequence)
+        return 1, multiframe_index.number_of_frames
 
 
 def validate_slicecount(dicoms):
@@ -1004,37 +1692,11 @@ def validate_slicecount(dicoms):
 
 
 def _multiframe_get_image_orientations(dicom_headers, frame_number=0):
-    frame_info = dicom_headers.PerFrameFunctionalGroupsSequence
-    shared_info = dicom_headers.get("SharedFunctionalGroupsSequence")
-    if "PlaneOrientationSequence" in frame_info[frame_number]:
-        image_orient1 = numpy.array(frame_info[frame_number].PlaneOrientationSequence[0].ImageOrientationPatient)[0:3]
-        image_orient2 = numpy.array(frame_info[frame_number].PlaneOrientationSequence[0].ImageOrientationPatient)[3:6]
-    elif shared_info is not None and "PlaneOrientationSequence" in shared_info[0]:
-        image_orient1 = numpy.array(shared_info[0].PlaneOrientationSequence[0].ImageOrientationPatient)[0:3]
-        image_orient2 = numpy.array(shared_info[0].PlaneOrientationSequence[0].ImageOrientationPatient)[3:6]
-    elif "ImageOrientationPatient" in frame_info[frame_number]:
-        image_orient1 = numpy.array(frame_info[frame_number].ImageOrientationPatient)[0:3]
-        image_orient2 = numpy.array(frame_info[frame_number].ImageOrientationPatient)[3:6]
-    elif shared_info is not None and "ImageOrientationPatient" in shared_info[0]:
-        image_orient1 = numpy.array(shared_info[0].ImageOrientationPatient)[0:3]
-        image_orient2 = numpy.array(shared_info[0].ImageOrientationPatient)[3:6]
-    else:
-        logger.warning('Unsupported or missing PlaneOrientationSequence/ImageOrientationPatient')
-        raise ConversionError('Unsupported or missing PlaneOrientationSequence/ImageOrientationPatient')
-
-    return image_orient1, image_orient2
+    return get_multiframe_index(dicom_headers).get_image_orientations(frame_number)
 
 
 def _multiframe_get_image_position(dicom_headers, frame_number=0):
-    frame_info = dicom_headers.PerFrameFunctionalGroupsSequence
-
-    if "PlanePositionSequence" in frame_info[frame_number]:
-        return numpy.array(frame_info[frame_number].PlanePositionSequence[0].ImagePositionPatient)
-    elif "ImagePositionPatient" in frame_info[frame_number]:
-        return numpy.array(frame_info[frame_number].ImagePositionPatient)
-    else:
-        logger.warning('Unsupported or missing PlanePositionSequence/ImagePositionPatient')
-        raise ConversionError('Unsupported or missing PlanePositionSequence/ImagePositionPatient')
+    return get_multiframe_index(dicom_headers).get_image_position(frame_number)
 
 
 def multiframe_validate_orientation(dicoms):
@@ -1043,43 +1705,45 @@ def multiframe_validate_orientation(dicoms):
 
     :param dicoms: list of dicoms
     """
-
-    frame_info = dicoms[0].PerFrameFunctionalGroupsSequence
-    first_image_orient1, first_image_orient2 = _multiframe_get_image_orientations(dicoms[0], 0)
-
-    for frame_index, frame_ in enumerate(frame_info):
-        # Create affine matrix (http://nipy.sourceforge.net/nibabel/dicom/dicom_orientation.html#dicom-slice-affine)
-        image_orient1, image_orient2 = _multiframe_get_image_orientations(dicoms[0], frame_index)
-        if not numpy.allclose(image_orient1, first_image_orient1, rtol=0.001, atol=0.001) \
-                or not numpy.allclose(image_orient2, first_image_orient2, rtol=0.001, atol=0.001):
-            logger.warning('Image orientations not consistent through all slices')
-            logger.warning('---------------------------------------------------------')
-            logger.warning('%s %s' % (image_orient1, first_image_orient1))
-            logger.warning('%s %s' % (image_orient2, first_image_orient2))
-            logger.warning('---------------------------------------------------------')
-            raise ConversionValidationError('IMAGE_ORIENTATION_INCONSISTENT')
+    multiframe_index = get_multiframe_index(dicoms[0])
+    first_image_orient1, first_image_orient2 = multiframe_index.get_image_orientations(0)
+
+    orientations = multiframe_index.orientations
+    is_inconsistent = ~(numpy.all(numpy.isclose(orientations[:, 0:3], first_image_orient1, rtol=0.001, atol=0.001),
+                                  axis=1) &
+                        numpy.all(numpy.isclose(orientations[:, 3:6], first_image_orient2, rtol=0.001, atol=0.001),
+                                  axis=1))
+    first_inconsistent = _first_true(is_inconsistent)
+    first_missing = _first_true(~multiframe_index.has_orientation)
+    # frames are checked in order so a missing orientation before the first inconsistency is an error
+    if first_missing is not None and (first_inconsistent is None or first_missing <= first_inconsistent):
+        multiframe_index.get_image_orientations(first_missing)
+    if first_inconsistent is not None:
+        image_orient1, image_orient2 = multiframe_index.get_image_orientations(first_inconsistent)
+        logger.warning('Image orientations not consistent through all slices')
+        logger.warning('---------------------------------------------------------')
+        logger.warning('%s %s' % (image_orient1, first_image_orient1))
+        logger.warning('%s %s' % (image_orient2, first_image_orient2))
+        logger.warning('---------------------------------------------------------')
+        raise ConversionValidationError('IMAGE_ORIENTATION_INCONSISTENT')
 
 
 def validate_orientation(dicoms):
     """
     Validate that all dicoms have the same orientation
 
-    :param dicoms: list of dicoms
+    :param dicoms: list of dicoms or SliceGeometry
     """
-    first_image_orient1 = numpy.array(dicoms[0].ImageOrientationPatient)[0:3]
-    first_image_orient2 = numpy.array(dicoms[0].ImageOrientationPatient)[3:6]
-    for dicom_ in dicoms:
-        # Create affine matrix (http://nipy.sourceforge.net/nibabel/dicom/dicom_orientation.html#dicom-slice-affine)
-        image_orient1 = numpy.array(dicom_.ImageOrientationPatient)[0:3]
-        image_orient2 = numpy.array(dicom_.ImageOrientationPatient)[3:6]
-        if not numpy.allclose(image_orient1, first_image_orient1, rtol=0.001, atol=0.001) \
-                or not numpy.allclose(image_orient2, first_image_orient2, rtol=0.001, atol=0.001):
-            logger.warning('Image orientations not consistent through all slices')
-            logger.warning('---------------------------------------------------------')
-            logger.warning('%s %s' % (image_orient1, first_image_orient1))
-            logger.warning('%s %s' % (image_orient2, first_image_orient2))
-            logger.warning('---------------------------------------------------------')
-            raise ConversionValidationError('IMAGE_ORIENTATION_INCONSISTENT')
+    orientations = get_slice_geometry(dicoms).get_orientations()
+    first_orientation = orientations[0]
+    slice_index = _first_true(~is_same_orientation(orientations, first_orientation))
+    if slice_index is not None:
+        logger.warning('Image orientations not consistent through all slices')
+        logger.warning('---------------------------------------------------------')
+        logger.warning('%s %s' % (orientations[slice_index, 0:3], first_orientation[0:3]))
+        logger.warning('%s %s' % (orientations[slice_index, 3:6], first_orientation[3:6]))
+        logger.warning('---------------------------------------------------------')
+        raise ConversionValidationError('IMAGE_ORIENTATION_INCONSISTENT')
 
 
 def set_tr_te(nifti_image, repetition_time, echo_time):
@@ -1123,6 +1787,35 @@ def get_nifti_data(nifti_image):
     return numpy.asanyarray(nifti_image.dataobj)
 
 
+def read_dicom_file(filename, stop_before_pixels=False):
+    """
+    Check the DICM header block and read the dicom file using a single open of the file
+    This is the combination of is_dicom_file and dcmread without opening the file twice
+
+    :param filename: file to read
+    :type filename: str
+    :param stop_before_pixels: Should we stop reading before the pixeldata (handy if we only want header info)
+    :returns: the dicom object or None if it is not a dicom file
+    """
+    with open(filename, 'rb') as file_stream:
+        file_stream.seek(128)
+        has_dicm = file_stream.read(4) == b'DICM'
+        if not has_dicm and not dicom2nifti.settings.pydicom_read_force:
+            return None
+        file_stream.seek(0)
+        # noinspection PyBroadException
+        try:
+            # the filename is kept on the dataset so deferred elements can still be read after closing
+            return dcmread(file_stream,
+                           defer_size="1 KB",
+                           stop_before_pixels=stop_before_pixels,
+                           force=dicom2nifti.settings.pydicom_read_force)
+        except:
+            if has_dicm:
+                raise
+            return None
+
+
 def is_dicom_file(filename):
     """
     Util function to check if file is a dicom file
@@ -20,6 +20,7 @@ import dicom2nifti.convert_generic as convert_generic
 import dicom2nifti.convert_philips as convert_philips
 import dicom2nifti.convert_siemens as convert_siemens
 import dicom2nifti.image_reorientation as image_reorientation
+import dicom2nifti.nifti_writer as nifti_writer
 import dicom2nifti.resample as resample
 import dicom2nifti.settings as settings
 from dicom2nifti import convert_hitachi
@@ -55,6 +56,7 @@ def dicom_series_to_nifti(original_dicom_directory, output_file=None, reorient_n
     - the NIFTI file path under 'NII_FILE'
     - the BVAL file path under 'BVAL_FILE' (only for dti)
     - the BVEC file path under 'BVEC_FILE' (only for dti)
+    - the applied reorientation under 'REORIENTATION' (None if the data was not reoriented or already LAS)
 
     IMPORTANT:
     If no specific sequence type can be found it will default to anatomical and try to convert.
@@ -97,6 +99,7 @@ def dicom_array_to_nifti(dicom_list, output_file, reorient_nifti=True):
     - the NIFTI file path under 'NII_FILE'
     - the BVAL file path under 'BVAL_FILE' (only for dti)
     - the BVEC file path under 'BVEC_FILE' (only for dti)
+    - the applied reorientation under 'REORIENTATION' (None if the data was not reoriented or already LAS)
 
     IMPORTANT:
     If no specific sequence type can be found it will default to anatomical and try to convert.
@@ -115,32 +118,66 @@ def dicom_array_to_nifti(dicom_list, output_file, reorient_nifti=True):
 
     vendor = _get_vendor(dicom_list)
 
+    # when resampling everything is done in memory and written once at the end
+    # otherwise the converter reorients and writes the output directly (4d data timepoint by timepoint)
+    if settings.resample:
+        converter_output_file, converter_reorient = None, False
+    else:
+        converter_output_file, converter_reorient = output_file, reorient_nifti
+
     if vendor == Vendor.GENERIC:
-        results = convert_generic.dicom_to_nifti(dicom_list, output_file)
+        results = convert_generic.dicom_to_nifti(dicom_list, converter_output_file, converter_reorient)
     elif vendor == Vendor.SIEMENS:
-        results = convert_siemens.dicom_to_nifti(dicom_list, output_file)
+        results = convert_siemens.dicom_to_nifti(dicom_list, converter_output_file, converter_reorient)
     elif vendor == Vendor.GE:
-        results = convert_ge.dicom_to_nifti(dicom_list, output_file)
+        results = convert_ge.dicom_to_nifti(dicom_list, converter_output_file, converter_reorient)
     elif vendor == Vendor.PHILIPS:
-        results = convert_philips.dicom_to_nifti(dicom_list, output_file)
+        results = convert_philips.dicom_to_nifti(dicom_list, converter_output_file, converter_reorient)
     elif vendor == Vendor.HITACHI:
-        results = convert_hitachi.dicom_to_nifti(dicom_list, output_file)
+        results = convert_hitachi.dicom_to_nifti(dicom_list, converter_output_file, converter_reorient)
     else:
         raise ConversionValidationError("UNSUPPORTED_DATA")
 
-    # do image reorientation if needed
-    if reorient_nifti or settings.resample:
-        gc.collect()
-        results['NII'] = image_reorientation.reorient_image(results['NII'], results['NII_FILE'])
+    if not settings.resample:
+        return results
+
+    # do image reorientation (data that is already LAS is not touched)
+    gc.collect()
+    results['NII'], results['REORIENTATION'] = image_reorientation.reorient_nifti(results['NII'])
 
     # resampling needs to be after reorientation
-    if settings.resample:
-        if not common.is_orthogonal_nifti(results['NII']):
-            results['NII'] = resample.resample_single_nifti(results['NII'], results['NII_FILE'])
+    if not common.is_orthogonal_nifti(results['NII']):
+        results['NII'] = resample.resample_single_nifti(results['NII'], None)
+
+    if output_file is not None:
+        _write_results(results, output_file)
 
     return results
 
 
+def _write_results(results, output_file):
+    """
+    Write the nifti and the bval and bvec files (if any) of the conversion results and update the file paths
+
+    :param results: conversion results as returned by the converters
+    :param output_file: filepath of the nifti file
+    """
+    results['NII'].header.set_slope_inter(1, 0)
+    results['NII'].header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
+    nifti_writer.write_nifti(results['NII'], output_file)
+    results['NII_FILE'] = output_file
+
+    if results.get('BVAL') is not None:
+        base_name = os.path.splitext(output_file)[0]
+        if base_name.endswith('.nii'):
+            base_name = os.path.splitext(base_name)[0]
+        logger.info('Creating bval en bvec files')
+        results['BVAL_FILE'] = '%s.bval' % base_name
+        results['BVEC_FILE'] = '%s.bvec' % base_name
+        common.write_bval_file(results['BVAL'], results['BVAL_FILE'])
+        common.write_bvec_file(results['BVEC'], results['BVEC_FILE'])
+
+
 def are_imaging_dicoms(dicom_input):
     """
     This function will check the dicom headers to see which type of series it is
@@ -4,6 +4,7 @@ this module houses all the code to just convert a directory of random dicom file
 
 @author: abrys
 """
+import concurrent.futures
 import gc
 import logging
 import os
@@ -17,12 +18,13 @@ from pydicom.tag import Tag
 
 import dicom2nifti.common as common
 import dicom2nifti.convert_dicom as convert_dicom
+import dicom2nifti.header_index as header_index
 import dicom2nifti.settings
 
 logger = logging.getLogger(__name__)
 
 
-def convert_directory(dicom_directory, output_folder, compression=True, reorient=True):
+def convert_directory(dicom_directory, output_folder, compression=True, reorient=True, workers=1):
     """
     This function will order all dicom files by series and order them one by one
 
@@ -30,64 +32,200 @@ def convert_directory(dicom_directory, output_folder, compression=True, reorient
     :param reorient: reorient the dicoms according to LAS orientation
     :param output_folder: folder to write the nifti files to
     :param dicom_directory: directory with dicom files
+    :param workers: number of processes used to convert series in parallel (default 1, no parallel conversion)
+    """
+    # sort dicom files by series uid (only the headers are read here)
+    dicom_series, series_headers = _get_series_files(dicom_directory)
+
+    # the filenames are decided up front so they do not depend on the order in which series are converted
+    nifti_files = {}
+    for series_id, dicom_header in series_headers.items():
+        # noinspection PyBroadException
+        try:
+            nifti_files[series_id] = _get_nifti_file(dicom_header, output_folder, compression)
+        except:  # Explicitly capturing app exceptions here to be able to continue processing
+            logger.info("Unable to convert: %s" % series_id)
+            traceback.print_exc()
+
+    if workers > 1 and len(nifti_files) > 1:
+        # series writing to the same file are converted in the same job and in the original order
+        # so the file that remains is the same one as with the sequential conversion
+        jobs = {}
+        for series_id, nifti_file in nifti_files.items():
+            jobs.setdefault(nifti_file, []).append(dicom_series[series_id])
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                    initializer=_set_settings,
+                                                    initargs=(_get_settings(workers),)) as executor:
+            futures = {executor.submit(_convert_series_job, series_files, nifti_file, reorient): nifti_file
+                       for nifti_file, series_files in jobs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                # noinspection PyBroadException
+                try:
+                    future.result()
+                except:  # a crashed worker (broken pool) only fails its own jobs, the others are still collected
+                    logger.warning("Unable to convert: %s" % futures[future])
+                    traceback.print_exc()
+    else:
+        # start converting one by one
+        for series_id, nifti_file in nifti_files.items():
+            _convert_series(dicom_series[series_id], nifti_file, reorient)
+            gc.collect()
+
+
+def _convert_series_job(series_files, nifti_file, reorient):
+    """
+    Convert a list of series (given by their file paths) to the same nifti file, used as process pool job
+    """
+    for dicom_files in series_files:
+        _convert_series(dicom_files, nifti_file, reorient)
+        gc.collect()
+
+
+def _convert_series(dicom_files, nifti_file, reorient):
+    """
+    Read and convert a single series, errors are logged so the other series can still be converted
+
+    :param dicom_files: list with the file paths of 1 series
+    :param nifti_file: file path of the nifti to write
+    :param reorient: reorient the dicoms according to LAS orientation
+    """
+    # noinspection PyBroadException
+    try:
+        logger.info('--------------------------------------------')
+        logger.info('Start converting %s' % nifti_file)
+        # now read the full dicom files of this series only
+        dicom_input = _read_series_files(dicom_files)
+        convert_dicom.dicom_array_to_nifti(dicom_input, nifti_file, reorient)
+    except:  # Explicitly capturing app exceptions here to be able to continue processing
+        logger.info("Unable to convert: %s" % nifti_file)
+        traceback.print_exc()
+
+
+def _get_nifti_file(dicom_header, output_folder, compression):
+    """
+    Construct the filename for the nifti of a series based on the headers of its first dicom
+    """
+    if 'SeriesNumber' in dicom_header:
+        base_filename = _remove_accents('%s' % dicom_header.SeriesNumber)
+        if 'SeriesDescription' in dicom_header:
+            base_filename = _remove_accents('%s_%s' % (base_filename,
+                                                       dicom_header.SeriesDescription))
+        elif 'SequenceName' in dicom_header:
+            base_filename = _remove_accents('%s_%s' % (base_filename,
+                                                       dicom_header.SequenceName))
+        elif 'ProtocolName' in dicom_header:
+            base_filename = _remove_accents('%s_%s' % (base_filename,
+                                                       dicom_header.ProtocolName))
+    else:
+        base_filename = _remove_accents(dicom_header.SeriesInstanceUID)
+    if compression:
+        return os.path.join(output_folder, base_filename + '.nii.gz')
+    return os.path.join(output_folder, base_filename + '.nii')
+
+
+def _get_settings(workers=1):
+    """
+    Get the current values of the settings module so they can be passed to worker processes
+    The thread counts are divided over the workers so the total number of threads does not grow with the workers
+
+    :param workers: number of worker processes
+    """
+    settings_values = {name: value for name, value in vars(dicom2nifti.settings).items()
+                       if not name.startswith('_') and isinstance(value, (bool, int, float, str, type(None)))}
+    for name in ['scan_threads', 'resample_threads', 'compression_threads']:
+        settings_values[name] = max(1, settings_values[name] // workers)
+    return settings_values
+
+
+def _set_settings(settings_values):
+    """
+    Apply the settings of the parent process in a worker process
+    """
+    for name, value in settings_values.items():
+        setattr(dicom2nifti.settings, name, value)
+
+
+def _get_series_files(dicom_directory):
+    """
+    Search all dicom files in a directory and group the file paths by SeriesInstanceUID
+    Only the headers are read here so the memory usage does not depend on the size of the pixel data
+
+    :param dicom_directory: directory with dicom files
+    :return: dict with the SeriesInstanceUID as key and a list of file paths as value and
+             dict with the SeriesInstanceUID as key and the headers of the first dicom of the series as value
     """
-    # sort dicom files by series uid
     dicom_series = {}
-    for root, _, files in os.walk(dicom_directory):
-        for dicom_file in files:
-            file_path = os.path.join(root, dicom_file)
+    series_headers = {}
+    file_paths = common.get_file_paths(dicom_directory)
+
+    # files that did not change since the previous scan are taken from the header index (if enabled)
+    index = header_index.open_index()
+    indexed = {}
+    if index is not None:
+        indexed = index.lookup(file_paths)
+    read_paths = [file_path for file_path in file_paths if file_path not in indexed]
+    read_headers = zip(read_paths, common.map_files(_read_header, read_paths))
+
+    try:
+        for file_path in file_paths:
+            if file_path in indexed:
+                valid, dicom_headers = indexed[file_path]
+            else:
+                _, dicom_headers = next(read_headers)
+                # unreadable files are indexed as not valid so they are not read again while they are unchanged
+                valid = dicom_headers is not None and _is_valid_imaging_dicom(dicom_headers)
+                if index is not None:
+                    index.add(file_path, valid, dicom_headers)
+                if dicom_headers is None:
+                    continue
             # noinspection PyBroadException
             try:
-                if common.is_dicom_file(file_path):
-                    # read the dicom as fast as possible
-                    # (max length for SeriesInstanceUID is 64 so defer_size 100 should be ok)
-
-                    dicom_headers = dcmread(file_path,
-                                                      defer_size="1 KB",
-                                                      stop_before_pixels=False,
-                                                      force=dicom2nifti.settings.pydicom_read_force)
-                    if not _is_valid_imaging_dicom(dicom_headers):
-                        logger.info("Skipping: %s" % file_path)
-                        continue
-                    logger.info("Organizing: %s" % file_path)
-                    if dicom_headers.SeriesInstanceUID not in dicom_series:
-                        dicom_series[dicom_headers.SeriesInstanceUID] = []
-                    dicom_series[dicom_headers.SeriesInstanceUID].append(dicom_headers)
+                if not valid:
+                    logger.info("Skipping: %s" % file_path)
+                    continue
+                logger.info("Organizing: %s" % file_path)
+                if dicom_headers.SeriesInstanceUID not in dicom_series:
+                    dicom_series[dicom_headers.SeriesInstanceUID] = []
+                    series_headers[dicom_headers.SeriesInstanceUID] = dicom_headers
+                dicom_series[dicom_headers.SeriesInstanceUID].append(file_path)
             except:  # Explicitly capturing all errors here to be able to continue processing all the rest
                 logger.warning("Unable to read: %s" % file_path)
                 traceback.print_exc()
+    finally:
+        if index is not None:
+            index.commit()
+            index.close()
+    return dicom_series, series_headers
 
-    # start converting one by one
-    for series_id, dicom_input in dicom_series.items():
-        base_filename = ""
-        # noinspection PyBroadException
-        try:
-            # construct the filename for the nifti
-            base_filename = ""
-            if 'SeriesNumber' in dicom_input[0]:
-                base_filename = _remove_accents('%s' % dicom_input[0].SeriesNumber)
-                if 'SeriesDescription' in dicom_input[0]:
-                    base_filename = _remove_accents('%s_%s' % (base_filename,
-                                                               dicom_input[0].SeriesDescription))
-                elif 'SequenceName' in dicom_input[0]:
-                    base_filename = _remove_accents('%s_%s' % (base_filename,
-                                                               dicom_input[0].SequenceName))
-                elif 'ProtocolName' in dicom_input[0]:
-                    base_filename = _remove_accents('%s_%s' % (base_filename,
-                                                               dicom_input[0].ProtocolName))
-            else:
-                base_filename = _remove_accents(dicom_input[0].SeriesInstanceUID)
-            logger.info('--------------------------------------------')
-            logger.info('Start converting %s' % base_filename)
-            if compression:
-                nifti_file = os.path.join(output_folder, base_filename + '.nii.gz')
-            else:
-                nifti_file = os.path.join(output_folder, base_filename + '.nii')
-            convert_dicom.dicom_array_to_nifti(dicom_input, nifti_file, reorient)
-            gc.collect()
-        except:  # Explicitly capturing app exceptions here to be able to continue processing
-            logger.info("Unable to convert: %s" % base_filename)
-            traceback.print_exc()
+
+def _read_header(file_path):
+    """
+    Read the dicom headers (without pixel data) of a file, returns None if it is not a (readable) dicom file
+    """
+    # noinspection PyBroadException
+    try:
+        # read the dicom headers as fast as possible
+        return common.read_dicom_file(file_path, stop_before_pixels=True)
+    except:  # Explicitly capturing all errors here to be able to continue processing all the rest
+        logger.warning("Unable to read: %s" % file_path)
+        traceback.print_exc()
+    return None
+
+
+def _read_series_files(dicom_files):
+    """
+    Read the dicom files of a single series including the pixel data
+
+    :param dicom_files: list with the file paths of 1 series
+    :return: list of dicom objects
+    """
+    dicom_input = []
+    for file_path in dicom_files:
+        dicom_input.append(dcmread(file_path,
+                                   defer_size="1 KB",
+                                   stop_before_pixels=False,
+                                   force=dicom2nifti.settings.pydicom_read_force))
+    return dicom_input
 
 
 def _is_valid_imaging_dicom(dicom_header):
@@ -22,13 +22,14 @@ import dicom2nifti.convert_generic as convert_generic
 logger = logging.getLogger(__name__)
 
 
-def dicom_to_nifti(dicom_input, output_file=None):
+def dicom_to_nifti(dicom_input, output_file=None, reorient_nifti=False):
     """
     This is the main dicom to nifti conversion fuction for ge images.
     As input ge images are required. It will then determine the type of images and do the correct conversion
 
     Examples: See unit test
 
+    :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
     :param output_file: the filepath to the output nifti file
     :param dicom_input: list with dicom objects
     """
@@ -51,10 +52,10 @@ def dicom_to_nifti(dicom_input, output_file=None):
 
     if convert_generic.is_4d(grouped_dicoms):
         logger.info('Found sequence type: 4D')
-        return _four_d_to_nifti(grouped_dicoms, output_file)
+        return _four_d_to_nifti(grouped_dicoms, output_file, reorient_nifti)
 
     logger.info('Assuming anatomical data')
-    return convert_generic.dicom_to_nifti(dicom_input, output_file)
+    return convert_generic.dicom_to_nifti(dicom_input, output_file, reorient_nifti)
 
 
 def _is_diffusion_imaging(grouped_dicoms):
@@ -77,13 +78,13 @@ def _is_diffusion_imaging(grouped_dicoms):
     return True
 
 
-def _four_d_to_nifti(grouped_dicoms, output_file):
+def _four_d_to_nifti(grouped_dicoms, output_file, reorient_nifti=False):
     """
     This function will convert ge 4d series to a nifti
     """
 
     # Create mosaic block
-    result = convert_generic.four_d_to_nifti(grouped_dicoms, output_file)
+    result = convert_generic.four_d_to_nifti(grouped_dicoms, output_file, reorient_nifti)
 
     if _is_diffusion_imaging(grouped_dicoms):
         bval_file = None
@@ -102,6 +103,7 @@ def _four_d_to_nifti(grouped_dicoms, output_file):
             'BVAL_FILE': bval_file,
             'BVEC_FILE': bvec_file,
             'NII': result['NII'],
+            'REORIENTATION': result['REORIENTATION'],
             'BVAL': bval,
             'BVEC': bvec,
             'MAX_SLICE_INCREMENT': result['MAX_SLICE_INCREMENT']
@@ -109,49 +111,53 @@ def _four_d_to_nifti(grouped_dicoms, output_file):
     return result
 
 
+def _get_bval(dicom_):
+    """
+    Read the original bval of a volume
+    0043:1039: B-values (4 values, 1st value is actual B value)
+    """
+    # bval can be stored both in string as number format in dicom so implement both
+    # some workarounds needed for implicit transfer syntax to work
+    if isinstance(dicom_[Tag(0x0043, 0x1039)].value, str):  # this works for python2.7
+        return float(dicom_[Tag(0x0043, 0x1039)].value.split('\\')[0])
+    elif isinstance(dicom_[Tag(0x0043, 0x1039)].value, bytes):  # this works for python3.o
+        return float(dicom_[Tag(0x0043, 0x1039)].value.decode("utf-8").split('\\')[0])
+    return dicom_[Tag(0x0043, 0x1039)][0]
+
+
+def _get_bvec(dicom_):
+    """
+    Read the original bvec of a volume
+    0019:10bb: Diffusion X
+    0019:10bc: Diffusion Y
+    0019:10bd: Diffusion Z
+    """
+    return [-float(dicom_[Tag(0x0019, 0x10bb)].value),  # invert based upon mricron output
+            float(dicom_[Tag(0x0019, 0x10bc)].value),
+            float(dicom_[Tag(0x0019, 0x10bd)].value)]
+
+
 def _get_bvals_bvecs(grouped_dicoms):
     """
     Write the bvals from the sorted dicom files to a bval file
     """
-    # loop over all timepoints and create a list with all bvals and bvecs
-    bvals = numpy.zeros([len(grouped_dicoms)], dtype=numpy.int32)
-    bvecs = numpy.zeros([len(grouped_dicoms), 3])
-
-    for group_index in range(0, len(grouped_dicoms)):
-        dicom_ = grouped_dicoms[group_index][0]
-        # 0019:10bb: Diffusion X
-        # 0019:10bc: Diffusion Y
-        # 0019:10bd: Diffusion Z
-        # 0043:1039: B-values (4 values, 1st value is actual B value)
-
-        # bval can be stored both in string as number format in dicom so implement both
-        # some workarounds needed for implicit transfer syntax to work
-        if isinstance(dicom_[Tag(0x0043, 0x1039)].value, str):  # this works for python2.7
-            original_bval = float(dicom_[Tag(0x0043, 0x1039)].value.split('\\')[0])
-        elif isinstance(dicom_[Tag(0x0043, 0x1039)].value, bytes):  # this works for python3.o
-            original_bval = float(dicom_[Tag(0x0043, 0x1039)].value.decode("utf-8").split('\\')[0])
-        else:
-            original_bval = dicom_[Tag(0x0043, 0x1039)][0]
-        original_bvec = numpy.array([0, 0, 0], dtype=numpy.float32)
-        original_bvec[0] = -float(dicom_[Tag(0x0019, 0x10bb)].value)  # invert based upon mricron output
-        original_bvec[1] = float(dicom_[Tag(0x0019, 0x10bc)].value)
-        original_bvec[2] = float(dicom_[Tag(0x0019, 0x10bd)].value)
-
-        # Add calculated B Value
-        if original_bval != 0:  # only normalize if there is a value
-            corrected_bval = original_bval * pow(numpy.linalg.norm(original_bvec), 2)
-            if numpy.linalg.norm(original_bvec) != 0:
-                normalized_bvec = original_bvec / numpy.linalg.norm(original_bvec)
-            else:
-                normalized_bvec = original_bvec
-        else:
-            corrected_bval = original_bval
-            normalized_bvec = original_bvec
-
-        bvals[group_index] = int(round(corrected_bval))  # we want the original numbers back as in the protocol
-        bvecs[group_index, :] = normalized_bvec
-
-    return bvals, bvecs
+    # create arrays with all bvals and bvecs
+    original_bvals, original_bvecs = common.get_gradient_table([group[0] for group in grouped_dicoms],
+                                                               _get_bval,
+                                                               _get_bvec)
+    original_bvals = original_bvals.astype(numpy.float32)
+    original_bvecs = original_bvecs.astype(numpy.float32)
+
+    # the length of the bvec scales the bval, only normalize if there is a value
+    norms = numpy.linalg.norm(original_bvecs, axis=1)
+    is_weighted = original_bvals != 0
+    corrected_bvals = numpy.where(is_weighted, original_bvals * norms ** 2, original_bvals)
+    is_normalized = is_weighted & (norms != 0)
+    normalized_bvecs = original_bvecs.astype(numpy.float64)
+    normalized_bvecs[is_normalized] = original_bvecs[is_normalized] / norms[is_normalized, numpy.newaxis]
+
+    bvals = numpy.round(corrected_bvals).astype(numpy.int32)  # we want the original numbers back as in the protocol
+    return bvals, normalized_bvecs
 
 
 def _create_bvals_bvecs(grouped_dicoms, bval_file, bvec_file):
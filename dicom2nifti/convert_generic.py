@@ -11,6 +11,8 @@ import numpy
 from pydicom.tag import Tag
 
 import dicom2nifti.common as common
+import dicom2nifti.image_reorientation as image_reorientation
+import dicom2nifti.nifti_writer as nifti_writer
 import dicom2nifti.settings as settings
 import dicom2nifti.resample as resample
 from dicom2nifti.exceptions import ConversionError, ConversionValidationError
@@ -28,34 +30,10 @@ def get_grouped_dicoms(dicom_input):
     dicoms = sorted(dicom_input, key=lambda x: x.InstanceNumber)
 
     # now group per stack
-    grouped_dicoms = [[]]  # list with first element a list
-    stack_index = 0
-
-    # loop over all sorted dicoms and sort them by stack
     # for this we use the position and direction of the slices so we can detect a new stack easily
-    previous_position = None
-    previous_direction = None
-    for dicom_ in dicoms:
-        current_direction = None
-        # if the stack number decreases we moved to the next stack
-        if previous_position is not None:
-            current_direction = numpy.array(dicom_.ImagePositionPatient) - previous_position
-            current_direction = current_direction / numpy.linalg.norm(current_direction)
-        if current_direction is not None and \
-                previous_direction is not None and \
-                not numpy.allclose(current_direction, previous_direction, rtol=0.05, atol=0.05):
-            previous_position = numpy.array(dicom_.ImagePositionPatient)
-            previous_direction = None
-            stack_index += 1
-        else:
-            previous_position = numpy.array(dicom_.ImagePositionPatient)
-            previous_direction = current_direction
-
-        if stack_index >= len(grouped_dicoms):
-            grouped_dicoms.append([])
-        grouped_dicoms[stack_index].append(dicom_)
+    positions = numpy.array([dicom_.ImagePositionPatient[0:3] for dicom_ in dicoms], dtype=float).reshape(-1, 3)
+    return [[dicoms[index] for index in group] for group in common.get_stack_groups(positions)]
 
-    return grouped_dicoms
 
 def is_4d(grouped_dicoms):
     """
@@ -72,10 +50,30 @@ def is_4d(grouped_dicoms):
 
     return False
 
-def four_d_to_nifti(grouped_dicoms, output_file):
+def four_d_to_nifti(grouped_dicoms, output_file, reorient_nifti=False):
     """
     This function will convert ge 4d series to a nifti
     """
+    if output_file is not None:
+        logger.info('Creating affine')
+        # Create the nifti header info
+        affine, slice_increment = common.create_affine(grouped_dicoms[0])
+
+        # write the timepoints to disk while they are created so only one timepoint is in memory
+        logger.info('Saving nifti to disk %s' % output_file)
+        nii_image, reorientation = write_timepoints((_timepoint_to_block(timepoint_dicoms)
+                                                     for timepoint_dicoms in grouped_dicoms),
+                                                    len(grouped_dicoms),
+                                                    affine,
+                                                    output_file,
+                                                    grouped_dicoms[0][0].RepetitionTime,
+                                                    grouped_dicoms[0][0].EchoTime,
+                                                    reorient_nifti=reorient_nifti)
+
+        return {'NII_FILE': output_file,
+                'NII': nii_image,
+                'REORIENTATION': reorientation,
+                'MAX_SLICE_INCREMENT': slice_increment}
 
     # Create mosaic block
     logger.info('Creating data block')
@@ -89,45 +87,133 @@ def four_d_to_nifti(grouped_dicoms, output_file):
     # Convert to nifti
     nii_image = nibabel.Nifti1Image(full_block, affine)
     common.set_tr_te(nii_image, grouped_dicoms[0][0].RepetitionTime, grouped_dicoms[0][0].EchoTime)
-    logger.info('Saving nifti to disk %s' % output_file)
+    nii_image, reorientation = reorient_and_save(nii_image, None, reorient_nifti)
+
+    return {'NII_FILE': output_file,
+            'NII': nii_image,
+            'REORIENTATION': reorientation,
+            'MAX_SLICE_INCREMENT': slice_increment}
+
+
+def reorient_and_save(nii_image, output_file, reorient_nifti=False):
+    """
+    Reorient the converted nifti to LAS (if requested) and save it to disk (if an output file is given)
+
+    :param nii_image: the converted nifti image
+    :param output_file: filepath to the output nifti, None to keep the image in memory only
+    :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
+    :return: tuple with the nifti image and the applied reorientation (None if not reoriented or already LAS)
+    """
+    reorientation = None
+    if reorient_nifti:
+        nii_image, reorientation = image_reorientation.reorient_nifti(nii_image)
 
-    # Save to disk
     if output_file is not None:
+        logger.info('Saving nifti to disk %s' % output_file)
         nii_image.header.set_slope_inter(1, 0)
         nii_image.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-        nii_image.to_filename(output_file)
+        nifti_writer.write_nifti(nii_image, output_file)
 
-    return {'NII_FILE': output_file,
-            'NII': nii_image,
-            'MAX_SLICE_INCREMENT': slice_increment}
+    return nii_image, reorientation
 
-def _get_full_block(grouped_dicoms):
+
+def write_timepoints(timepoint_blocks, number_of_timepoints, affine, output_file, repetition_time, echo_time,
+                     squeeze=False, reorient_nifti=False):
     """
-    Generate a full datablock containing all timepoints
+    Write a 4D nifti timepoint by timepoint so only one timepoint needs to be in memory
+
+    The LAS reorientation only permutes and flips the x, y and z axes so it is applied to every timepoint
+    while writing, only single slice data (where the time axis can take part in the reorientation) is
+    reoriented in memory
+
+    :param timepoint_blocks: iterable with the 3D data block (x, y, z) of each timepoint
+    :param number_of_timepoints: number of timepoints
+    :param affine: affine of the nifti
+    :param output_file: filepath to the output nifti
+    :param repetition_time: repetition time for the nifti header
+    :param echo_time: echo time for the nifti header
+    :param squeeze: remove the dimensions of size 1 (like numpy.squeeze on the full block)
+    :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
+    :return: tuple with the written nifti image (data is read from disk when needed) and the applied
+             reorientation (None if not reoriented or already LAS)
+    """
+    timepoint_blocks = _validate_timepoints(timepoint_blocks, number_of_timepoints)
+    data_block = next(timepoint_blocks)
+    block_shape = data_block.shape
+    shape = block_shape + (number_of_timepoints,)
+    if squeeze:
+        shape = tuple(size for size in shape if size != 1)
+
+    if reorient_nifti and 1 in block_shape:
+        full_block = common.create_4d_block(block_shape, number_of_timepoints, data_block.dtype)
+        full_block[..., 0] = data_block
+        del data_block
+        for index, data_block in enumerate(timepoint_blocks, 1):
+            full_block[..., index] = data_block
+        nii_image = nibabel.Nifti1Image(full_block.reshape(shape, order='F'), affine)
+        common.set_tr_te(nii_image, repetition_time, echo_time)
+        return reorient_and_save(nii_image, output_file, reorient_nifti)
+
+    axes, flips, reorientation = [0, 1, 2], (), None
+    if reorient_nifti:
+        # the same squeezing as the reorientation of a full image (see image_reorientation.reorient_nifti)
+        squeezed_shape = tuple(size for size in shape if size != 1)
+        axes, flips, affine = image_reorientation.get_reorientation(affine, squeezed_shape)
+        if axes != [0, 1, 2] or flips or squeezed_shape != shape:
+            reorientation = {'AXES': axes, 'FLIPS': list(flips)}
+        shape = tuple(block_shape[axis] for axis in axes) + squeezed_shape[3:]
+
+    template = nifti_writer.create_template(shape, data_block.dtype, affine)
+    common.set_tr_te(template, repetition_time, echo_time)
+    template.header.set_slope_inter(1, 0)
+    template.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
+    with nifti_writer.NiftiWriter(output_file, template) as writer:
+        writer.write(_reorient_block(data_block, axes, flips))
+        del data_block
+        for data_block in timepoint_blocks:
+            writer.write(_reorient_block(data_block, axes, flips))
+            del data_block
+
+    # no memory mapping because the file can be overwritten later
+    return nibabel.load(output_file, mmap=False), reorientation
+
+
+def _validate_timepoints(timepoint_blocks, number_of_timepoints):
     """
-    # For each slice / mosaic create a data volume block
-    data_blocks = []
-    for index in range(0, len(grouped_dicoms)):
-        logger.info('Creating block %s of %s' % (index + 1, len(grouped_dicoms)))
-        data_blocks.append(_timepoint_to_block(grouped_dicoms[index]))
-
-    # Add the data_blocks together to one 4d block
-    size_x = numpy.shape(data_blocks[0])[0]
-    size_y = numpy.shape(data_blocks[0])[1]
-    size_z = numpy.shape(data_blocks[0])[2]
-    size_t = len(data_blocks)
-    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=data_blocks[0].dtype)
-    for index in range(0, size_t):
-        if full_block[:, :, :, index].shape != data_blocks[index].shape:
+    Iterate over the timepoint blocks and check that they all have the shape of the first timepoint
+    """
+    block_shape = None
+    for index, data_block in enumerate(timepoint_blocks):
+        logger.info('Creating block %s of %s' % (index + 1, number_of_timepoints))
+        if block_shape is None:
+            block_shape = data_block.shape
+        elif data_block.shape != block_shape:
             logger.warning('Missing slices (slice count mismatch between timepoint %s and %s)' % (index - 1, index))
             logger.warning('---------------------------------------------------------')
-            logger.warning(full_block[:, :, :, index].shape)
-            logger.warning(data_blocks[index].shape)
+            logger.warning(block_shape)
+            logger.warning(data_block.shape)
             logger.warning('---------------------------------------------------------')
             raise ConversionError("MISSING_DICOM_FILES")
-        full_block[:, :, :, index] = data_blocks[index]
+        yield data_block
 
-    return full_block
+
+def _reorient_block(data_block, axes, flips):
+    """
+    Apply the reorientation of the x, y and z axes to a timepoint (as a view)
+    """
+    if axes != [0, 1, 2]:
+        data_block = numpy.moveaxis(data_block, axes, [0, 1, 2])
+    if flips:
+        data_block = numpy.flip(data_block, axis=flips)
+    return data_block
+
+
+def _get_full_block(grouped_dicoms):
+    """
+    Generate a full datablock containing all timepoints
+    """
+    # the 4d block is allocated once and every timepoint is written in its place
+    return common.get_4d_pixeldata(grouped_dicoms)
 
 def _timepoint_to_block(timepoint_dicoms):
     """
@@ -136,12 +222,13 @@ def _timepoint_to_block(timepoint_dicoms):
     # similar way of getting the block to anatomical however here we are creating the dicom series our selves
     return common.get_volume_pixeldata(timepoint_dicoms)
 
-def multiframe_to_nifti(dicom_input, output_file):
+def multiframe_to_nifti(dicom_input, output_file, reorient_nifti=False):
     """
     This function will convert an anatomical dicom series to a nifti
 
     Examples: See unit test
 
+    :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
     :param output_file: filepath to the output nifti
     :param dicom_input: directory with the dicom files for a single scan, or list of read in dicoms
     """
@@ -189,22 +276,20 @@ def multiframe_to_nifti(dicom_input, output_file):
         common.set_tr_te(nii_image, dicom_input[0].RepetitionTime, dicom_input[0].EchoTime)
 
     # Save to disk
-    if output_file is not None:
-        logger.info('Saving nifti to disk %s' % output_file)
-        nii_image.header.set_slope_inter(1, 0)
-        nii_image.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-        nii_image.to_filename(output_file)
+    nii_image, reorientation = reorient_and_save(nii_image, output_file, reorient_nifti)
 
     return {'NII_FILE': output_file,
             'NII': nii_image,
+            'REORIENTATION': reorientation,
             'MAX_SLICE_INCREMENT': max_slice_increment}
 
-def dicom_to_nifti(dicom_input, output_file):
+def dicom_to_nifti(dicom_input, output_file, reorient_nifti=False):
     """
     This function will convert an anatomical dicom series to a nifti
 
     Examples: See unit test
 
+    :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
     :param output_file: filepath to the output nifti
     :param dicom_input: directory with the dicom files for a single scan, or list of read in dicoms
     """
@@ -223,22 +308,26 @@ def dicom_to_nifti(dicom_input, output_file):
     # convert
     if common.is_multiframe_dicom(dicom_input):
         logger.info('Found sequence type: MULTIFRAME')
-        return multiframe_to_nifti(dicom_input, output_file)
+        return multiframe_to_nifti(dicom_input, output_file, reorient_nifti)
 
     # if no dicoms remain we should raise exception
     if len(dicom_input) < 1:
         raise ConversionValidationError('TOO_FEW_SLICES/LOCALIZER')
 
+    # read the geometry of the slices once for all validations
+    geometry = common.SliceGeometry(dicom_input)
+
     if settings.validate_slicecount:
         common.validate_slicecount(dicom_input)
         # remove_localizers based on image orientation (only valid if slicecount is validated)
-        dicom_input = remove_localizers_by_orientation(dicom_input)
+        geometry = remove_localizers_by_orientation(geometry)
+        dicom_input = geometry.dicoms
 
         # validate all the dicom files for correct orientations
         common.validate_slicecount(dicom_input)
     if settings.validate_orientation:
         # validate that all slices have the same orientation
-        common.validate_orientation(dicom_input)
+        common.validate_orientation(geometry)
     if settings.validate_orthogonal:
         # validate that we have an orthogonal image (to detect gantry tilting etc)
         common.validate_orthogonal(dicom_input)
@@ -249,24 +338,25 @@ def dicom_to_nifti(dicom_input, output_file):
     if is_4d(grouped_dicoms):
         del dicom_input
         logger.info('Found sequence type: 4D')
-        return four_d_to_nifti(grouped_dicoms, output_file)
+        return four_d_to_nifti(grouped_dicoms, output_file, reorient_nifti)
 
     del grouped_dicoms
 
     # sort the dicoms
-    dicom_input = common.sort_dicoms(dicom_input)
+    geometry = common.sort_dicoms(geometry)
+    dicom_input = geometry.dicoms
 
     # validate slice increment inconsistent
     slice_increment_inconsistent = False
     if settings.validate_slice_increment:
         # validate that all slices have a consistent slice increment
-        common.validate_slice_increment(dicom_input)
-    elif common.is_slice_increment_inconsistent(dicom_input):
+        common.validate_slice_increment(geometry)
+    elif common.is_slice_increment_inconsistent(geometry):
         slice_increment_inconsistent = True
 
     if settings.validate_instance_number:
         # validate that all slices have a consistent instance_number
-        common.validate_instance_number(dicom_input)
+        common.validate_instance_number(geometry)
 
     # if inconsistent increment and we allow resampling then do the resampling based conversion to maintain the correct geometric shape
     if slice_increment_inconsistent and settings.resample:
@@ -291,14 +381,11 @@ def dicom_to_nifti(dicom_input, output_file):
         common.set_tr_te(nii_image, dicom_input[0].RepetitionTime, dicom_input[0].EchoTime)
 
     # Save to disk
-    if output_file is not None:
-        logger.info('Saving nifti to disk %s' % output_file)
-        nii_image.header.set_slope_inter(1, 0)
-        nii_image.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-        nii_image.to_filename(output_file)
+    nii_image, reorientation = reorient_and_save(nii_image, output_file, reorient_nifti)
 
     return {'NII_FILE': output_file,
             'NII': nii_image,
+            'REORIENTATION': reorientation,
             'MAX_SLICE_INCREMENT': max_slice_increment}
 
 
@@ -353,14 +440,39 @@ def remove_duplicate_slices(dicoms):
             dicoms_dict[tuple(dicom_.ImagePositionPatient)] = dicom_
             filtered_dicoms.append(dicom_)
         else:
-            if numpy.array_equal(dicom_.pixel_array,
-                                 dicoms_dict[tuple(dicom_.ImagePositionPatient)].pixel_array):
+            if _is_same_pixel_data(dicom_, dicoms_dict[tuple(dicom_.ImagePositionPatient)]):
                 logger.warning('Removing duplicate slice from series')
             else:
                 filtered_dicoms.append(dicom_)
     return filtered_dicoms
 
 
+# attributes that define how the raw pixel data is interpreted
+_PIXEL_FORMAT_ATTRIBUTES = ['Rows', 'Columns', 'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation',
+                            'SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration', 'NumberOfFrames']
+
+
+def _is_same_pixel_data(dicom_1, dicom_2):
+    """
+    Check if 2 slices contain the same pixel data
+    If the transfer syntax and pixel format are the same the raw (still encoded) pixel data is compared,
+    otherwise both slices are decoded and compared (without keeping the decoded data on the slices)
+    """
+    if _get_transfer_syntax(dicom_1) == _get_transfer_syntax(dicom_2) and \
+            all(dicom_1.get(attribute) == dicom_2.get(attribute) for attribute in _PIXEL_FORMAT_ATTRIBUTES):
+        digest_1 = common.get_pixel_data_digest(dicom_1)
+        if digest_1 is not None:
+            return digest_1 == common.get_pixel_data_digest(dicom_2)
+    return numpy.array_equal(common.get_pixel_array(dicom_1), common.get_pixel_array(dicom_2))
+
+
+def _get_transfer_syntax(dicom_):
+    file_meta = getattr(dicom_, 'file_meta', None)
+    if file_meta is None:
+        return None
+    return file_meta.get('TransferSyntaxUID')
+
+
 def remove_localizers_by_imagetype(dicoms):
     """
     Search dicoms for localizers and delete them
@@ -383,43 +495,37 @@ def remove_localizers_by_orientation(dicoms):
     This is needed as in some cases with ct data there are some localizer/projection type images that cannot
     be distiguished by the dicom headers. This is why we kick out all orientations that do not have more than 4 files
     4 is the limit anyway for converting to nifti on our case
+
+    :param dicoms: list of dicoms or SliceGeometry (the same type is returned)
     """
-    orientations = []
-    sorted_dicoms = {}
+    geometry = common.get_slice_geometry(dicoms)
 
     # in case of multiframe this check cannot be done
-    if 'ImageOrientationPatient' not in dicoms[0]:
+    if numpy.all(numpy.isnan(geometry.orientations[0])):
         return dicoms
-
-    # Loop overall files and build dict
-    for dicom_header in dicoms:
-        # Create affine matrix (http://nipy.sourceforge.net/nibabel/dicom/dicom_orientation.html#dicom-slice-affine)
-        image_orient1 = numpy.array(dicom_header.ImageOrientationPatient)[0:3]
-        image_orient2 = numpy.array(dicom_header.ImageOrientationPatient)[3:6]
-        image_orient_combined = (image_orient1.tolist(), image_orient2.tolist())
-        found_orientation = False
-        for orientation in orientations:
-            if numpy.allclose(image_orient_combined[0], numpy.array(orientation[0]), rtol=0.001, atol=0.001) \
-                    and numpy.allclose(image_orient_combined[1], numpy.array(orientation[1]), rtol=0.001,
-                                       atol=0.001):
-                sorted_dicoms[str(orientation)].append(dicom_header)
-                found_orientation = True
-                break
-        if not found_orientation:
-            orientations.append(image_orient_combined)
-            sorted_dicoms[str(image_orient_combined)] = [dicom_header]
+    orientations = geometry.get_orientations()
+
+    # group the slices by orientation, each group is represented by the orientation of its first slice
+    orientation_groups = []
+    is_grouped = numpy.zeros(len(geometry), dtype=bool)
+    while not numpy.all(is_grouped):
+        first_index = int(numpy.flatnonzero(~is_grouped)[0])
+        in_group = ~is_grouped & common.is_same_orientation(orientations, orientations[first_index])
+        in_group[first_index] = True
+        orientation_groups.append(numpy.flatnonzero(in_group))
+        is_grouped |= in_group
 
     # if there are multiple possible orientations delete orientations where there are less than 4 files
     # we don't convert anything less that that anyway
-
-    if len(sorted_dicoms) > 1:
-        filtered_dicoms = []
-        for orientation in sorted_dicoms.keys():
-            if len(sorted_dicoms[orientation]) >= 4:
-                filtered_dicoms.extend(sorted_dicoms[orientation])
-        return filtered_dicoms
+    if len(orientation_groups) > 1:
+        indices = [group for group in orientation_groups if len(group) >= 4]
+        indices = numpy.concatenate(indices) if indices else numpy.array([], dtype=int)
     else:
-        return next(iter(sorted_dicoms.values()))
+        indices = orientation_groups[0]
+
+    if isinstance(dicoms, common.SliceGeometry):
+        return geometry.subset(indices)
+    return [geometry.dicoms[index] for index in indices]
 
 
 def _convert_slice_incement_inconsistencies(dicom_input):
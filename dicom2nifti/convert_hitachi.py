@@ -16,13 +16,14 @@ pydicom_config.enforce_valid_values = False
 logger = logging.getLogger(__name__)
 
 
-def dicom_to_nifti(dicom_input, output_file=None):
+def dicom_to_nifti(dicom_input, output_file=None, reorient_nifti=False):
     """
     This is the main dicom to nifti conversion fuction for hitachi images.
     As input hitachi images are required. It will then determine the type of images and do the correct conversion
 
     Examples: See unit test
 
+    :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
     :param output_file: file path to the output nifti
     :param dicom_input: directory with dicom files for 1 scan
     """
@@ -47,6 +48,6 @@ def dicom_to_nifti(dicom_input, output_file=None):
     # TODO add validations and conversion for DTI and fMRI once testdata is available
 
     logger.info('Assuming anatomical data')
-    return convert_generic.dicom_to_nifti(dicom_input, output_file)
+    return convert_generic.dicom_to_nifti(dicom_input, output_file, reorient_nifti)
 
 
@@ -5,7 +5,6 @@ dicom2nifti
 @author: abrys
 """
 import os
-import traceback
 
 import logging
 import nibabel
@@ -22,13 +21,14 @@ from dicom2nifti.exceptions import ConversionError, ConversionValidationError
 pydicom_config.enforce_valid_values = False
 logger = logging.getLogger(__name__)
 
-def dicom_to_nifti(dicom_input, output_file=None):
+def dicom_to_nifti(dicom_input, output_file=None, reorient_nifti=False):
     """
     This is the main dicom to nifti conversion fuction for philips images.
     As input philips images are required. It will then determine the type of images and do the correct conversion
 
     Examples: See unit test
 
+    :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
     :param output_file: file path to the output nifti
     :param dicom_input: directory with dicom files for 1 scan
     """
@@ -56,20 +56,20 @@ def dicom_to_nifti(dicom_input, output_file=None):
         logger.info('Found multiframe dicom')
         if _is_multiframe_4d(dicom_input):
             logger.info('Found sequence type: MULTIFRAME 4D')
-            return _multiframe_to_nifti(dicom_input, output_file)
+            return _multiframe_to_nifti(dicom_input, output_file, reorient_nifti)
 
         if _is_multiframe_anatomical(dicom_input):
             logger.info('Found sequence type: MULTIFRAME ANATOMICAL')
-            return convert_generic.multiframe_to_nifti(dicom_input, output_file)
+            return convert_generic.multiframe_to_nifti(dicom_input, output_file, reorient_nifti)
     else:
         logger.info('Found singleframe dicom')
         grouped_dicoms = _get_grouped_dicoms(dicom_input)
         if _is_singleframe_4d(dicom_input):
             logger.info('Found sequence type: SINGLEFRAME 4D')
-            return _singleframe_to_nifti(grouped_dicoms, output_file)
+            return _singleframe_to_nifti(grouped_dicoms, output_file, reorient_nifti)
 
     logger.info('Assuming anatomical data')
-    return convert_generic.dicom_to_nifti(dicom_input, output_file)
+    return convert_generic.dicom_to_nifti(dicom_input, output_file, reorient_nifti)
 
 
 def _assert_explicit_vr(dicom_input):
@@ -215,7 +215,7 @@ def _is_float(value):
         return False
 
 
-def _multiframe_to_nifti(dicom_input, output_file):
+def _multiframe_to_nifti(dicom_input, output_file, reorient_nifti=False):
     """
     This function will convert philips 4D or anatomical multiframe series to a nifti
     """
@@ -245,13 +245,6 @@ def _multiframe_to_nifti(dicom_input, output_file):
     except:
         logger.info('Unable to set timing info')
 
-    # Save to disk
-    if output_file is not None:
-        logger.info('Saving nifti to disk %s' % output_file)
-        nii_image.header.set_slope_inter(1, 0)
-        nii_image.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-        nii_image.to_filename(output_file)
-
     if _is_multiframe_diffusion_imaging(dicom_input):
         bval_file = None
         bvec_file = None
@@ -262,22 +255,30 @@ def _multiframe_to_nifti(dicom_input, output_file):
             logger.info('Creating bval en bvec files')
             bval_file = '%s/%s.bval' % (base_path, base_name)
             bvec_file = '%s/%s.bvec' % (base_path, base_name)
-        bval, bvec, bval_file, bvec_file = _create_bvals_bvecs(multiframe_dicom, bval_file, bvec_file, nii_image,
-                                                               output_file)
+        nii_image, bval, bvec, bval_file, bvec_file = _create_bvals_bvecs(multiframe_dicom, bval_file, bvec_file,
+                                                                          nii_image)
+
+        # Save to disk (after the diffusion images are fixed so the nifti is only written once)
+        nii_image, reorientation = convert_generic.reorient_and_save(nii_image, output_file, reorient_nifti)
 
         return {'NII_FILE': output_file,
                 'BVAL_FILE': bval_file,
                 'BVEC_FILE': bvec_file,
                 'NII': nii_image,
+                'REORIENTATION': reorientation,
                 'BVAL': bval,
                 'BVEC': bvec}
 
+    # Save to disk
+    nii_image, reorientation = convert_generic.reorient_and_save(nii_image, output_file, reorient_nifti)
+
     return {'NII_FILE': output_file,
             'NII': nii_image,
+            'REORIENTATION': reorientation,
             'MAX_SLICE_INCREMENT': max_slice_increment}
 
 
-def _singleframe_to_nifti(grouped_dicoms, output_file):
+def _singleframe_to_nifti(grouped_dicoms, output_file, reorient_nifti=False):
     """
     This function will convert a philips singleframe series to a nifti
     """
@@ -297,13 +298,6 @@ def _singleframe_to_nifti(grouped_dicoms, output_file):
     nii_image = nibabel.Nifti1Image(full_block, affine)
     common.set_tr_te(nii_image, grouped_dicoms[0][0].RepetitionTime, grouped_dicoms[0][0].EchoTime)
 
-    if output_file is not None:
-        # Save to disk
-        logger.info('Saving nifti to disk %s' % output_file)
-        nii_image.header.set_slope_inter(1, 0)
-        nii_image.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-        nii_image.to_filename(output_file)
-
     if _is_singleframe_diffusion_imaging(grouped_dicoms):
         bval_file = None
         bvec_file = None
@@ -319,19 +313,26 @@ def _singleframe_to_nifti(grouped_dicoms, output_file):
         nii_image, bval, bvec, bval_file, bvec_file = _create_singleframe_bvals_bvecs(grouped_dicoms,
                                                                                       bval_file,
                                                                                       bvec_file,
-                                                                                      nii_image,
-                                                                                      output_file)
+                                                                                      nii_image)
+
+        # Save to disk (after the diffusion images are fixed so the nifti is only written once)
+        nii_image, reorientation = convert_generic.reorient_and_save(nii_image, output_file, reorient_nifti)
 
         return {'NII_FILE': output_file,
                 'BVAL_FILE': bval_file,
                 'BVEC_FILE': bvec_file,
                 'NII': nii_image,
+                'REORIENTATION': reorientation,
                 'BVAL': bval,
                 'BVEC': bvec,
                 'MAX_SLICE_INCREMENT': slice_increment}
 
+    # Save to disk
+    nii_image, reorientation = convert_generic.reorient_and_save(nii_image, output_file, reorient_nifti)
+
     return {'NII_FILE': output_file,
             'NII': nii_image,
+            'REORIENTATION': reorientation,
             'MAX_SLICE_INCREMENT': slice_increment}
 
 
@@ -339,19 +340,8 @@ def _singleframe_to_block(grouped_dicoms):
     """
     Generate a full datablock containing all timepoints
     """
-    # For each slice / mosaic create a data volume block
-    data_blocks = []
-    for index in range(0, len(grouped_dicoms)):
-        logger.info('Creating block %s of %s' % (index + 1, len(grouped_dicoms)))
-        current_block = _stack_to_block(grouped_dicoms[index])
-        current_block = current_block[:, :, :, numpy.newaxis]
-        data_blocks.append(current_block)
-
-    try:
-        full_block = numpy.concatenate(data_blocks, axis=3)
-    except:
-        traceback.print_exc()
-        raise ConversionError("MISSING_DICOM_FILES")
+    # the 4d block is allocated once and every timepoint is written in its place
+    full_block = common.get_4d_pixeldata(grouped_dicoms)
 
     # Apply the rescaling if needed
     common.apply_scaling(full_block, grouped_dicoms[0][0])
@@ -359,13 +349,6 @@ def _singleframe_to_block(grouped_dicoms):
     return full_block
 
 
-def _stack_to_block(timepoint_dicoms):
-    """
-    Convert a mosaic slice to a block of data by reading the headers, splitting the mosaic and appending
-    """
-    return common.get_volume_pixeldata(timepoint_dicoms)
-
-
 def _get_grouped_dicoms(dicom_input):
     """
     Search all dicoms in the dicom directory, sort and validate them
@@ -378,32 +361,62 @@ def _get_grouped_dicoms(dicom_input):
     else:
         dicoms = common.sort_dicoms(dicom_input)
     # now group per stack
-    grouped_dicoms = [[]]  # list with first element a list
-    timepoint_index = 0
-    previous_stack_position = -1
-
-    # loop over all sorted dicoms
     stack_position_tag = Tag(0x2001, 0x100a)  # put this there as this is a slow step and used a lot
-    for index in range(0, len(dicoms)):
-        dicom_ = dicoms[index]
-        stack_position = 0
-        if stack_position_tag in dicom_:
-            stack_position = common.get_is_value(dicom_[stack_position_tag])
-        if previous_stack_position == stack_position:
-            # if the stack number is the same we move to the next timepoint
-            timepoint_index += 1
-            if len(grouped_dicoms) <= timepoint_index:
-                grouped_dicoms.append([])
-        else:
-            # if it changes move back to the first timepoint
-            timepoint_index = 0
-        grouped_dicoms[timepoint_index].append(dicom_)
-        previous_stack_position = stack_position
-
-    return grouped_dicoms
-
-
-def _create_bvals_bvecs(multiframe_dicom, bval_file, bvec_file, nifti, nifti_file):
+    stack_positions = numpy.array([common.get_is_value(dicom_[stack_position_tag])
+                                   if stack_position_tag in dicom_ else 0
+                                   for dicom_ in dicoms], dtype=numpy.int64)
+    return [[dicoms[index] for index in group] for group in common.get_stack_groups(None, stack_positions)]
+
+
+def _get_multiframe_bval(diffusion_item):
+    """
+    Read the bval from the mr diffusion sequence item of a frame, 0 if it is not directional
+    """
+    if str(diffusion_item[Tag(0x0018, 0x9075)].value) != 'DIRECTIONAL':
+        return 0
+    return common.get_fd_value(diffusion_item[Tag(0x0018, 0x9087)])
+
+
+def _get_multiframe_bvec(diffusion_item):
+    """
+    Read the bvec from the mr diffusion sequence item of a frame, 0 if it is not directional
+    """
+    if str(diffusion_item[Tag(0x0018, 0x9075)].value) != 'DIRECTIONAL':
+        return [0, 0, 0]
+    return common.get_fd_array_value(diffusion_item[Tag(0x0018, 0x9076)][0][Tag(0x0018, 0x9089)], 3)
+
+
+def _get_bval_type_a(dicom_):
+    """
+    Read the bval of a single frame dicom stored in the first way
+    """
+    return common.get_fl_value(dicom_[Tag(0x2001, 0x1003)])
+
+
+def _get_bvec_type_a(dicom_):
+    """
+    Read the bvec of a single frame dicom stored in the first way
+    """
+    return [common.get_fl_value(dicom_[Tag(0x2005, 0x10b0)]),
+            common.get_fl_value(dicom_[Tag(0x2005, 0x10b1)]),
+            common.get_fl_value(dicom_[Tag(0x2005, 0x10b2)])]
+
+
+def _get_bval_type_b(dicom_):
+    """
+    Read the bval of a single frame dicom stored in the second way
+    """
+    return common.get_fd_value(dicom_[Tag(0x0018, 0x9087)])
+
+
+def _get_bvec_type_b(dicom_):
+    """
+    Read the bvec of a single frame dicom stored in the second way
+    """
+    return common.get_fd_array_value(dicom_[Tag(0x0018, 0x9089)], 3)
+
+
+def _create_bvals_bvecs(multiframe_dicom, bval_file, bvec_file, nifti):
     """
     Write the bvals from the sorted dicom files to a bval file
     Inspired by https://github.com/IBIC/ibicUtils/blob/master/ibicBvalsBvecs.py
@@ -412,19 +425,14 @@ def _create_bvals_bvecs(multiframe_dicom, bval_file, bvec_file, nifti, nifti_fil
     # create the empty arrays
     number_of_stacks, number_of_stack_slices = common.multiframe_get_stack_count([multiframe_dicom])
 
-    bvals = numpy.zeros([number_of_stacks], dtype=numpy.int32)
-    bvecs = numpy.zeros([number_of_stacks, 3])
-
-    # loop over all timepoints and create a list with all bvals and bvecs
-    for stack_index in range(0, number_of_stacks):
-        stack = multiframe_dicom[Tag(0x5200, 0x9230)][stack_index]
-        if str(stack[Tag(0x0018, 0x9117)][0][Tag(0x0018, 0x9075)].value) == 'DIRECTIONAL':
-            bvals[stack_index] = common.get_fd_value(stack[Tag(0x0018, 0x9117)][0][Tag(0x0018, 0x9087)])
-            bvecs[stack_index, :] = common.get_fd_array_value(stack[Tag(0x0018, 0x9117)][0]
-                                                              [Tag(0x0018, 0x9076)][0][Tag(0x0018, 0x9089)], 3)
+    # create arrays with all bvals and bvecs of the timepoints (the first frames)
+    frames = multiframe_dicom[Tag(0x5200, 0x9230)]
+    diffusion_items = [frames[stack_index][Tag(0x0018, 0x9117)][0] for stack_index in range(0, number_of_stacks)]
+    bvals, bvecs = common.get_gradient_table(diffusion_items, _get_multiframe_bval, _get_multiframe_bvec)
+    bvals = bvals.astype(numpy.int32)
 
     # truncate nifti if needed
-    nifti, bvals, bvecs = _fix_diffusion_images(bvals, bvecs, nifti, nifti_file)
+    nifti, bvals, bvecs = _fix_diffusion_images(bvals, bvecs, nifti)
 
     # save the found bvecs to the file
     if numpy.count_nonzero(bvals) > 0 or numpy.count_nonzero(bvecs) > 0:
@@ -436,10 +444,10 @@ def _create_bvals_bvecs(multiframe_dicom, bval_file, bvec_file, nifti, nifti_fil
         bvals = None
         bvecs = None
 
-    return bvals, bvecs, bval_file, bvec_file
+    return nifti, bvals, bvecs, bval_file, bvec_file
 
 
-def _fix_diffusion_images(bvals, bvecs, nifti, nifti_file):
+def _fix_diffusion_images(bvals, bvecs, nifti):
     """
     This function will remove the last timepoint from the nifti, bvals and bvecs if the last vector is 0,0,0
     This is sometimes added at the end by philips
@@ -456,40 +464,28 @@ def _fix_diffusion_images(bvals, bvecs, nifti, nifti_file):
     new_nifti = nibabel.Nifti1Image(common.get_nifti_data(nifti)[:, :, :, :-1].squeeze(), nifti.affine)
     new_nifti.header.set_slope_inter(1, 0)
     new_nifti.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-    new_nifti.to_filename(nifti_file)
 
     return new_nifti, bvals, bvecs
 
 
-def _create_singleframe_bvals_bvecs(grouped_dicoms, bval_file, bvec_file, nifti, nifti_file):
+def _create_singleframe_bvals_bvecs(grouped_dicoms, bval_file, bvec_file, nifti):
     """
     Write the bvals from the sorted dicom files to a bval file
     """
 
-    # create the empty arrays
+    # create arrays with all bvals and bvecs of the timepoints
     bvals = numpy.zeros([len(grouped_dicoms)], dtype=numpy.int32)
     bvecs = numpy.zeros([len(grouped_dicoms), 3])
-
-    # loop over all timepoints and create a list with all bvals and bvecs
     if _is_bval_type_a(grouped_dicoms):
-        bval_tag = Tag(0x2001, 0x1003)
-        bvec_x_tag = Tag(0x2005, 0x10b0)
-        bvec_y_tag = Tag(0x2005, 0x10b1)
-        bvec_z_tag = Tag(0x2005, 0x10b2)
-        for stack_index in range(0, len(grouped_dicoms)):
-            bvals[stack_index] = common.get_fl_value(grouped_dicoms[stack_index][0][bval_tag])
-            bvecs[stack_index, :] = [common.get_fl_value(grouped_dicoms[stack_index][0][bvec_x_tag]),
-                                     common.get_fl_value(grouped_dicoms[stack_index][0][bvec_y_tag]),
-                                     common.get_fl_value(grouped_dicoms[stack_index][0][bvec_z_tag])]
+        bvals, bvecs = common.get_gradient_table([group[0] for group in grouped_dicoms],
+                                                 _get_bval_type_a, _get_bvec_type_a)
     elif _is_bval_type_b(grouped_dicoms):
-        bval_tag = Tag(0x0018, 0x9087)
-        bvec_tag = Tag(0x0018, 0x9089)
-        for stack_index in range(0, len(grouped_dicoms)):
-            bvals[stack_index] = common.get_fd_value(grouped_dicoms[stack_index][0][bval_tag])
-            bvecs[stack_index, :] = common.get_fd_array_value(grouped_dicoms[stack_index][0][bvec_tag], 3)
+        bvals, bvecs = common.get_gradient_table([group[0] for group in grouped_dicoms],
+                                                 _get_bval_type_b, _get_bvec_type_b)
+    bvals = bvals.astype(numpy.int32)
 
     # truncate nifti if needed
-    nifti, bvals, bvecs = _fix_diffusion_images(bvals, bvecs, nifti, nifti_file)
+    nifti, bvals, bvecs = _fix_diffusion_images(bvals, bvecs, nifti)
 
     # save the found bvecs to the file
     if numpy.count_nonzero(bvals) > 0 or numpy.count_nonzero(bvecs) > 0:
@@ -4,8 +4,10 @@ dicom2nifti
 
 @author: abrys
 """
+import functools
 import os
 import re
+import struct
 import traceback
 
 import logging
@@ -22,6 +24,9 @@ from dicom2nifti.exceptions import ConversionValidationError, ConversionError
 
 logger = logging.getLogger(__name__)
 
+# sanity limit on the number of tags and items in a csa header
+_MAX_CSA_ITEMS = 1000
+
 
 # Disable this warning as there is not reason for an init class in an enum
 # pylint: disable=w0232, r0903, E1101
@@ -38,11 +43,12 @@ class MosaicType(object):
 # pylint: enable=w0232, r0903
 
 
-def dicom_to_nifti(dicom_input, output_file=None):
+def dicom_to_nifti(dicom_input, output_file=None, reorient_nifti=False):
     """
     This is the main dicom to nifti conversion function for ge images.
     As input ge images are required. It will then determine the type of images and do the correct conversion
 
+    :param reorient_nifti: if True the nifti affine and data will be updated so the data is stored LAS oriented
     :param output_file: filepath to the output nifti
     :param dicom_input: directory with dicom files for 1 scan
     """
@@ -67,19 +73,19 @@ def dicom_to_nifti(dicom_input, output_file=None):
 
     if _is_4d(dicom_input):
         logger.info('Found sequence type: MOSAIC 4D')
-        return _mosaic_4d_to_nifti(dicom_input, output_file)
+        return _mosaic_4d_to_nifti(dicom_input, output_file, reorient_nifti)
 
     if common.is_multiframe_dicom(dicom_input):
         logger.info('Found sequence type: MULTIFRAME')
-        return convert_generic.multiframe_to_nifti(dicom_input, output_file)
+        return convert_generic.multiframe_to_nifti(dicom_input, output_file, reorient_nifti)
 
     grouped_dicoms = _classic_get_grouped_dicoms(dicom_input)
     if _is_classic_4d(grouped_dicoms):
         logger.info('Found sequence type: CLASSIC 4D')
-        return _classic_4d_to_nifti(grouped_dicoms, output_file)
+        return _classic_4d_to_nifti(grouped_dicoms, output_file, reorient_nifti)
 
     logger.info('Assuming anatomical data')
-    return convert_generic.dicom_to_nifti(dicom_input, output_file)
+    return convert_generic.dicom_to_nifti(dicom_input, output_file, reorient_nifti)
 
 
 def _is_mosaic(dicom_input):
@@ -146,7 +152,7 @@ def _is_diffusion_imaging(header_input):
     return True
 
 
-def _mosaic_4d_to_nifti(dicom_input, output_file):
+def _mosaic_4d_to_nifti(dicom_input, output_file, reorient_nifti=False):
     """
     This function will convert siemens 4d series to a nifti
     Some inspiration on which fields can be used was taken from
@@ -157,25 +163,39 @@ def _mosaic_4d_to_nifti(dicom_input, output_file):
     sorted_mosaics = _get_sorted_mosaics(dicom_input)
     common.validate_orientation(sorted_mosaics)
 
-    # Create mosaic block
-    logger.info('Creating data block')
-    full_block = _mosaic_get_full_block(sorted_mosaics)
-
     logger.info('Creating affine')
     # Create the nifti header info
     affine = _create_affine_siemens_mosaic(dicom_input)
-    logger.info('Creating nifti')
-    # Convert to nifti
-    if full_block.ndim > 3:
-        full_block = full_block.squeeze()
-    nii_image = nibabel.Nifti1Image(full_block, affine)
-    common.set_tr_te(nii_image, sorted_mosaics[0].RepetitionTime, sorted_mosaics[0].EchoTime)
-    logger.info('Saving nifti to disk')
-    # Save to disk
+
     if output_file is not None:
-        nii_image.header.set_slope_inter(1, 0)
-        nii_image.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-        nii_image.to_filename(output_file)
+        # write the mosaics to disk while they are unpacked so only one timepoint is in memory
+        # all mosaics of a series have the same type and dimensions so the headers are parsed once
+        logger.info('Saving nifti to disk')
+        mosaic_type = _get_mosaic_type(sorted_mosaics[0])
+        block_dimensions = _get_mosaic_block_dimensions(sorted_mosaics[0])
+        nii_image, reorientation = convert_generic.write_timepoints((_mosaic_to_block(mosaic,
+                                                                                      mosaic_type,
+                                                                                      block_dimensions)
+                                                                     for mosaic in sorted_mosaics),
+                                                                    len(sorted_mosaics),
+                                                                    affine,
+                                                                    output_file,
+                                                                    sorted_mosaics[0].RepetitionTime,
+                                                                    sorted_mosaics[0].EchoTime,
+                                                                    squeeze=True,
+                                                                    reorient_nifti=reorient_nifti)
+    else:
+        # Create mosaic block
+        logger.info('Creating data block')
+        full_block = _mosaic_get_full_block(sorted_mosaics)
+
+        logger.info('Creating nifti')
+        # Convert to nifti
+        if full_block.ndim > 3:
+            full_block = full_block.squeeze()
+        nii_image = nibabel.Nifti1Image(full_block, affine)
+        common.set_tr_te(nii_image, sorted_mosaics[0].RepetitionTime, sorted_mosaics[0].EchoTime)
+        nii_image, reorientation = convert_generic.reorient_and_save(nii_image, None, reorient_nifti)
 
     if _is_diffusion_imaging(dicom_input[0]):
         # Create the bval en bvec files
@@ -195,14 +215,16 @@ def _mosaic_4d_to_nifti(dicom_input, output_file):
                 'BVAL_FILE': bval_file,
                 'BVEC_FILE': bvec_file,
                 'NII': nii_image,
+                'REORIENTATION': reorientation,
                 'BVAL': bvals,
                 'BVEC': bvecs}
 
     return {'NII_FILE': output_file,
-            'NII': nii_image}
+            'NII': nii_image,
+            'REORIENTATION': reorientation}
 
 
-def _classic_4d_to_nifti(grouped_dicoms, output_file):
+def _classic_4d_to_nifti(grouped_dicoms, output_file, reorient_nifti=False):
     """
     This function will convert siemens 4d series to a nifti
     Some inspiration on which fields can be used was taken from
@@ -212,26 +234,34 @@ def _classic_4d_to_nifti(grouped_dicoms, output_file):
     all_dicoms = [i for sl in grouped_dicoms for i in sl]  # combine into 1 list for validating
     common.validate_orientation(all_dicoms)
 
-    # Create mosaic block
-    logger.info('Creating data block')
-    full_block = _classic_get_full_block(grouped_dicoms)
-
     logger.info('Creating affine')
     # Create the nifti header info
     affine, slice_increment = common.create_affine(grouped_dicoms[0])
 
-    logger.info('Creating nifti')
-    # Convert to nifti
-    if full_block.ndim > 3:  # do not squeeze single slice data
-        full_block = full_block.squeeze()
-    nii_image = nibabel.Nifti1Image(full_block, affine)
-    common.set_tr_te(nii_image, grouped_dicoms[0][0].RepetitionTime, grouped_dicoms[0][0].EchoTime)
-    logger.info('Saving nifti to disk')
-    # Save to disk
     if output_file is not None:
-        nii_image.header.set_slope_inter(1, 0)
-        nii_image.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-        nii_image.to_filename(output_file)
+        # write the timepoints to disk while they are created so only one timepoint is in memory
+        logger.info('Saving nifti to disk')
+        nii_image, reorientation = convert_generic.write_timepoints((_classic_timepoint_to_block(timepoint_dicoms)
+                                                                     for timepoint_dicoms in grouped_dicoms),
+                                                                    len(grouped_dicoms),
+                                                                    affine,
+                                                                    output_file,
+                                                                    grouped_dicoms[0][0].RepetitionTime,
+                                                                    grouped_dicoms[0][0].EchoTime,
+                                                                    squeeze=True,
+                                                                    reorient_nifti=reorient_nifti)
+    else:
+        # Create mosaic block
+        logger.info('Creating data block')
+        full_block = _classic_get_full_block(grouped_dicoms)
+
+        logger.info('Creating nifti')
+        # Convert to nifti
+        if full_block.ndim > 3:  # do not squeeze single slice data
+            full_block = full_block.squeeze()
+        nii_image = nibabel.Nifti1Image(full_block, affine)
+        common.set_tr_te(nii_image, grouped_dicoms[0][0].RepetitionTime, grouped_dicoms[0][0].EchoTime)
+        nii_image, reorientation = convert_generic.reorient_and_save(nii_image, None, reorient_nifti)
 
     if _is_diffusion_imaging(grouped_dicoms[0][0]):
         logger.info('Creating bval en bvec')
@@ -251,12 +281,14 @@ def _classic_4d_to_nifti(grouped_dicoms, output_file):
                 'BVAL_FILE': bval_file,
                 'BVEC_FILE': bvec_file,
                 'NII': nii_image,
+                'REORIENTATION': reorientation,
                 'BVAL': bval,
                 'BVEC': bvec,
                 'MAX_SLICE_INCREMENT': slice_increment}
 
     return {'NII_FILE': output_file,
             'NII': nii_image,
+            'REORIENTATION': reorientation,
             'MAX_SLICE_INCREMENT': slice_increment}
 
 def _classic_get_grouped_dicoms(dicom_input):
@@ -265,39 +297,8 @@ def _classic_get_grouped_dicoms(dicom_input):
 
     fast_read = True will only read the headers not the data
     """
-
-    # Order all dicom files by InstanceNumber
-    dicoms = sorted(dicom_input, key=lambda x: x.InstanceNumber)
-
-    # now group per stack
-    grouped_dicoms = [[]]  # list with first element a list
-    stack_index = 0
-
-    # loop over all sorted dicoms and sort them by stack
-    # for this we use the position and direction of the slices so we can detect a new stack easily
-    previous_position = None
-    previous_direction = None
-    for dicom_ in dicoms:
-        current_direction = None
-        # if the stack number decreases we moved to the next stack
-        if previous_position is not None:
-            current_direction = numpy.array(dicom_.ImagePositionPatient) - previous_position
-            current_direction = current_direction / numpy.linalg.norm(current_direction)
-        if current_direction is not None and \
-                previous_direction is not None and \
-                not numpy.allclose(current_direction, previous_direction, rtol=0.05, atol=0.05):
-            previous_position = numpy.array(dicom_.ImagePositionPatient)
-            previous_direction = None
-            stack_index += 1
-        else:
-            previous_position = numpy.array(dicom_.ImagePositionPatient)
-            previous_direction = current_direction
-
-        if stack_index >= len(grouped_dicoms):
-            grouped_dicoms.append([])
-        grouped_dicoms[stack_index].append(dicom_)
-
-    return grouped_dicoms
+    # the stacks are detected in the same way as for the generic 4d series
+    return convert_generic.get_grouped_dicoms(dicom_input)
 
 # old function that was replaced by the new one for icometrix/dicom2nifti#70 will keep it for now
 # def _classic_get_grouped_dicoms(dicom_input):
@@ -335,22 +336,8 @@ def _classic_get_full_block(grouped_dicoms):
     """
     Generate a full datablock containing all timepoints
     """
-    # For each slice / mosaic create a data volume block
-    data_blocks = []
-    for index in range(0, len(grouped_dicoms)):
-        logger.info('Creating block %s of %s' % (index + 1, len(grouped_dicoms)))
-        data_blocks.append(_classic_timepoint_to_block(grouped_dicoms[index]))
-
-    # Add the data_blocks together to one 4d block
-    size_x = numpy.shape(data_blocks[0])[0]
-    size_y = numpy.shape(data_blocks[0])[1]
-    size_z = numpy.shape(data_blocks[0])[2]
-    size_t = len(data_blocks)
-    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=data_blocks[0].dtype)
-    for index in range(0, size_t):
-        full_block[:, :, :, index] = data_blocks[index]
-
-    return full_block
+    # the 4d block is allocated once and every timepoint is written in its place
+    return common.get_4d_pixeldata(grouped_dicoms)
 
 
 def _classic_timepoint_to_block(timepoint_dicoms):
@@ -365,19 +352,7 @@ def _mosaic_get_full_block(sorted_mosaics):
     """
     Generate a full datablock containing all timepoints
     """
-    # For each slice / mosaic create a data volume block
-    data_blocks = []
-    for index in range(0, len(sorted_mosaics)):
-        data_blocks.append(_mosaic_to_block(sorted_mosaics[index]))
-
-    # Add the data_blocks together to one 4d block
-    size_x = numpy.shape(data_blocks[0])[0]
-    size_y = numpy.shape(data_blocks[0])[1]
-    size_z = numpy.shape(data_blocks[0])[2]
-    size_t = len(data_blocks)
-    full_block = numpy.zeros((size_x, size_y, size_z, size_t), dtype=data_blocks[0].dtype)
-    for index in range(0, size_t):
-        full_block[:, :, :, index] = data_blocks[index]
+    full_block = _mosaics_to_block(sorted_mosaics)
 
     # Apply the rescaling if needed
     common.apply_scaling(full_block, sorted_mosaics[0])
@@ -400,15 +375,103 @@ def _get_sorted_mosaics(dicom_input):
     return sorted_mosaics
 
 
+def _read_csa_header(csa_bytes):
+    """
+    Parse a binary siemens CSA header (CSA1 or CSA2) in one pass
+    Based on the format description in nibabel (nibabel.nicom.csareader)
+
+    :param csa_bytes: value of the csa header element
+    :return: dict with the tag names as keys and the lists of (string) items as values
+    """
+    if csa_bytes[:4] == b'SV10':  # CSA2
+        csa_type = 2
+        offset = 8
+    else:  # CSA1
+        csa_type = 1
+        offset = 0
+    number_of_tags, _ = struct.unpack_from('<2I', csa_bytes, offset)
+    offset += 8
+    if not 0 < number_of_tags <= _MAX_CSA_ITEMS:
+        raise ValueError('Invalid number of CSA tags %s' % number_of_tags)
+
+    csa_tags = {}
+    first_tag_items = 0
+    for tag_number in range(number_of_tags):
+        name, value_multiplicity, _, _, number_of_items, _ = struct.unpack_from('<64si4s3i', csa_bytes, offset)
+        offset += 84
+        if tag_number == 1:
+            first_tag_items = number_of_items
+        if number_of_items > _MAX_CSA_ITEMS:
+            raise ValueError('Invalid number of CSA items %s' % number_of_items)
+        number_of_values = value_multiplicity if value_multiplicity > 0 else number_of_items
+        items = []
+        for item_number in range(number_of_items):
+            item_length_1, item_length_2, _, _ = struct.unpack_from('<4i', csa_bytes, offset)
+            offset += 16
+            if csa_type == 1:
+                # CSA1 has an odd length calculation
+                item_length = item_length_1 - first_tag_items
+                if item_length < 0 or offset + item_length > len(csa_bytes):
+                    break
+            else:
+                item_length = item_length_2
+                if offset + item_length > len(csa_bytes):
+                    raise ValueError('CSA item is too long')
+            if item_number < number_of_values:
+                items.append(csa_bytes[offset:offset + item_length].split(b'\0', 1)[0].decode('ISO-8859-1'))
+            # items are aligned on 4 bytes
+            offset += item_length + (-item_length % 4)
+        csa_tags[name.split(b'\0', 1)[0].decode('ISO-8859-1')] = items
+    return csa_tags
+
+
+@functools.lru_cache(maxsize=16)
+def _read_ascconv_headers(csa_bytes):
+    """
+    Get the ascconv part of the protocol in the csa series header
+    This is cached on the raw header so all mosaics of a series only read it once
+    """
+    try:
+        protocol = _read_csa_header(csa_bytes)['MrPhoenixProtocol'][0]
+    except (KeyError, IndexError, ValueError, struct.error):
+        # fall back to searching the whole header as text
+        protocol = csa_bytes.decode(encoding='ISO-8859-1')
+    return re.findall(r'### ASCCONV BEGIN(.*)### ASCCONV END ###', protocol, re.DOTALL)[0]
+
+
+@functools.lru_cache(maxsize=16)
+def _read_ascconv_protocol(csa_bytes):
+    """
+    Convert the lines of the ascconv headers ("key = value") to a dict with the (string) values
+    This is cached on the raw header so all mosaics of a series only parse it once
+    """
+    return dict(re.findall(r'^\s*([^\s=#]+)\s*=[ \t]*([^\r\n]*?)\s*$',
+                           _read_ascconv_headers(csa_bytes),
+                           re.MULTILINE))
+
+
 def _get_asconv_headers(mosaic):
     """
     Getter for the asconv headers (asci header info stored in the dicom)
     """
-    asconv_headers = re.findall(r'### ASCCONV BEGIN(.*)### ASCCONV END ###',
-                                mosaic[Tag(0x0029, 0x1020)].value.decode(encoding='ISO-8859-1'),
-                                re.DOTALL)[0]
+    return _read_ascconv_headers(bytes(mosaic[Tag(0x0029, 0x1020)].value))
 
-    return asconv_headers
+
+def _get_ascconv_protocol(mosaic):
+    """
+    Getter for the asconv headers of a mosaic as a dict
+    """
+    return _read_ascconv_protocol(bytes(mosaic[Tag(0x0029, 0x1020)].value))
+
+
+def _get_ascconv_value(ascconv_headers, key, pattern):
+    """
+    Get the part of an ascconv value that matches the pattern or None if it is missing
+    """
+    match = re.match(pattern, ascconv_headers.get(key, ''))
+    if match is None:
+        return None
+    return match.group(0)
 
 
 def _get_mosaic_type(mosaic):
@@ -419,29 +482,23 @@ def _get_mosaic_type(mosaic):
     https://www.icts.uiowa.edu/confluence/plugins/viewsource/viewpagesrc.action?pageId=54756326
     """
 
-    ascconv_headers = _get_asconv_headers(mosaic)
+    ascconv_headers = _get_ascconv_protocol(mosaic)
 
     try:
-        size = int(re.findall(r'sSliceArray\.lSize\s*=\s*(\d+)', ascconv_headers)[0])
-
-        # get the locations of the slices
-        slice_location = [None] * size
-        for index in range(size):
-            axial_result = re.findall(
-                r'sSliceArray\.asSlice\[%s\]\.sPosition\.dTra\s*=\s*([-+]?[0-9]*\.?[0-9]*)' % index,
-                ascconv_headers)
-            if len(axial_result) > 0:
-                axial = float(axial_result[0])
-            else:
-                axial = 0.0
-            slice_location[index] = axial
+        size = int(_get_ascconv_value(ascconv_headers, 'sSliceArray.lSize', r'\d+'))
+
+        # get the locations of the first 2 slices
+        slice_location = []
+        for index in range(min(size, 2)):
+            axial = _get_ascconv_value(ascconv_headers, 'sSliceArray.asSlice[%s].sPosition.dTra' % index,
+                                       r'[-+]?[0-9]*\.?[0-9]*')
+            slice_location.append(float(axial) if axial else 0.0)
 
         # should we invert (https://www.icts.uiowa.edu/confluence/plugins/viewsource/viewpagesrc.action?pageId=54756326)
         invert = False
-        invert_result = re.findall(r'sSliceArray\.ucImageNumbTra\s*=\s*([-+]?0?x?[0-9]+)', ascconv_headers)
-        if len(invert_result) > 0:
-            invert_value = int(invert_result[0], 16)
-            if invert_value >= 0:
+        invert_value = _get_ascconv_value(ascconv_headers, 'sSliceArray.ucImageNumbTra', r'[-+]?0?x?[0-9]+')
+        if invert_value is not None:
+            if int(invert_value, 16) >= 0:
                 invert = True
 
         # return the correct slice types
@@ -466,9 +523,9 @@ def _get_mosaic_block_dimensions(mosaic):
     :param mosaic:
     :return: (rows, columns, nr of slices)
     """
-    ascconv_headers = _get_asconv_headers(mosaic)
+    ascconv_headers = _get_ascconv_protocol(mosaic)
 
-    size_z = int(re.findall(r'sSliceArray\.lSize\s*=\s*(\d+)', ascconv_headers)[0])
+    size_z = int(_get_ascconv_value(ascconv_headers, 'sSliceArray.lSize', r'\d+'))
 
     # get the number of rows and columns
     number_x = number_y = ceil(sqrt(size_z))
@@ -476,37 +533,68 @@ def _get_mosaic_block_dimensions(mosaic):
     size_y = int(mosaic.Rows / number_y)
     return number_x, number_y, size_x, size_y, size_z
 
-def _mosaic_to_block(mosaic):
+def _mosaic_to_block(mosaic, mosaic_type=None, block_dimensions=None):
     """
     Convert a mosaic slice to a block of data by reading the headers, splitting the mosaic and appending
+
+    :param mosaic: mosaic dicom
+    :param mosaic_type: MosaicType of the mosaic (read from the headers if None)
+    :param block_dimensions: dimensions as returned by _get_mosaic_block_dimensions (read from the headers if None)
     """
-    # get the mosaic type
-    mosaic_type = _get_mosaic_type(mosaic)
-    number_x, number_y, size_x, size_y, size_z = _get_mosaic_block_dimensions(mosaic)
-
-    # recreate 2d slice
-    data_2d = mosaic.pixel_array
-    # create 3d block
-    data_3d = numpy.zeros((size_z, size_y, size_x), dtype=data_2d.dtype)
-    # fill 3d block by taking the correct portions of the slice
-    z_index = 0
-    for y_index in range(0, number_y):
-        if z_index >= size_z:
-            break
-        for x_index in range(0, number_x):
-            if mosaic_type == MosaicType.ASCENDING:
-                data_3d[z_index, :, :] = data_2d[size_y * y_index:size_y * (y_index + 1),
-                                         size_x * x_index:size_x * (x_index + 1)]
-            else:
-                data_3d[size_z - (z_index + 1), :, :] = data_2d[size_y * y_index:size_y * (y_index + 1),
-                                                         size_x * x_index:size_x * (x_index + 1)]
-            z_index += 1
-            if z_index >= size_z:
-                break
-    # reorient the block of data
-    data_3d = numpy.transpose(data_3d, (2, 1, 0))
+    if mosaic_type is None:
+        mosaic_type = _get_mosaic_type(mosaic)
+    if block_dimensions is None:
+        block_dimensions = _get_mosaic_block_dimensions(mosaic)
+    return _unpack_mosaics(common.get_pixel_array(mosaic), mosaic_type, block_dimensions)
 
-    return data_3d
+
+def _mosaics_to_block(sorted_mosaics):
+    """
+    Convert a list of mosaics to a 4d block of data
+    The block is allocated once and every mosaic is unpacked directly into its timepoint
+    All mosaics of a series have the same type and dimensions so the headers of the first mosaic are parsed once
+    """
+    mosaic_type = _get_mosaic_type(sorted_mosaics[0])
+    block_dimensions = _get_mosaic_block_dimensions(sorted_mosaics[0])
+    _, _, size_x, size_y, size_z = block_dimensions
+
+    full_block = None
+    for index, mosaic in enumerate(sorted_mosaics):
+        mosaic_data = common.get_pixel_array(mosaic)
+        if full_block is None:
+            full_block = common.create_4d_block((size_x, size_y, size_z), len(sorted_mosaics), mosaic_data.dtype)
+        # the transposed timepoint is a (z, y, x) view in the order of the unpacked tiles
+        _unpack_mosaics(mosaic_data, mosaic_type, block_dimensions, out=full_block[..., index].T)
+        del mosaic_data
+    return full_block
+
+
+def _unpack_mosaics(data_2d, mosaic_type, block_dimensions, out=None):
+    """
+    Split one (rows, columns) or a stack of (t, rows, columns) mosaics in tiles using a reshape instead of
+    copying tile by tile
+
+    :param data_2d: mosaic data with the rows and columns as last axes
+    :param mosaic_type: MosaicType of the mosaics
+    :param block_dimensions: dimensions as returned by _get_mosaic_block_dimensions
+    :param out: optional (z, y, x) or (t, z, y, x) array to write the tiles to
+    :return: block of data in (x, y, z) or (x, y, z, t) order
+    """
+    number_x, number_y, size_x, size_y, size_z = block_dimensions
+
+    # (..., rows, columns) -> (..., tile row, y, tile column, x) -> (..., tile row, tile column, y, x)
+    data_2d = data_2d[..., :number_y * size_y, :number_x * size_x]
+    tiles = data_2d.reshape(data_2d.shape[:-2] + (number_y, size_y, number_x, size_x)).swapaxes(-3, -2)
+    # the tiles are filled row by row, empty tiles at the end are dropped
+    data_3d = tiles.reshape(data_2d.shape[:-2] + (number_y * number_x, size_y, size_x))[..., :size_z, :, :]
+    if mosaic_type == MosaicType.DESCENDING:
+        data_3d = data_3d[..., ::-1, :, :]
+    if out is None:
+        out = numpy.ascontiguousarray(data_3d)
+    else:
+        out[...] = data_3d
+    # reorient the block of data, (..., z, y, x) -> (x, y, z, ...)
+    return out.T
 
 
 def _create_affine_siemens_mosaic(dicom_input):
@@ -545,21 +633,40 @@ def _create_affine_siemens_mosaic(dicom_input):
     return affine
 
 
+def _get_volume_headers(sorted_dicoms):
+    """
+    Get the header of the first slice of each volume (mosaics or grouped classic dicoms)
+    """
+    if type(sorted_dicoms[0]) is list:
+        return [volume_dicoms[0] for volume_dicoms in sorted_dicoms]
+    return list(sorted_dicoms)
+
+
+def _get_bval(dicom_headers):
+    """
+    Read the bval of a volume
+    """
+    return common.get_is_value(dicom_headers[Tag(0x0019, 0x100c)])
+
+
+def _get_bvec(dicom_headers):
+    """
+    Read the bvec of a volume, 0 if it is not in the headers
+    """
+    if Tag(0x0019, 0x100e) in dicom_headers:
+        # in case of implicit VR the private field cannot be split into an array, we do this here
+        return common.get_fd_array_value(dicom_headers[Tag(0x0019, 0x100e)], 3)
+    return [0, 0, 0]
+
+
 def _create_bvals(sorted_dicoms, bval_file):
     """
     Write the bvals from the sorted dicom files to a bval file
     """
-    bvals = []
-    for index in range(0, len(sorted_dicoms)):
-        if type(sorted_dicoms[0]) is list:
-            dicom_headers = sorted_dicoms[index][0]
-        else:
-            dicom_headers = sorted_dicoms[index]
-
-        bvals.append(common.get_is_value(dicom_headers[Tag(0x0019, 0x100c)]))
+    bvals = numpy.array([_get_bval(dicom_headers) for dicom_headers in _get_volume_headers(sorted_dicoms)])
     # save the found bvecs to the file
     common.write_bval_file(bvals, bval_file)
-    return numpy.array(bvals)
+    return bvals
 
 
 def _create_bvecs(sorted_dicoms, bvec_file):
@@ -568,47 +675,10 @@ def _create_bvecs(sorted_dicoms, bvec_file):
     # inspired by dicom2nii from mricron
     # see  http://users.fmrib.ox.ac.uk/~robson/internal/Dicom2Nifti111.m
     """
-    if type(sorted_dicoms[0]) is list:
-        dicom_headers = sorted_dicoms[0][0]
-    else:
-        dicom_headers = sorted_dicoms[0]
-
-    # get the patient orientation
-    image_orientation = dicom_headers.ImageOrientationPatient
-    read_vector = numpy.array([float(image_orientation[0]), float(image_orientation[1]), float(image_orientation[2])])
-    phase_vector = numpy.array([float(image_orientation[3]), float(image_orientation[4]), float(image_orientation[5])])
-    mosaic_vector = numpy.cross(read_vector, phase_vector)
-
-    # normalize the vectors
-    read_vector /= numpy.linalg.norm(read_vector)
-    phase_vector /= numpy.linalg.norm(phase_vector)
-    mosaic_vector /= numpy.linalg.norm(mosaic_vector)
-    # create an empty array for the new bvecs
-    bvecs = numpy.zeros([len(sorted_dicoms), 3])
-    # for each slice calculate the new bvec
-    for index in range(0, len(sorted_dicoms)):
-        if type(sorted_dicoms[0]) is list:
-            dicom_headers = sorted_dicoms[index][0]
-        else:
-            dicom_headers = sorted_dicoms[index]
-
-        # get the bval als this is needed in some checks
-        bval = common.get_is_value(dicom_headers[Tag(0x0019, 0x100c)])
-        # get the bvec if it exists in the headers
-        bvec = numpy.array([0, 0, 0])
-        if Tag(0x0019, 0x100e) in dicom_headers:
-            # in case of implicit VR the private field cannot be split into an array, we do this here
-            bvec = numpy.array(common.get_fd_array_value(dicom_headers[Tag(0x0019, 0x100e)], 3))
-        # if bval is 0 or the vector is 0 no projection is needed and the vector is 0,0,0
-        new_bvec = numpy.array([0, 0, 0])
-
-        if bval > 0 and not (bvec == [0, 0, 0]).all():
-            # project the bvec and invert the y direction
-            new_bvec = numpy.array(
-                [numpy.dot(bvec, read_vector), -numpy.dot(bvec, phase_vector), numpy.dot(bvec, mosaic_vector)])
-            # normalize the bvec
-            new_bvec /= numpy.linalg.norm(new_bvec)
-        bvecs[index, :] = new_bvec
+    volume_headers = _get_volume_headers(sorted_dicoms)
+    bvals, bvecs = common.get_gradient_table(volume_headers, _get_bval, _get_bvec)
+    # project the bvecs on the image directions (and invert the y direction)
+    bvecs = common.project_bvecs(bvals, bvecs, volume_headers[0].ImageOrientationPatient)
     # save the found bvecs to the file
     common.write_bvec_file(bvecs, bvec_file)
-    return numpy.array(bvecs)
+    return bvecs
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+dicom2nifti
+
+Persistent index of dicom headers so repeated directory conversions do not need to parse unchanged files again
+
+@author: abrys
+"""
+import json
+import os
+import sqlite3
+import time
+
+from pydicom.dataset import Dataset, FileMetaDataset
+
+import dicom2nifti.settings
+
+# increase this when the stored content changes, older indexes are then rebuilt from scratch
+SCHEMA_VERSION = 1
+
+# tags needed for the validity check, series grouping, naming, sorting and vendor detection
+INDEXED_TAGS = ['SeriesInstanceUID',
+                'SeriesNumber',
+                'SeriesDescription',
+                'SequenceName',
+                'ProtocolName',
+                'InstanceNumber',
+                'ImagePositionPatient',
+                'ImageOrientationPatient',
+                'Manufacturer',
+                'Modality',
+                'SOPClassUID',
+                'ImageType',
+                'NumberOfFrames']
+INDEXED_FILE_META_TAGS = ['MediaStorageSOPClassUID',
+                          'TransferSyntaxUID']
+
+# number of paths per query, stays below the limit of sqlite on the number of query parameters
+LOOKUP_CHUNK_SIZE = 500
+
+
+class HeaderIndex(object):
+    """
+    SQLite backed index of the relevant dicom tags keyed by the path, size and modification time of the files
+    Only the main thread should use an instance (the sqlite connection can not be shared between threads)
+    """
+
+    def __init__(self, index_file, max_entries=None):
+        """
+        :param index_file: path of the sqlite file (created if it does not exist)
+        :param max_entries: maximum number of files in the index, least recently used files are evicted first
+        """
+        if max_entries is None:
+            max_entries = dicom2nifti.settings.header_index_max_entries
+        self.max_entries = max_entries
+        self._connection = sqlite3.connect(index_file, timeout=60)
+        self._create_schema()
+
+    def _create_schema(self):
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._connection.execute('DROP TABLE IF EXISTS headers')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS headers ('
+                                 'path TEXT PRIMARY KEY, '
+                                 'size INTEGER, '
+                                 'mtime INTEGER, '
+                                 'valid INTEGER, '
+                                 'header TEXT, '
+                                 'last_access REAL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS headers_last_access ON headers (last_access)')
+        self._connection.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self._connection.commit()
+
+    def lookup(self, file_paths):
+        """
+        Get the indexed headers of the unchanged files
+
+        :param file_paths: list of file paths
+        :return: dict with the file path as key and a (valid, dicom_headers) tuple as value for all files
+                 that are in the index and did not change since they were indexed
+                 (dicom_headers is None for files that could not be read as dicom)
+        """
+        absolute_paths = {}
+        for file_path in file_paths:
+            absolute_paths[os.path.abspath(file_path)] = file_path
+
+        found = {}
+        found_paths = []
+        for chunk in _chunks(list(absolute_paths), LOOKUP_CHUNK_SIZE):
+            rows = self._connection.execute('SELECT path, size, mtime, valid, header FROM headers '
+                                            'WHERE path IN (%s)' % ', '.join('?' * len(chunk)),
+                                            chunk).fetchall()
+            for absolute_path, size, mtime, valid, header in rows:
+                file_path = absolute_paths[absolute_path]
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                if size != stat.st_size or mtime != stat.st_mtime_ns:
+                    continue
+                found[file_path] = (bool(valid), None if header is None else _from_json(header))
+                found_paths.append(absolute_path)
+
+        now = time.time()
+        for chunk in _chunks(found_paths, LOOKUP_CHUNK_SIZE):
+            self._connection.execute('UPDATE headers SET last_access = ? WHERE path IN (%s)' %
+                                     ', '.join('?' * len(chunk)),
+                                     [now] + chunk)
+        self._connection.commit()
+        return found
+
+    def add(self, file_path, valid, dicom_headers):
+        """
+        Add the headers of a file to the index (call commit afterwards)
+
+        :param file_path: path of the dicom file
+        :param valid: result of the imaging dicom validity check
+        :param dicom_headers: the dicom headers of the file or None if it could not be read as dicom
+                              (the file is then stored as not valid so it is not read again while it is unchanged)
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return
+        header = None
+        if dicom_headers is None:
+            valid = False
+        else:
+            header = _to_json(dicom_headers)
+        self._connection.execute('INSERT OR REPLACE INTO headers (path, size, mtime, valid, header, last_access) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)',
+                                 (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, int(valid),
+                                  header, time.time()))
+
+    def commit(self):
+        """
+        Store the added headers and evict the least recently used files if the index is too large
+        """
+        count = self._connection.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+        if count > self.max_entries:
+            self._connection.execute('DELETE FROM headers WHERE path IN '
+                                     '(SELECT path FROM headers ORDER BY last_access LIMIT ?)',
+                                     (count - self.max_entries,))
+        self._connection.commit()
+
+    def invalidate(self, directory=None):
+        """
+        Remove files from the index
+
+        :param directory: only remove the files in this directory (and its subdirectories), None removes all files
+        """
+        if directory is None:
+            self._connection.execute('DELETE FROM headers')
+        else:
+            directory = os.path.join(os.path.abspath(directory), '')
+            self._connection.execute("DELETE FROM headers WHERE substr(path, 1, ?) = ?",
+                                     (len(directory), directory))
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+def open_index():
+    """
+    Open the header index configured in the settings
+
+    :return: HeaderIndex or None if the header index is disabled
+    """
+    if dicom2nifti.settings.header_index_file is None:
+        return None
+    return HeaderIndex(dicom2nifti.settings.header_index_file)
+
+
+def clear(index_file=None):
+    """
+    Remove all files from a header index
+
+    :param index_file: path of the sqlite file, defaults to the one configured in the settings
+    """
+    if index_file is None:
+        index_file = dicom2nifti.settings.header_index_file
+    if index_file is None or not os.path.exists(index_file):
+        return
+    index = HeaderIndex(index_file)
+    try:
+        index.invalidate()
+    finally:
+        index.close()
+
+
+def _chunks(values, chunk_size):
+    """
+    Split a list in consecutive parts of at most chunk_size values
+    """
+    return [values[index:index + chunk_size] for index in range(0, len(values), chunk_size)]
+
+
+def _to_json(dicom_headers):
+    """
+    Serialize the indexed tags of a dicom object
+    """
+    dataset = Dataset()
+    for keyword in INDEXED_TAGS:
+        if keyword in dicom_headers:
+            dataset[keyword] = dicom_headers[keyword]
+    file_meta = FileMetaDataset()
+    original_file_meta = getattr(dicom_headers, 'file_meta', None)
+    if original_file_meta is not None:
+        for keyword in INDEXED_FILE_META_TAGS:
+            if keyword in original_file_meta:
+                file_meta[keyword] = original_file_meta[keyword]
+    return json.dumps({'dataset': dataset.to_json_dict(),
+                       'file_meta': file_meta.to_json_dict()})
+
+
+def _from_json(header_json):
+    """
+    Deserialize the indexed tags to a dicom object with the same tags and file meta
+    """
+    header = json.loads(header_json)
+    dataset = Dataset.from_json(header['dataset'])
+    dataset.file_meta = FileMetaDataset(Dataset.from_json(header['file_meta']))
+    return dataset
@@ -6,10 +6,14 @@ Created on Thu Aug  1 16:10:56 2013
 """
 # To ignore numpy errors:
 #     pylint: disable=E1101
+import os
+
 import nibabel
 import numpy
 
-from dicom2nifti.image_volume import load, SliceType, ImageVolume
+import dicom2nifti.nifti_writer as nifti_writer
+from dicom2nifti.common import get_nifti_data
+from dicom2nifti.image_volume import __calc_most_likely_direction__
 
 
 def reorient_image(input_image, output_image):
@@ -18,89 +22,122 @@ def reorient_image(input_image, output_image):
     x will represent the coronal plane, y the sagittal and z the axial plane.
     x increases from Right (R) to Left (L), y from Posterior (P) to Anterior (A) and z from Inferior (I) to Superior (S)
 
+    The reorientation is calculated from the affine alone and applied as a view on the data,
+    the data is only copied (slab by slab) when writing the output image
+
     :returns: The output image in nibabel form
-    :param output_image: filepath to the nibabel image
+    :param output_image: filepath to the nibabel image (None to only reorient in memory)
     :param input_image: filepath to the nibabel image
     """
-    # Use the imageVolume module to find which coordinate corresponds to each plane
-    # and get the image data in RAS orientation
-    # print 'Reading nifti'
-    if isinstance(input_image, nibabel.Nifti1Image):
-        image = ImageVolume(input_image)
-    else:
-        image = load(input_image)
-
-    # 4d have a different conversion to 3d
-    # print 'Reorganizing data'
-    if image.nifti_data.squeeze().ndim == 4:
-        new_image = _reorient(image)
-    elif image.nifti_data.squeeze().ndim == 3 or image.nifti_data.ndim == 3 or image.nifti_data.squeeze().ndim == 2:
-        new_image = _reorient(image)
-    else:
+    input_file = None
+    if not isinstance(input_image, nibabel.Nifti1Image):
+        input_file = input_image
+        input_image = nibabel.load(input_image)
+
+    output, reorientation = reorient_nifti(input_image)
+    if output_image is None:
+        return output
+    if reorientation is None and input_file is not None and \
+            os.path.abspath(input_file) == os.path.abspath(output_image):
+        # the file is already LAS so it does not need to be written again
+        return output
+
+    if reorientation is None:
+        # the image is returned as is so its header can still have the (scaled) on disk dtype,
+        # the scaled data is written in its own dtype like the reoriented images
+        data = get_nifti_data(output)
+        output = nibabel.nifti1.Nifti1Image(data, output.affine, output.header)
+        output.header.set_data_dtype(data.dtype)
+    output.header.set_slope_inter(1, 0)
+    output.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
+    nifti_writer.write_nifti(output, output_image)
+    return output
+
+
+def reorient_nifti(nifti_image):
+    """
+    Change the orientation of a nifti image to LAS space in memory (see reorient_image)
+    If the image is already LAS it is returned as is, otherwise the header of the input image is kept
+    (units, repetition time, ...) with the shape and voxel sizes of the reoriented image
+
+    :param nifti_image: nibabel image to reorient
+    :return: tuple with the LAS image and the applied reorientation (dict with the AXES of the input image that
+             became x, y and z and the new axes that were flipped (FLIPS)) or None if the image was already LAS
+    """
+    # the same squeezing as the image volume does but without touching the data
+    shape = tuple(size for size in nifti_image.shape if size != 1)
+    if len(shape) == 2:
+        shape += (1,)
+    if len(shape) not in [3, 4]:
         raise Exception('Only 3d and 4d images are supported')
 
-    # print 'Recreating affine'
-    affine = image.affine
-    # Based on VolumeImage.py where slice orientation 1 represents the axial plane
-    # Flipping on the data may be needed based on x_inverted, y_inverted, ZInverted
+    axes, flips, new_affine = get_reorientation(nifti_image.affine, shape)
+    if axes == [0, 1, 2] and not flips and shape == nifti_image.shape:
+        return nifti_image, None
+
+    data = get_nifti_data(nifti_image).reshape(shape)
+    new_image = numpy.moveaxis(data, axes, [0, 1, 2])
+    if flips:
+        new_image = numpy.flip(new_image, axis=flips)
+
+    if new_image.ndim > 3:  # do not squeeze single slice data
+        new_image = new_image.squeeze()
+    # start from the input header so the units and timing (tr in pixdim[4] and the description) are kept,
+    # the shape and the voxel sizes are updated from the new data and affine
+    output = nibabel.nifti1.Nifti1Image(new_image, new_affine, nifti_image.header)
+    output.header.set_data_dtype(new_image.dtype)
+    output.header.set_slope_inter(1, 0)
+    return output, {'AXES': axes, 'FLIPS': list(flips)}
+
+
+def get_reorientation(affine, shape):
+    """
+    Calculate the LAS reorientation of an image from its affine
+    The result is the same as reorienting with the image volume (sagittal, coronal and axial orientations)
+
+    :param affine: affine of the image
+    :param shape: shape of the (squeezed) image data
+    :return: tuple with the input axes of the new x, y and z axes, the new axes to flip and the new affine
+    """
+    affine_inverse = numpy.linalg.inv(affine)
+    transformed_x = affine_inverse[:, 0]
+    transformed_y = affine_inverse[:, 1]
+    transformed_z = affine_inverse[:, 2]
 
-    # Create new affine header by changing the order of the columns of the input image header
-    # the last column with the origin depends on the origin of the original image, the size and the direction of x,y,z
+    # calculate the most likely x,y,z direction
+    x_component, y_component, z_component = __calc_most_likely_direction__(transformed_x,
+                                                                           transformed_y,
+                                                                           transformed_z)
+    x_inverted = transformed_x[x_component] < 0
+    y_inverted = transformed_y[y_component] < 0
+    z_inverted = transformed_z[z_component] < 0
 
+    # new x,y,z correspond to LR (sagittal), PA (coronal), IS (axial) directions
+    axes = [int(x_component), int(y_component), int(z_component)]
+    flips = []
     new_affine = numpy.eye(4)
-    new_affine[:, 0] = affine[:, image.sagittal_orientation.normal_component]
-    new_affine[:, 1] = affine[:, image.coronal_orientation.normal_component]
-    new_affine[:, 2] = affine[:, image.axial_orientation.normal_component]
+    new_affine[:, 0] = affine[:, x_component]
+    new_affine[:, 1] = affine[:, y_component]
+    new_affine[:, 2] = affine[:, z_component]
     point = [0, 0, 0, 1]
 
     # If the orientation of coordinates is inverted, then the origin of the "new" image
     # would correspond to the last voxel of the original image
     # First we need to find which point is the origin point in image coordinates
     # and then transform it in world coordinates
-    if not image.axial_orientation.x_inverted:
+    if not x_inverted:
+        flips.append(0)
         new_affine[:, 0] = - new_affine[:, 0]
-        point[image.sagittal_orientation.normal_component] = image.dimensions[
-                                                                 image.sagittal_orientation.normal_component] - 1
-        # new_affine[0, 3] = - new_affine[0, 3]
-    if image.axial_orientation.y_inverted:
+        point[x_component] = shape[x_component] - 1
+    if y_inverted:
+        flips.append(1)
         new_affine[:, 1] = - new_affine[:, 1]
-        point[image.coronal_orientation.normal_component] = image.dimensions[
-                                                                image.coronal_orientation.normal_component] - 1
-        # new_affine[1, 3] = - new_affine[1, 3]
-    if image.coronal_orientation.y_inverted:
+        point[y_component] = shape[y_component] - 1
+    if z_inverted:
+        flips.append(2)
         new_affine[:, 2] = - new_affine[:, 2]
-        point[image.axial_orientation.normal_component] = image.dimensions[image.axial_orientation.normal_component] - 1
-        # new_affine[2, 3] = - new_affine[2, 3]
+        point[z_component] = shape[z_component] - 1
 
     new_affine[:, 3] = numpy.dot(affine, point)
 
-    # DONE: Needs to update new_affine, so that there is no translation difference between the original
-    # and created image (now there is 1-2 voxels translation)
-    # print 'Creating new nifti image'
-    if new_image.ndim > 3:  # do not squeeze single slice data
-        new_image = new_image.squeeze()
-    output = nibabel.nifti1.Nifti1Image(new_image, new_affine)
-    output.header.set_slope_inter(1, 0)
-    output.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-    output.to_filename(output_image)
-    return output
-
-def _reorient(image):
-    """
-    Reorganize the data for a 3d nifti
-    """
-    # Create new array where x,y,z correspond to LR (sagittal), PA (coronal), IS (axial) directions and the size
-    # of the array in each direction is the same with the corresponding direction of the input image.
-    new_image = numpy.moveaxis(image.nifti_data,
-                               [image.sagittal_orientation.normal_component,
-                                image.coronal_orientation.normal_component,
-                                image.axial_orientation.normal_component],
-                               [0, 1, 2])
-    if not image.axial_orientation.x_inverted:
-        new_image = numpy.flip(new_image, axis=0)
-    if image.axial_orientation.y_inverted:
-        new_image = numpy.flip(new_image, axis=1)
-    if image.sagittal_orientation.y_inverted:
-        new_image = numpy.flip(new_image, axis=2)
-
-    return new_image
+    return axes, tuple(flips), new_affine
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+dicom2nifti
+
+Streaming nifti writer, the header is written first and the data is appended block by block (x fastest)
+so the full volume does not need to be in memory when writing
+
+@author: abrys
+"""
+import collections
+import concurrent.futures
+import gzip
+import logging
+import os
+
+import nibabel
+import numpy
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import seek_tell
+
+import dicom2nifti.settings as settings
+from dicom2nifti.exceptions import ConversionError
+
+logger = logging.getLogger(__name__)
+
+
+def create_template(shape, dtype, affine):
+    """
+    Create a nifti image without data that can be used to define the header of a NiftiWriter
+
+    :param shape: shape of the data
+    :param dtype: dtype of the data
+    :param affine: affine of the image
+    :return: Nifti1Image
+    """
+    return nibabel.Nifti1Image(numpy.broadcast_to(numpy.zeros((), dtype=dtype), tuple(shape)), affine)
+
+
+class NiftiWriter(object):
+    """
+    Write a nifti file block by block in the same layout as nibabel (to_filename) would write it
+
+    The blocks are written in x fastest (fortran) order so they should be consecutive slabs along the last axis
+    (for example the slices of a 3D volume or the volumes of a 4D image)
+    If an error occurs while writing (or not all data is written) the partial file is removed
+    """
+
+    def __init__(self, output_file, nifti_image):
+        """
+        :param output_file: path of the nifti file (.nii or .nii.gz)
+        :param nifti_image: image that defines the header (shape, dtype, affine, ...), its data is not written
+        """
+        self.output_file = output_file
+        header = nifti_image.header
+        if numpy.isnan(header['scl_slope']) and numpy.isnan(header['scl_inter']):
+            # nibabel does the same when writing unscaled data
+            header.set_slope_inter(1, 0)
+        nifti_image.update_header()
+        self.shape = nifti_image.shape
+        self.dtype = nifti_image.get_data_dtype(finalize=True)
+        # the blocks contain the scaled values, the inverse of the header scaling is applied before the cast
+        slope, inter = header.get_slope_inter()
+        self.slope = 1.0 if slope is None else float(slope)
+        self.inter = 0.0 if inter is None else float(inter)
+        self.number_of_voxels = int(numpy.prod(self.shape))
+        self.written_voxels = 0
+
+        self._fileobj = _open_output(output_file)
+        try:
+            header.write_to(self._fileobj)
+            seek_tell(self._fileobj, header.get_data_offset(), write0=True)
+        except BaseException:
+            self._abort()
+            raise
+
+    def write(self, block):
+        """
+        Append a block of data, the block is converted to the dtype of the nifti
+        If the header has a scl_slope/scl_inter the block should contain the scaled values (like the dataobj of the
+        image), they are unscaled before the conversion in the same way as nibabel does when writing
+
+        :param block: numpy array with the next part of the data
+        """
+        block = numpy.asarray(block)
+        if self.written_voxels + block.size > self.number_of_voxels:
+            logger.warning('Too much data written to %s' % self.output_file)
+            raise ConversionError('NIFTI_DATA_SIZE_MISMATCH')
+        if self.slope != 1.0 or self.inter != 0.0:
+            block = _unscale(block, self.slope, self.inter, self.dtype)
+        # the transposed fortran ordered block is c contiguous
+        data = numpy.ascontiguousarray(block.astype(self.dtype, copy=False).T)
+        self._fileobj.write(data.reshape(-1).view(numpy.uint8))
+        self.written_voxels += block.size
+
+    def close(self):
+        """
+        Finish writing the nifti file
+        """
+        if self.written_voxels != self.number_of_voxels:
+            self._abort()
+            logger.warning('Not all data written to %s (%s of %s voxels)' %
+                           (self.output_file, self.written_voxels, self.number_of_voxels))
+            raise ConversionError('NIFTI_DATA_SIZE_MISMATCH')
+        self._fileobj.close()
+
+    def _abort(self):
+        self._fileobj.close()
+        if os.path.exists(self.output_file):
+            os.remove(self.output_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._abort()
+            return False
+        self.close()
+        return False
+
+
+class ParallelGzipFile(object):
+    """
+    Write only gzip file that compresses blocks of data in parallel (like pigz)
+
+    Every block is written as a separate gzip member, the result is a standard multi member gzip file
+    that can be read by nibabel, fsl, gunzip, ...
+    """
+
+    def __init__(self, output_file, compresslevel=None, threads=None, block_size=4 * 1024 * 1024):
+        """
+        :param output_file: path of the gzip file
+        :param compresslevel: gzip compression level, defaults to the compression level in the settings
+        :param threads: number of compression threads, defaults to the compression threads in the settings
+        :param block_size: size in bytes of the uncompressed data in each gzip member
+        """
+        if compresslevel is None:
+            compresslevel = settings.compression_level
+        if threads is None:
+            threads = settings.compression_threads
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self._max_pending = 2 * max(threads, 1)
+        self._buffer = bytearray()
+        self._position = 0
+        self._pending = collections.deque()
+        self._members_written = 0
+        self._fileobj = open(output_file, 'wb')
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(threads, 1))
+        self.closed = False
+
+    def write(self, data):
+        """
+        Append (uncompressed) data to the file
+
+        :param data: bytes like object
+        """
+        data = memoryview(data).cast('B')
+        self._buffer += data
+        self._position += data.nbytes
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return data.nbytes
+
+    def tell(self):
+        """
+        Position in the uncompressed data
+        """
+        return self._position
+
+    def seek(self, offset, whence=0):
+        # only appending is supported (seek_tell then falls back to tell and writing zeros)
+        if whence != 0 or offset != self._position:
+            raise OSError('ParallelGzipFile only supports appending')
+        return self._position
+
+    def close(self):
+        """
+        Compress the remaining data and close the file
+        """
+        if self.closed:
+            return
+        try:
+            if self._buffer or self._members_written + len(self._pending) == 0:
+                # an empty file still needs one (empty) gzip member
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_member(self._pending.popleft())
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._fileobj.close()
+            self.closed = True
+
+    def _submit(self, data):
+        # mtime 0 keeps the output deterministic
+        self._pending.append(self._executor.submit(gzip.compress, data, self.compresslevel, mtime=0))
+        while len(self._pending) > self._max_pending:
+            self._write_member(self._pending.popleft())
+
+    def _write_member(self, future):
+        self._fileobj.write(future.result())
+        self._members_written += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _unscale(block, slope, inter, dtype):
+    """
+    Apply the inverse of the nifti scaling to a block, integer outputs are rounded and clipped to the dtype
+    (nan becomes 0) like the nibabel ArrayWriter does
+
+    :param block: block with the scaled values
+    :param slope: scl_slope of the header
+    :param inter: scl_inter of the header
+    :param dtype: dtype of the nifti data
+    """
+    block = (block - inter) / slope
+    if dtype.kind in 'iu':
+        numpy.nan_to_num(block, copy=False)
+        numpy.rint(block, out=block)
+        dtype_info = numpy.iinfo(dtype)
+        numpy.clip(block, dtype_info.min, dtype_info.max, out=block)
+    return block
+
+
+def _open_output(output_file):
+    """
+    Open a nifti file for writing using the compression settings
+    """
+    if output_file.lower().endswith('.gz'):
+        if settings.compression_threads > 1:
+            return ParallelGzipFile(output_file)
+        return ImageOpener(output_file, 'wb', compresslevel=settings.compression_level)
+    return ImageOpener(output_file, 'wb')
+
+
+def write_nifti(nifti_image, output_file):
+    """
+    Write a nifti image slab by slab along the last axis
+    The data can be any (non contiguous) view, only one slab at a time is copied to the file layout
+
+    :param nifti_image: nifti image to write
+    :param output_file: path of the nifti file (.nii or .nii.gz)
+    """
+    data = numpy.asanyarray(nifti_image.dataobj)
+    with NiftiWriter(output_file, nifti_image) as writer:
+        if data.ndim == 0:
+            writer.write(data)
+            return
+        for index in range(data.shape[-1]):
+            writer.write(data[..., index])
@@ -4,6 +4,10 @@ dicom2nifti
 
 @author: abrys
 """
+import collections
+import concurrent.futures
+import threading
+
 import nibabel
 import nibabel.affines
 import numpy
@@ -11,17 +15,27 @@ import scipy.ndimage
 
 from dicom2nifti.common import get_nifti_data
 from dicom2nifti import settings
+from dicom2nifti import nifti_writer
+
+# maximum size of the output slab that is resampled at once
+_SLAB_BYTES = 64 * 1024 * 1024
+# maximum number of resample plans in the cache (the index maps are limited by settings.resample_cache_size)
+_MAX_CACHED_PLANS = 64
+_plan_cache = collections.OrderedDict()
+_plan_cache_lock = threading.Lock()
 
 
 def resample_single_nifti(input_image, output_nifti):
     """
     Resample a gantry tilted image in place
+    The resampled image is only written to disk if output_nifti is not None
     """
     # read the input image
     output_image = resample_nifti_images([input_image])
     output_image.header.set_slope_inter(1, 0)
     output_image.header.set_xyzt_units(2)  # set units for xyz (leave t as unknown)
-    output_image.to_filename(output_nifti)
+    if output_nifti is not None:
+        nifti_writer.write_nifti(output_image, output_nifti)
     return output_image
 
 
@@ -50,10 +64,139 @@ def resample_nifti_images(nifti_images, voxel_size=None):
 
     # get the smallest voxelsize and use that
     if voxel_size is None:
-        voxel_size = nifti_images[0].header.get_zooms()
+        voxel_size = nifti_images[0].header.get_zooms()[:3]
         for nifti_image in nifti_images[1:]:
-            voxel_size = numpy.minimum(voxel_size, nifti_image.header.get_zooms())
+            voxel_size = numpy.minimum(voxel_size, nifti_image.header.get_zooms()[:3])
+
+    plan = _get_plan(nifti_images, voxel_size)
+
+    # Resample each image (4d images are resampled per time point)
+    data = get_nifti_data(nifti_images[0])
+    combined_image_data = numpy.empty(plan.new_shape + data.shape[3:], dtype=data.dtype, order='F')
+    transforms = [(get_nifti_data(nifti_image), matrix, offset)
+                  for nifti_image, (matrix, offset) in zip(nifti_images, plan.transforms)]
+
+    # resample slab by slab along z so the temporary data stays small, scipy releases the gil so slabs
+    # (or the time points of a slab) can be resampled in parallel
+    size_x, size_y, size_z = combined_image_data.shape[:3]
+    slice_bytes = size_x * size_y * combined_image_data.itemsize * int(numpy.prod(combined_image_data.shape[3:]))
+    slab_size = max(1, _SLAB_BYTES // max(1, slice_bytes))
+    slabs = [(z_start, min(z_start + slab_size, size_z)) for z_start in range(0, size_z, slab_size)]
+    executor = None
+    if settings.resample_threads > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.resample_threads)
+    try:
+        if combined_image_data.ndim > 3:
+            for z_start, z_stop in slabs:
+                _resample_4d_slab(plan, transforms, combined_image_data[:, :, z_start:z_stop], z_start, executor)
+        else:
+            _map(executor,
+                 lambda slab: _resample_3d_slab(plan, transforms, combined_image_data[:, :, slab[0]:slab[1]],
+                                                slab[0]),
+                 slabs)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    _trim_plan_cache()
+
+    if combined_image_data.ndim > 3:  # do not squeeze single slice data
+        combined_image_data = combined_image_data.squeeze()
+    return nibabel.Nifti1Image(combined_image_data, plan.new_affine)
+
+
+class ResamplePlan(object):
+    """
+    Geometry of a resampling: the output grid and the transform (from output to input voxels) of every input image
+    For nearest neighbour interpolation it can also keep the input voxel of every output voxel (per slab)
+    so resampling the same geometry again does not need to calculate any coordinates
+    """
+
+    def __init__(self, new_affine, new_shape, transforms):
+        """
+        :param new_affine: affine of the output
+        :param new_shape: shape of the output
+        :param transforms: list with the matrix and offset (from output to input voxels) of every input image
+        """
+        self.new_affine = new_affine
+        self.new_shape = new_shape
+        self.transforms = transforms
+        self.index_maps = {}
+        self.nbytes = 0
+
+    def get_index_maps(self, transforms, z_start, output_shape):
+        """
+        Get the (nearest neighbour) index maps of all input images for a slab of the output
+        The index maps are kept in the plan as long as the resample cache has room for them
+
+        :param transforms: list with the data, matrix and offset of each input image
+        :param z_start: first slice of the slab in the output
+        :param output_shape: shape of the slab
+        :return: list with the region and index map of every input image (see _get_index_map)
+        """
+        key = (z_start, output_shape)
+        index_maps = self.index_maps.get(key)
+        if index_maps is not None:
+            return index_maps
+        index_maps = [_get_index_map(image_data.shape[:3], matrix, offset + matrix.dot([0, 0, z_start]), output_shape)
+                      for image_data, matrix, offset in transforms]
+        nbytes = sum(index_map.nbytes for _, index_map in index_maps if index_map is not None)
+        with _plan_cache_lock:
+            if self.nbytes + nbytes <= settings.resample_cache_size:
+                self.index_maps[key] = index_maps
+                self.nbytes += nbytes
+        return index_maps
+
+    def stores_index_maps(self):
+        """
+        Check if index maps can be (or are) kept for this plan
+        """
+        return settings.resample_spline_interpolation_order == 0 and settings.resample_cache_size > 0
+
+
+def clear_plan_cache():
+    """
+    Remove all cached resample plans
+    """
+    with _plan_cache_lock:
+        _plan_cache.clear()
+
+
+def _get_plan(nifti_images, voxel_size):
+    """
+    Get the resample plan for these images from the cache or create it
+    The cache is keyed by the shape and affine of all images, the voxel size and the interpolation order
+    """
+    if settings.resample_cache_size <= 0:
+        return _create_plan(nifti_images, voxel_size)
+
+    key = (tuple((nifti_image.shape, nifti_image.affine.tobytes()) for nifti_image in nifti_images),
+           tuple(float(size) for size in voxel_size),
+           settings.resample_spline_interpolation_order)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+    plan = _create_plan(nifti_images, voxel_size)
+    with _plan_cache_lock:
+        _plan_cache[key] = plan
+    return plan
+
+
+def _trim_plan_cache():
+    """
+    Remove the least recently used plans until the cache fits in its size
+    """
+    with _plan_cache_lock:
+        while _plan_cache and (len(_plan_cache) > _MAX_CACHED_PLANS or
+                               sum(plan.nbytes for plan in _plan_cache.values()) > settings.resample_cache_size):
+            _plan_cache.popitem(last=False)
 
+
+def _create_plan(nifti_images, voxel_size):
+    """
+    Calculate the output grid and the transforms of the input images (see resample_nifti_images)
+    """
     x_axis_world = numpy.transpose(numpy.dot(nifti_images[0].affine, [[1], [0], [0], [0]]))[0, :3]
     y_axis_world = numpy.transpose(numpy.dot(nifti_images[0].affine, [[0], [1], [0], [0]]))[0, :3]
     x_axis_world /= numpy.linalg.norm(x_axis_world)  # normalization
@@ -103,28 +246,183 @@ def resample_nifti_images(nifti_images, voxel_size=None):
 
     new_affine = _create_affine(x_axis_world, y_axis_world, z_axis_world, origin, voxel_size)
 
-    # Resample each image
-    combined_image_data = numpy.full(new_shape, settings.resample_padding,
-                                     dtype=get_nifti_data(nifti_images[0]).dtype)
+    transforms = []
     for nifti_image in nifti_images:
         image_affine = nifti_image.affine
         combined_affine = numpy.linalg.inv(new_affine).dot(image_affine)
         matrix, offset = nibabel.affines.to_matvec(numpy.linalg.inv(combined_affine))
-        resampled_image = scipy.ndimage.affine_transform(get_nifti_data(nifti_image),
-                                                         matrix=matrix,
-                                                         offset=offset,
-                                                         output_shape=new_shape,
-                                                         output=get_nifti_data(nifti_image).dtype,
-                                                         order=settings.resample_spline_interpolation_order,
-                                                         mode='constant',
-                                                         cval=settings.resample_padding,
-                                                         prefilter=False)
-        combined_image_data[combined_image_data == settings.resample_padding] = \
-            resampled_image[combined_image_data == settings.resample_padding]
+        transforms.append((matrix, offset))
 
-    if combined_image_data.ndim > 3:  # do not squeeze single slice data
-        combined_image_data = combined_image_data.squeeze()
-    return nibabel.Nifti1Image(combined_image_data, new_affine)
+    return ResamplePlan(new_affine, tuple(int(size) for size in new_shape), transforms)
+
+
+def _map(executor, function, items):
+    """
+    Call the function for all items, in parallel if there is an executor
+    """
+    if executor is None or len(items) < 2:
+        for item in items:
+            function(item)
+        return
+    for _ in executor.map(function, items):
+        pass
+
+
+def _resample_3d_slab(plan, transforms, output_slab, z_start):
+    """
+    Resample a slab of 3d output, with the cached index maps if the plan keeps them
+    """
+    index_maps = None
+    if plan.stores_index_maps():
+        index_maps = plan.get_index_maps(transforms, z_start, output_slab.shape)
+    _resample_slab(transforms, output_slab, z_start, index_maps=index_maps)
+
+
+def _resample_4d_slab(plan, transforms, output_slab, z_start, executor):
+    """
+    Resample a slab of 4d output starting at slice z_start from all input images, the time points are
+    resampled in parallel
+
+    For nearest neighbour interpolation the input voxel of every output voxel is calculated once and reused
+    for all time points (this gives exactly the same result as resampling every time point)
+    """
+    time_points = list(numpy.ndindex(*output_slab.shape[3:]))
+    index_maps = None
+    if settings.resample_spline_interpolation_order == 0:
+        index_maps = plan.get_index_maps(transforms, z_start, output_slab.shape[:3])
+    _map(executor,
+         lambda time_point: _resample_slab(transforms, output_slab[(Ellipsis,) + time_point], z_start,
+                                           time_point, index_maps),
+         time_points)
+
+
+def _resample_slab(transforms, output_slab, z_start, time_point=None, index_maps=None):
+    """
+    Resample a slab of 3d output starting at slice z_start from all input images
+    The first image that has data (not padding) in a voxel determines its value
+
+    :param transforms: list with the data, matrix and offset (from output to input voxels) of each input image
+    :param output_slab: output data of the slab
+    :param z_start: first slice of the slab in the output
+    :param time_point: time point of the (4d) input images to resample
+    :param index_maps: nearest neighbour index maps of the input images for this slab (None to interpolate)
+    """
+    for index, (image_data, matrix, offset) in enumerate(transforms):
+        if time_point is not None:
+            image_data = image_data[(Ellipsis,) + time_point]
+        if index == 0:
+            resampled_slab = output_slab
+        else:
+            resampled_slab = numpy.empty(output_slab.shape, dtype=output_slab.dtype, order='F')
+        if index_maps is not None:
+            _resample_index_map(image_data, index_maps[index], resampled_slab)
+        else:
+            _resample_region(image_data, matrix, offset + matrix.dot([0, 0, z_start]), resampled_slab)
+        if index > 0:
+            padding_mask = output_slab == settings.resample_padding
+            output_slab[padding_mask] = resampled_slab[padding_mask]
+
+
+def _resample_index_map(image_data, index_map, output):
+    """
+    Nearest neighbour resampling with a precalculated index map (see _get_index_map)
+    """
+    region, index_map = index_map
+    padding = _get_padding_value(output.dtype)
+    if region is None:
+        output[...] = padding
+        return
+    region_data = image_data[region].ravel()
+    output[...] = numpy.where(index_map >= 0, region_data.take(numpy.maximum(index_map, 0)), padding)
+
+
+def _get_index_map(image_shape, matrix, offset, output_shape):
+    """
+    Get the (nearest neighbour) input voxel of every output voxel
+
+    :return: tuple with the input region (slices) and the flat index in this region of every output voxel
+             (-1 outside of the image), the region is None if the output is completely outside of the image
+    """
+    region_start, region_stop = _get_region(image_shape, matrix, offset, output_shape)
+    if region_start is None:
+        return None, None
+    region_shape = tuple(int(size) for size in region_stop - region_start)
+    region_size = int(numpy.prod(region_shape))
+    index_dtype = numpy.int32 if region_size < 2 ** 31 else numpy.int64
+    # resampling the voxel indices gives exactly the voxels scipy would use
+    index_map = scipy.ndimage.affine_transform(numpy.arange(region_size, dtype=index_dtype).reshape(region_shape),
+                                               matrix=matrix,
+                                               offset=offset - region_start,
+                                               output_shape=output_shape,
+                                               output=index_dtype,
+                                               order=0,
+                                               mode='constant',
+                                               cval=-1,
+                                               prefilter=False)
+    region = tuple(slice(start, stop) for start, stop in zip(region_start, region_stop))
+    return region, index_map
+
+
+def _get_padding_value(dtype):
+    """
+    Get the padding as scipy would write it in an output of this dtype
+    """
+    return scipy.ndimage.affine_transform(numpy.zeros((1, 1, 1), dtype=dtype),
+                                          matrix=numpy.eye(3),
+                                          offset=[10, 10, 10],
+                                          output_shape=(1, 1, 1),
+                                          output=dtype,
+                                          order=0,
+                                          mode='constant',
+                                          cval=settings.resample_padding,
+                                          prefilter=False)[0, 0, 0]
+
+
+def _get_region(image_shape, matrix, offset, output_shape):
+    """
+    Get the region of the input image that is needed to resample the output
+    (the bounding box of the output corners with a margin for the interpolation)
+
+    :return: tuple with the start and stop of the region or (None, None) if the output is completely outside
+             of the image
+    """
+    corners = numpy.array(numpy.meshgrid(*[[0, size - 1] for size in output_shape], indexing='ij')).reshape(3, -1)
+    input_corners = matrix.dot(corners) + offset[:, numpy.newaxis]
+    margin = settings.resample_spline_interpolation_order + 2
+    region_start = numpy.maximum(numpy.floor(input_corners.min(axis=1)).astype(int) - margin, 0)
+    region_stop = numpy.minimum(numpy.ceil(input_corners.max(axis=1)).astype(int) + margin + 1, image_shape)
+    if numpy.any(region_stop <= region_start):
+        return None, None
+    return region_start, region_stop
+
+
+def _resample_region(image_data, matrix, offset, output):
+    """
+    Resample only the region of the input image that is needed for the output
+
+    :param image_data: input data
+    :param matrix: matrix from output to input voxels
+    :param offset: offset from output to input voxels
+    :param output: output array to resample into
+    """
+    region_start, region_stop = _get_region(image_data.shape, matrix, offset, output.shape)
+    if region_start is None:
+        # the output region is completely outside of the image
+        output[...] = _get_padding_value(output.dtype)
+        return
+
+    region = image_data[region_start[0]:region_stop[0],
+                        region_start[1]:region_stop[1],
+                        region_start[2]:region_stop[2]]
+    scipy.ndimage.affine_transform(region,
+                                   matrix=matrix,
+                                   offset=offset - region_start,
+                                   output_shape=output.shape,
+                                   output=output,
+                                   order=settings.resample_spline_interpolation_order,
+                                   mode='constant',
+                                   cval=settings.resample_padding,
+                                   prefilter=False)
 
 
 def _create_affine(x_axis, y_axis, z_axis, image_pos, voxel_sizes):
@@ -9,6 +9,13 @@ pydicom_read_force = False
 resample = False
 resample_padding = 0
 resample_spline_interpolation_order = 0  # spline interpolation order (0 nn , 1 bilinear, 3 cubic)
+resample_threads = 4  # number of threads used to resample the slabs of an image
+resample_cache_size = 0  # bytes of resample plans (nearest neighbour indices) kept for reuse (0 to disable)
+scan_threads = 8  # number of threads used to read the dicom headers when scanning a directory
+header_index_file = None  # sqlite file used to index the dicom headers when scanning a directory (None to disable)
+header_index_max_entries = 1000000
+compression_threads = 1  # number of threads used to compress .nii.gz output (1 uses the default nibabel gzip)
+compression_level = 1  # gzip compression level of .nii.gz output
 
 
 def disable_validate_slice_increment():
@@ -166,3 +173,77 @@ def set_resample_spline_interpolation_order(order):
     global resample_spline_interpolation_order
     resample_spline_interpolation_order = order
 
+
+def set_resample_threads(threads):
+    """
+    Set the number of threads used for resampling, the output is resampled in slabs along z that are processed
+    in parallel (use 1 to disable the threading)
+    """
+    global resample_threads
+    resample_threads = threads
+
+
+def set_resample_cache_size(cache_size):
+    """
+    Set the maximum size in bytes of the resample cache (0 to disable the cache)
+    Images with the same shape, affine and interpolation order reuse the output grid and, for nearest neighbour
+    interpolation, the input voxel of every output voxel
+    """
+    global resample_cache_size
+    resample_cache_size = cache_size
+
+
+def set_scan_threads(threads):
+    """
+    Set the number of threads used to check and read the dicom files when scanning a directory
+    Reading headers is mostly waiting for the filesystem so this can be higher than the number of cores
+    (especially on network filesystems), use 1 to disable the threading
+    """
+    global scan_threads
+    scan_threads = threads
+
+
+def enable_header_index(index_file):
+    """
+    Enable the persistent header index when scanning directories
+    The relevant tags of each dicom file are stored in an sqlite file (keyed by path, size and modification time)
+    so unchanged files are not parsed again when the same directory is converted again
+
+    :param index_file: path of the sqlite file (created if it does not exist)
+    """
+    global header_index_file
+    header_index_file = index_file
+
+
+def disable_header_index():
+    """
+    Disable the persistent header index when scanning directories
+    """
+    global header_index_file
+    header_index_file = None
+
+
+def set_header_index_max_entries(max_entries):
+    """
+    Set the maximum number of files in the header index, the least recently used files are removed first
+    """
+    global header_index_max_entries
+    header_index_max_entries = max_entries
+
+
+def set_compression_threads(threads):
+    """
+    Set the number of threads used to compress .nii.gz output
+    With more than 1 thread the data is compressed in blocks in parallel and written as a multi member gzip file
+    (like pigz), use 1 to use the default single threaded nibabel gzip
+    """
+    global compression_threads
+    compression_threads = threads
+
+
+def set_compression_level(level):
+    """
+    Set the gzip compression level (1 fastest to 9 smallest) of .nii.gz output
+    """
+    global compression_level
+    compression_level = level
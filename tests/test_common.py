@@ -4,21 +4,64 @@ dicom2nifti
 
 @author: abrys
 """
+import copy
 import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
+
+import numpy
+import pydicom.pixels
 
 import dicom2nifti
+import dicom2nifti.common as common
 import tests.test_data as test_data
-from dicom2nifti.common import read_dicom_directory, \
+from dicom2nifti.common import read_dicom_directory, read_dicom_file, \
     validate_slice_increment, \
     validate_slicecount, \
     validate_orthogonal, \
     validate_orientation, \
-    sort_dicoms, is_slice_increment_inconsistent
-from dicom2nifti.convert_generic import dicom_to_nifti
-from dicom2nifti.exceptions import ConversionValidationError
+    sort_dicoms, is_slice_increment_inconsistent, get_volume_pixeldata, \
+    get_multiframe_index, multiframe_get_stack_count, SliceGeometry, sort_dicoms_by_normal, \
+    get_pixel_array, get_slice_reference, get_stack_groups, project_bvecs, get_4d_pixeldata
+from dicom2nifti.convert_generic import dicom_to_nifti, get_grouped_dicoms
+from dicom2nifti.exceptions import ConversionValidationError, ConversionError
+
+
+def _multiframe_to_block_per_frame(multiframe_dicom):
+    """
+    Reference implementation of multiframe_to_block that inserts the frames one by one
+    """
+    number_of_stacks, number_of_stack_slices = multiframe_get_stack_count([multiframe_dicom])
+    size_x = multiframe_dicom.pixel_array.shape[2]
+    size_y = multiframe_dicom.pixel_array.shape[1]
+    frame_info = multiframe_dicom.PerFrameFunctionalGroupsSequence
+    data_4d = numpy.zeros((number_of_stack_slices, size_y, size_x, number_of_stacks),
+                          dtype=common.get_numpy_type(multiframe_dicom))
+    t_location_index = common._get_t_position_index(multiframe_dicom)
+    for slice_index in range(0, number_of_stacks * number_of_stack_slices):
+        if "FrameContentSequence" in frame_info[slice_index]:
+            z_location = frame_info[slice_index].FrameContentSequence[0].InStackPositionNumber - 1
+        else:
+            z_location = slice_index
+        if t_location_index is not None:
+            t_location = frame_info[slice_index].FrameContentSequence[0].DimensionIndexValues[t_location_index] - 1
+        elif "FrameContentSequence" in frame_info[slice_index] and \
+                "TemporalPositionIndex" in frame_info[slice_index].FrameContentSequence[0]:
+            t_location = frame_info[slice_index].FrameContentSequence[0].TemporalPositionIndex - 1
+        else:
+            t_location = 0
+        block_data = multiframe_dicom.pixel_array[slice_index, :, :]
+        if "PixelValueTransformationSequence" in frame_info[slice_index]:
+            transformation = frame_info[slice_index].PixelValueTransformationSequence[0]
+            block_data = common.do_scaling(block_data, transformation.RescaleSlope, transformation.RescaleIntercept)
+        if block_data.dtype != data_4d.dtype:
+            new_dtype = numpy.promote_types(block_data.dtype, data_4d.dtype)
+            data_4d = data_4d.astype(new_dtype)
+            block_data = block_data.astype(new_dtype)
+        data_4d[z_location, :, :, t_location] = block_data
+    return numpy.squeeze(numpy.transpose(data_4d, (2, 1, 0, 3)))
 
 
 class TestConversionCommon(unittest.TestCase):
@@ -126,6 +169,244 @@ class TestConversionCommon(unittest.TestCase):
             dicom2nifti.enable_validate_orientation()
             shutil.rmtree(tmp_output_dir)
 
+    def test_read_dicom_directory_scan_threads(self):
+        threaded = read_dicom_directory(test_data.GENERIC_ANATOMICAL)
+        try:
+            dicom2nifti.settings.set_scan_threads(1)
+            serial = read_dicom_directory(test_data.GENERIC_ANATOMICAL)
+        finally:
+            dicom2nifti.settings.set_scan_threads(8)
+        self.assertEqual([dicom.filename for dicom in threaded],
+                         [dicom.filename for dicom in serial])
+
+    def test_read_dicom_file(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            not_dicom = os.path.join(tmp_output_dir, 'not_dicom.txt')
+            with open(not_dicom, 'w') as file_stream:
+                file_stream.write('not a dicom file')
+            self.assertIsNone(read_dicom_file(not_dicom))
+            dicom_file = read_dicom_directory(test_data.GENERIC_ANATOMICAL)[0].filename
+            dicom_headers = read_dicom_file(dicom_file)
+            self.assertIsNotNone(dicom_headers)
+            self.assertIsNotNone(dicom_headers.pixel_array)  # deferred pixel data is read after closing the file
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_get_volume_pixeldata(self):
+        dicoms = sort_dicoms(read_dicom_directory(test_data.GENERIC_ANATOMICAL))
+        volume = get_volume_pixeldata(dicoms)
+        expected = numpy.stack([dicom.pixel_array.T for dicom in copy.deepcopy(dicoms)], axis=2)
+        self.assertEqual(volume.shape, expected.shape)
+        self.assertTrue(volume.flags.f_contiguous)
+        self.assertTrue(numpy.array_equal(volume, expected))
+        # the pixel data is not kept on the slices
+        self.assertTrue(all('_pixel_array' not in vars(dicom) or dicom._pixel_array is None for dicom in dicoms))
+
+        # a wrongly predicted dtype gives the same volume and a wider prediction is not allocated
+        for predicted_dtype in [numpy.float64, numpy.int8]:
+            with mock.patch.object(common, '_get_volume_dtype', return_value=numpy.dtype(predicted_dtype)), \
+                    mock.patch('numpy.empty', wraps=numpy.empty) as empty:
+                volume = get_volume_pixeldata(dicoms)
+            self.assertEqual(volume.dtype, expected.dtype)
+            self.assertTrue(numpy.array_equal(volume, expected))
+            self.assertEqual([call[0][1] for call in empty.call_args_list], [expected.dtype])
+
+    def test_slice_reference(self):
+        for directory in [test_data.GENERIC_ANATOMICAL, test_data.GENERIC_COMPRESSED_JPEG]:
+            for dicom in read_dicom_directory(directory)[:3]:
+                slice_reference = get_slice_reference(dicom)
+                self.assertIsNotNone(slice_reference)
+                self.assertEqual(slice_reference.filename, dicom.filename)
+                expected = pydicom.pixels.pixel_array(dicom.filename)
+                numpy.testing.assert_array_equal(get_pixel_array(slice_reference), expected)
+                numpy.testing.assert_array_equal(get_pixel_array(dicom), expected)
+                # the pixel data stays deferred on the slice
+                self.assertIsNone(dicom.get_item(0x7fe00010, keep_deferred=True).value)
+        # pixel data in memory can not be referenced
+        dicom = read_dicom_directory(test_data.GENERIC_ANATOMICAL)[0]
+        dicom.PixelData = dicom.PixelData
+        self.assertIsNone(get_slice_reference(dicom))
+
+    def test_get_4d_pixeldata(self):
+        grouped_dicoms = get_grouped_dicoms(read_dicom_directory(test_data.GE_FMRI))
+        full_block = get_4d_pixeldata(grouped_dicoms)
+        expected = numpy.stack([get_volume_pixeldata(timepoint_dicoms) for timepoint_dicoms in grouped_dicoms], axis=3)
+        self.assertEqual(full_block.dtype, expected.dtype)
+        numpy.testing.assert_array_equal(full_block, expected)
+        # every timepoint is a contiguous slot
+        self.assertTrue(full_block[..., 0].flags.f_contiguous)
+
+        with self.assertRaises(ConversionError) as exception:
+            get_4d_pixeldata([grouped_dicoms[0], grouped_dicoms[1][1:]])
+        self.assertEqual(str(exception.exception), 'MISSING_DICOM_FILES')
+
+    def test_get_4d_pixeldata_validation(self):
+        grouped_dicoms = get_grouped_dicoms(read_dicom_directory(test_data.GE_FMRI))
+
+        # a slice with a different size
+        small_slice = copy.deepcopy(grouped_dicoms[1][0])
+        small_slice.PixelData = get_pixel_array(small_slice)[:-2, :-1].tobytes()
+        small_slice.Rows -= 2
+        small_slice.Columns -= 1
+        with self.assertRaises(ConversionValidationError) as exception:
+            get_4d_pixeldata([grouped_dicoms[0], [small_slice] + grouped_dicoms[1][1:]])
+        self.assertEqual(str(exception.exception), 'IMAGE_SIZE_INCONSISTENT')
+
+        # a slice that does not fit in the dtype of the block
+        first_block = get_volume_pixeldata(grouped_dicoms[0])
+        with self.assertRaises(ConversionValidationError) as exception:
+            get_volume_pixeldata(grouped_dicoms[0], out=numpy.empty(first_block.shape, dtype=numpy.int8, order='F'))
+        self.assertEqual(str(exception.exception), 'IMAGE_DTYPE_INCONSISTENT')
+
+        # a later timepoint with a wider dtype than the first one
+        scaled_timepoint = copy.deepcopy(grouped_dicoms[1])
+        for dicom_ in scaled_timepoint:
+            dicom_.RescaleSlope = 0.5
+            dicom_.RescaleIntercept = 0
+        expected = numpy.stack([first_block, get_volume_pixeldata(scaled_timepoint)], axis=3)
+        self.assertEqual(expected.dtype, numpy.float64)
+        full_block = get_4d_pixeldata([grouped_dicoms[0], scaled_timepoint])
+        self.assertEqual(full_block.dtype, expected.dtype)
+        numpy.testing.assert_array_equal(full_block, expected)
+        with mock.patch.object(common, '_get_volume_dtype', return_value=None):
+            full_block = get_4d_pixeldata([grouped_dicoms[0], scaled_timepoint])
+        self.assertEqual(full_block.dtype, expected.dtype)
+        numpy.testing.assert_array_equal(full_block, expected)
+
+        # rgb timepoints
+        rgb_dicoms = sort_dicoms(read_dicom_directory(test_data.GENERIC_RGB))
+        rgb_block = get_volume_pixeldata(rgb_dicoms)
+        full_block = get_4d_pixeldata([rgb_dicoms, rgb_dicoms])
+        self.assertEqual(full_block.shape, rgb_block.shape[:3] + (2, 3))
+        numpy.testing.assert_array_equal(full_block[:, :, :, 1], rgb_block)
+
+    def test_multiframe_index(self):
+        multiframe_dicom = read_dicom_directory(test_data.PHILIPS_ENHANCED_DTI)[0]
+        multiframe_index = get_multiframe_index(multiframe_dicom)
+        self.assertIs(get_multiframe_index(multiframe_dicom), multiframe_index)
+        number_of_frames = len(multiframe_dicom.PerFrameFunctionalGroupsSequence)
+        self.assertEqual(multiframe_index.number_of_frames, number_of_frames)
+        self.assertEqual(multiframe_index.positions.shape, (number_of_frames, 3))
+        self.assertTrue(numpy.all(multiframe_index.has_position))
+        self.assertTrue(numpy.all(multiframe_index.has_orientation))
+        first_frame = multiframe_dicom.PerFrameFunctionalGroupsSequence[0]
+        self.assertTrue(numpy.allclose(multiframe_index.get_image_position(0),
+                                       first_frame.PlanePositionSequence[0].ImagePositionPatient))
+        _, number_of_stack_slices = multiframe_get_stack_count([multiframe_dicom])
+        self.assertEqual(len(numpy.unique(multiframe_index.get_z_locations())), number_of_stack_slices)
+
+    def test_multiframe_to_block(self):
+        def assert_equal_to_per_frame(multiframe_dicom):
+            expected = _multiframe_to_block_per_frame(copy.deepcopy(multiframe_dicom))
+            data = common.multiframe_to_block(multiframe_dicom)
+            self.assertEqual(data.dtype, expected.dtype)
+            numpy.testing.assert_array_equal(data, expected)
+
+        for directory in [test_data.PHILIPS_ENHANCED_ANATOMICAL,
+                          test_data.PHILIPS_ENHANCED_DTI,
+                          test_data.PHILIPS_ENHANCED_FMRI]:
+            assert_equal_to_per_frame(read_dicom_directory(directory)[0])
+
+        # if multiple frames have the same location the last one wins
+        multiframe_dicom = read_dicom_directory(test_data.PHILIPS_ENHANCED_FMRI)[0]
+        frame_info = multiframe_dicom.PerFrameFunctionalGroupsSequence
+        for duplicate_index, frame_index in [(9, 2), (20, 2), (31, 30)]:
+            duplicate_content = frame_info[duplicate_index].FrameContentSequence[0]
+            frame_content = frame_info[frame_index].FrameContentSequence[0]
+            duplicate_content.InStackPositionNumber = frame_content.InStackPositionNumber
+            duplicate_content.TemporalPositionIndex = frame_content.TemporalPositionIndex
+        assert_equal_to_per_frame(multiframe_dicom)
+
+        # frames with integer and floating point scaling
+        multiframe_dicom = read_dicom_directory(test_data.PHILIPS_ENHANCED_DTI)[0]
+        frame_info = multiframe_dicom.PerFrameFunctionalGroupsSequence
+        for frame_index, (slope, intercept) in enumerate([(1, 100), (2, 0), (1, 0), (0.5, 3)] * 3):
+            frame_info[frame_index].PixelValueTransformationSequence[0].RescaleSlope = slope
+            frame_info[frame_index].PixelValueTransformationSequence[0].RescaleIntercept = intercept
+        for frame_index in range(12, 16):
+            del frame_info[frame_index].PixelValueTransformationSequence
+        assert_equal_to_per_frame(multiframe_dicom)
+
+        # frames without FrameContentSequence are located at their frame index
+        multiframe_dicom = read_dicom_directory(test_data.PHILIPS_ENHANCED_ANATOMICAL)[0]
+        for frame in multiframe_dicom.PerFrameFunctionalGroupsSequence:
+            del frame.FrameContentSequence
+        assert_equal_to_per_frame(multiframe_dicom)
+
+        # a FrameContentSequence without InStackPositionNumber is not supported
+        multiframe_dicom = read_dicom_directory(test_data.PHILIPS_ENHANCED_DTI)[0]
+        del multiframe_dicom.PerFrameFunctionalGroupsSequence[5].FrameContentSequence[0].InStackPositionNumber
+        self.assertRaises(ConversionError, common.multiframe_to_block, multiframe_dicom)
+
+    def test_slice_geometry(self):
+        dicoms = sort_dicoms(read_dicom_directory(test_data.GENERIC_ANATOMICAL))
+        geometry = SliceGeometry(dicoms)
+        self.assertEqual(geometry.positions.shape, (len(dicoms), 3))
+        self.assertEqual(geometry.orientations.shape, (len(dicoms), 6))
+        validate_slice_increment(geometry)
+        validate_orientation(geometry)
+        self.assertFalse(is_slice_increment_inconsistent(geometry))
+        reordered = geometry.reorder(dicoms[::-1])
+        self.assertTrue(numpy.array_equal(reordered.positions, geometry.positions[::-1]))
+
+        geometry = SliceGeometry(sort_dicoms(read_dicom_directory(test_data.FAILING_SLICEINCREMENT)))
+        self.assertRaises(ConversionValidationError, validate_slice_increment, geometry)
+
+    def test_missing_geometry(self):
+        dicoms = sort_dicoms(read_dicom_directory(test_data.GENERIC_ANATOMICAL))
+
+        # a slice without position cannot be sorted or validated
+        missing_position = copy.deepcopy(dicoms)
+        del missing_position[3].ImagePositionPatient
+        for function in [sort_dicoms, validate_slice_increment, is_slice_increment_inconsistent]:
+            with self.assertRaises(ConversionValidationError) as context:
+                function(missing_position)
+            self.assertEqual(context.exception.args[0], 'IMAGE_POSITION_MISSING')
+
+        # a slice without orientation cannot be validated or sorted along the normal
+        missing_orientation = copy.deepcopy(dicoms)
+        del missing_orientation[3].ImageOrientationPatient
+        for function in [validate_orientation, sort_dicoms_by_normal]:
+            with self.assertRaises(ConversionValidationError) as context:
+                function(missing_orientation)
+            self.assertEqual(context.exception.args[0], 'IMAGE_ORIENTATION_MISSING')
+
+        # the multiframe validations raise on a frame without position or orientation
+        multiframe_dicom = read_dicom_directory(test_data.PHILIPS_ENHANCED_ANATOMICAL)[0]
+        del multiframe_dicom.PerFrameFunctionalGroupsSequence[3].PlanePositionSequence
+        del multiframe_dicom.PerFrameFunctionalGroupsSequence[3].PlaneOrientationSequence
+        self.assertRaises(ConversionError, common.multiframe_validate_slice_increment, [multiframe_dicom])
+        self.assertRaises(ConversionError, common.multiframe_validate_orientation, [multiframe_dicom])
+
+    def test_get_stack_groups(self):
+        # 3 timepoints of 4 slices
+        positions = numpy.zeros((12, 3))
+        positions[:, 2] = numpy.tile(numpy.arange(4) * 2.5, 3)
+        groups = get_stack_groups(positions)
+        self.assertEqual([list(group) for group in groups], [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11]])
+        self.assertEqual(len(get_stack_groups(positions[:4])), 1)
+        # the slices are interleaved over the stacks with (philips) stack positions
+        stack_positions = numpy.repeat(numpy.arange(4), 3)
+        groups = get_stack_groups(None, stack_positions)
+        self.assertEqual([list(group) for group in groups], [[0, 3, 6, 9], [1, 4, 7, 10], [2, 5, 8, 11]])
+
+    def test_project_bvecs(self):
+        bvals = numpy.array([0, 1000, 1000, 1000])
+        bvecs = numpy.array([[1, 0, 0], [0, 0, 0], [2, 0, 0], [0, 1, 1]], dtype=float)
+        # sagittal image, read along y and phase along z
+        projected_bvecs = project_bvecs(bvals, bvecs, [0, 1, 0, 0, 0, -1])
+        expected = numpy.array([[0, 0, 0], [0, 0, 0], [0, 0, -1], [numpy.sqrt(0.5), numpy.sqrt(0.5), 0]])
+        numpy.testing.assert_allclose(projected_bvecs, expected, atol=1e-12)
+
+    def test_sort_dicoms_by_normal(self):
+        dicoms = read_dicom_directory(test_data.GENERIC_ANATOMICAL)
+        expected = [dicom.filename for dicom in sort_dicoms(dicoms)]
+        sorted_dicoms = [dicom.filename for dicom in sort_dicoms_by_normal(dicoms[::-1])]
+        self.assertIn(sorted_dicoms, [expected, expected[::-1]])
+        geometry = sort_dicoms_by_normal(SliceGeometry(dicoms))
+        self.assertEqual([dicom.filename for dicom in geometry.dicoms], sorted_dicoms)
+
 
 if __name__ == '__main__':
     unittest.main()
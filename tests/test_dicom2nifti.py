@@ -5,14 +5,25 @@ dicom2nifti
 @author: abrys
 """
 
+import copy
 import os
 import shutil
 import tempfile
+import tracemalloc
 import unittest
+from unittest import mock
+
+import nibabel
+import numpy
 
 import tests.test_data as test_data
 
 import dicom2nifti
+import dicom2nifti.common as common
+import dicom2nifti.convert_dicom as convert_dicom
+import dicom2nifti.image_reorientation as image_reorientation
+import dicom2nifti.nifti_writer as nifti_writer
+from dicom2nifti.common import read_dicom_directory
 from tests.test_tools import assert_compare_nifti, ground_thruth_filenames
 
 
@@ -83,6 +94,78 @@ class TestConversionDicom(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_reorient_streaming(self):
+        # the reoriented 4d data should still be written timepoint by timepoint (without the full data block)
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            for input_directory, full_block_function in [
+                    (test_data.SIEMENS_DTI, 'dicom2nifti.convert_siemens._mosaic_get_full_block'),
+                    (test_data.SIEMENS_CLASSIC_DTI, 'dicom2nifti.convert_siemens._classic_get_full_block'),
+                    (test_data.GE_DTI_OLD, 'dicom2nifti.convert_generic._get_full_block')]:
+                output_file = os.path.join(tmp_output_dir, 'test.nii.gz')
+                with mock.patch(full_block_function, side_effect=AssertionError('full data block created')):
+                    results = dicom2nifti.dicom_series_to_nifti(input_directory, output_file, True)
+                self.assertIsNotNone(results['REORIENTATION'])
+                assert_compare_nifti(results['NII_FILE'], ground_thruth_filenames(input_directory)[1])
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_default_streaming_memory(self):
+        # build a 4d series with 40 timepoints from the first timepoint of a ge fmri
+        dicoms = sorted(read_dicom_directory(test_data.GE_FMRI), key=lambda dicom_: dicom_.InstanceNumber)[:4]
+        series = []
+        for timepoint in range(40):
+            for index, dicom_ in enumerate(dicoms):
+                timepoint_dicom = copy.deepcopy(dicom_)
+                timepoint_dicom.InstanceNumber = timepoint * len(dicoms) + index + 1
+                timepoint_dicom.PixelData = (dicom_.pixel_array + timepoint).astype(dicom_.pixel_array.dtype).tobytes()
+                series.append(timepoint_dicom)
+
+        # with the default settings (reorientation, no resampling) only a timepoint at a time is in memory
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            tracemalloc.start()
+            try:
+                results = convert_dicom.dicom_array_to_nifti(series, os.path.join(tmp_output_dir, 'test.nii'))
+                _, peak_memory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertIsNotNone(results['REORIENTATION'])
+            self.assertEqual(results['NII'].shape, (64, 64, 4, 40))
+            full_block_size = results['NII'].get_data_dtype().itemsize * numpy.prod(results['NII'].shape)
+            self.assertLess(peak_memory, full_block_size / 2)
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_reorient_write_once(self):
+        # the reoriented nifti and the bval and bvec files are written once with the same content as the
+        # reorientation of the data in memory
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            for input_directory in [test_data.SIEMENS_DTI, test_data.GE_DTI, test_data.PHILIPS_DTI]:
+                output_file = os.path.join(tmp_output_dir, 'test.nii.gz')
+                # every nifti (streamed or in memory) is written with a NiftiWriter
+                with mock.patch.object(nifti_writer, 'NiftiWriter', wraps=nifti_writer.NiftiWriter) as writer, \
+                        mock.patch.object(common, 'write_bval_file', wraps=common.write_bval_file) as write_bval, \
+                        mock.patch.object(common, 'write_bvec_file', wraps=common.write_bvec_file) as write_bvec:
+                    results = dicom2nifti.dicom_series_to_nifti(input_directory, output_file, True)
+                self.assertEqual(writer.call_count, 1)
+                self.assertEqual(write_bval.call_count, 1)
+                self.assertEqual(write_bvec.call_count, 1)
+
+                expected = convert_dicom.dicom_array_to_nifti(read_dicom_directory(input_directory), None, False)
+                expected_image, reorientation = image_reorientation.reorient_nifti(expected['NII'])
+                self.assertEqual(results['REORIENTATION'], reorientation)
+                written_image = nibabel.load(results['NII_FILE'])
+                numpy.testing.assert_allclose(written_image.affine, expected_image.affine)
+                numpy.testing.assert_array_equal(numpy.asanyarray(written_image.dataobj),
+                                                 numpy.asanyarray(expected_image.dataobj))
+                self.assertEqual(written_image.header.get_zooms(), expected_image.header.get_zooms())
+                numpy.testing.assert_array_equal(numpy.loadtxt(results['BVAL_FILE']), expected['BVAL'])
+                numpy.testing.assert_allclose(numpy.loadtxt(results['BVEC_FILE']), numpy.transpose(expected['BVEC']))
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
     def test_convert_directory(self):
 
         tmp_output_dir = tempfile.mkdtemp()
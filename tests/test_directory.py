@@ -5,12 +5,18 @@ dicom2nifti
 @author: abrys
 """
 
+import multiprocessing
 import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
+
+import pydicom
 
 import dicom2nifti.convert_dir as convert_directory
+import dicom2nifti.header_index as header_index
+import dicom2nifti.settings
 import tests.test_data as test_data
 
 
@@ -26,6 +32,196 @@ class TestConversionDirectory(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_convert_directory_workers(self):
+
+        tmp_input_dir = tempfile.mkdtemp()
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            # 3 series writing to the same file and a few series with their own file
+            for name, input_directory in [('generic', test_data.GENERIC_ANATOMICAL),
+                                          ('ge', test_data.GE_ANATOMICAL),
+                                          ('siemens', test_data.SIEMENS_ANATOMICAL),
+                                          ('ge_fmri', test_data.GE_FMRI),
+                                          ('siemens_dti', test_data.SIEMENS_DTI),
+                                          ('philips_dti', test_data.PHILIPS_DTI)]:
+                shutil.copytree(input_directory, os.path.join(tmp_input_dir, name))
+
+            # the parallel conversion should write exactly the same files as the sequential one
+            os.mkdir(os.path.join(tmp_output_dir, 'sequential'))
+            os.mkdir(os.path.join(tmp_output_dir, 'parallel'))
+            convert_directory.convert_directory(tmp_input_dir, os.path.join(tmp_output_dir, 'sequential'))
+            convert_directory.convert_directory(tmp_input_dir, os.path.join(tmp_output_dir, 'parallel'), workers=3)
+            expected_files = sorted(os.listdir(os.path.join(tmp_output_dir, 'sequential')))
+            self.assertIn('4_dicom2nifti.nii.gz', expected_files)
+            self.assertEqual(len(expected_files), 8)
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp_output_dir, 'parallel'))), expected_files)
+            for file_name in expected_files:
+                with open(os.path.join(tmp_output_dir, 'sequential', file_name), 'rb') as expected_file, \
+                        open(os.path.join(tmp_output_dir, 'parallel', file_name), 'rb') as parallel_file:
+                    self.assertEqual(parallel_file.read(), expected_file.read(), file_name)
+
+        finally:
+            shutil.rmtree(tmp_input_dir)
+            shutil.rmtree(tmp_output_dir)
+
+    def test_convert_directory_broken_pool(self):
+        if multiprocessing.get_start_method() != 'fork':
+            self.skipTest('the crashing conversion is only inherited by forked workers')
+
+        tmp_input_dir = tempfile.mkdtemp()
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            shutil.copytree(test_data.GENERIC_ANATOMICAL, os.path.join(tmp_input_dir, 'generic'))
+            shutil.copytree(test_data.GE_FMRI, os.path.join(tmp_input_dir, 'ge_fmri'))
+            shutil.copytree(test_data.PHILIPS_DTI, os.path.join(tmp_input_dir, 'philips_dti'))
+
+            # a worker that dies breaks the pool, every job should still be collected and logged
+            with mock.patch.object(convert_directory, '_convert_series', side_effect=lambda *args: os._exit(1)), \
+                    self.assertLogs(convert_directory.logger, 'WARNING') as logs:
+                convert_directory.convert_directory(tmp_input_dir, tmp_output_dir, workers=2)
+            self.assertEqual(len([line for line in logs.output if 'Unable to convert' in line]), 3)
+            self.assertEqual(os.listdir(tmp_output_dir), [])
+
+        finally:
+            shutil.rmtree(tmp_input_dir)
+            shutil.rmtree(tmp_output_dir)
+
+    def test_worker_settings(self):
+        worker_settings = convert_directory._get_settings(4)
+        self.assertEqual(worker_settings['scan_threads'], max(1, dicom2nifti.settings.scan_threads // 4))
+        self.assertEqual(worker_settings['resample_threads'], max(1, dicom2nifti.settings.resample_threads // 4))
+        self.assertEqual(worker_settings['compression_threads'], 1)
+
+    def test_convert_directory_invalid_multiframe(self):
+
+        tmp_input_dir = tempfile.mkdtemp()
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            # a multiframe file without SeriesInstanceUID next to a valid series
+            shutil.copytree(test_data.GENERIC_ANATOMICAL, os.path.join(tmp_input_dir, 'generic'))
+            multiframe_file = os.path.join(test_data.PHILIPS_ENHANCED_ANATOMICAL,
+                                           os.listdir(test_data.PHILIPS_ENHANCED_ANATOMICAL)[0])
+            multiframe_dicom = pydicom.dcmread(multiframe_file)
+            del multiframe_dicom.SeriesInstanceUID
+            multiframe_dicom.save_as(os.path.join(tmp_input_dir, 'multiframe.dcm'))
+
+            dicom_series, _ = convert_directory._get_series_files(tmp_input_dir)
+            self.assertEqual(len(dicom_series), 1)
+            convert_directory.convert_directory(tmp_input_dir, tmp_output_dir)
+            assert os.path.isfile(os.path.join(tmp_output_dir, '4_dicom2nifti.nii.gz'))
+
+        finally:
+            shutil.rmtree(tmp_input_dir)
+            shutil.rmtree(tmp_output_dir)
+
+    def test_get_series_files(self):
+        dicom_series, _ = convert_directory._get_series_files(test_data.GENERIC_ANATOMICAL)
+        self.assertEqual(len(dicom_series), 1)
+        dicom_files = next(iter(dicom_series.values()))
+        self.assertEqual(len(dicom_files), len(os.listdir(test_data.GENERIC_ANATOMICAL)))
+        self.assertTrue(all(os.path.isfile(dicom_file) for dicom_file in dicom_files))
+
+    def test_get_series_files_header_index(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        index_file = os.path.join(tmp_output_dir, 'headers.sqlite')
+        try:
+            dicom2nifti.settings.enable_header_index(index_file)
+            expected_series, expected_headers = convert_directory._get_series_files(test_data.GENERIC_ANATOMICAL)
+            file_paths = next(iter(expected_series.values()))
+            index = header_index.open_index()
+            try:
+                self.assertEqual(len(index.lookup(file_paths)), len(file_paths))
+            finally:
+                index.close()
+
+            # the second scan is taken from the index
+            dicom_series, series_headers = convert_directory._get_series_files(test_data.GENERIC_ANATOMICAL)
+            self.assertEqual(dicom_series, expected_series)
+            for series_id, dicom_header in series_headers.items():
+                self.assertEqual(convert_directory._get_nifti_file(dicom_header, tmp_output_dir, True),
+                                 convert_directory._get_nifti_file(expected_headers[series_id], tmp_output_dir, True))
+
+            header_index.clear()
+            index = header_index.open_index()
+            try:
+                self.assertEqual(len(index.lookup(file_paths)), 0)
+            finally:
+                index.close()
+        finally:
+            dicom2nifti.settings.disable_header_index()
+            shutil.rmtree(tmp_output_dir)
+
+    def test_header_index_unreadable_files(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            dicom_directory = os.path.join(tmp_output_dir, 'dicom')
+            shutil.copytree(test_data.GENERIC_ANATOMICAL, dicom_directory)
+            not_dicom_file = os.path.join(dicom_directory, 'not_dicom.txt')
+            with open(not_dicom_file, 'w') as file_handle:
+                file_handle.write('not a dicom file')
+            dicom2nifti.settings.enable_header_index(os.path.join(tmp_output_dir, 'headers.sqlite'))
+            expected_series, _ = convert_directory._get_series_files(dicom_directory)
+
+            # the unreadable file is indexed as not valid and no file is read again on the second scan
+            index = header_index.open_index()
+            try:
+                self.assertEqual(index.lookup([not_dicom_file]), {not_dicom_file: (False, None)})
+            finally:
+                index.close()
+            with mock.patch('dicom2nifti.convert_dir._read_header',
+                            wraps=convert_directory._read_header) as read_header:
+                dicom_series, _ = convert_directory._get_series_files(dicom_directory)
+            self.assertEqual(read_header.call_count, 0)
+            self.assertEqual(dicom_series, expected_series)
+        finally:
+            dicom2nifti.settings.disable_header_index()
+            shutil.rmtree(tmp_output_dir)
+
+    def test_header_index_batched_lookup(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            dicom_series, _ = convert_directory._get_series_files(test_data.GENERIC_ANATOMICAL)
+            file_paths = next(iter(dicom_series.values()))
+            index = header_index.HeaderIndex(os.path.join(tmp_output_dir, 'headers.sqlite'))
+            try:
+                for file_path in file_paths[1:]:
+                    index.add(file_path, True, convert_directory._read_header(file_path))
+                index.commit()
+
+                # the files are looked up in chunks instead of one query per file
+                statements = []
+                index._connection.set_trace_callback(statements.append)
+                with mock.patch.object(header_index, 'LOOKUP_CHUNK_SIZE', 3):
+                    found = index.lookup(file_paths)
+                index._connection.set_trace_callback(None)
+                self.assertEqual(sorted(found), sorted(file_paths[1:]))
+                self.assertEqual(len([statement for statement in statements if statement.startswith('SELECT')]),
+                                 -(-len(file_paths) // 3))
+                for file_path in file_paths[1:]:
+                    self.assertTrue(found[file_path][0])
+                    self.assertEqual(found[file_path][1].SOPClassUID,
+                                     convert_directory._read_header(file_path).SOPClassUID)
+            finally:
+                index.close()
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_header_index_eviction(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            dicom_series, _ = convert_directory._get_series_files(test_data.GENERIC_ANATOMICAL)
+            file_paths = next(iter(dicom_series.values()))
+            index = header_index.HeaderIndex(os.path.join(tmp_output_dir, 'headers.sqlite'), max_entries=2)
+            try:
+                for file_path in file_paths:
+                    index.add(file_path, True, convert_directory._read_header(file_path))
+                index.commit()
+                self.assertEqual(len(index.lookup(file_paths)), 2)
+            finally:
+                index.close()
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
     def test_remove_accents(self):
 
         assert convert_directory._remove_accents(u'êén_ölîfānt@') == 'een_olifant'
@@ -13,11 +13,13 @@ import tempfile
 import unittest
 
 import nibabel
+import numpy
 
 import tests.test_data as test_data
 
 import dicom2nifti.convert_generic as convert_generic
-from dicom2nifti.common import read_dicom_directory
+import dicom2nifti.image_reorientation as image_reorientation
+from dicom2nifti.common import read_dicom_directory, read_dicom_file
 from common import is_dicom_file
 import dicom2nifti.settings as settings
 from dicom2nifti.exceptions import ConversionError
@@ -198,5 +200,43 @@ class TestConversionGeneric(unittest.TestCase):
         finally:
             shutil.rmtree(temporary_directory)
 
+    def test_remove_duplicate_slices(self):
+        for directory in [test_data.GENERIC_ANATOMICAL, test_data.GENERIC_COMPRESSED]:
+            dicoms = read_dicom_directory(directory)
+            # the same file twice is a duplicate
+            duplicate = read_dicom_file(dicoms[0].filename)
+            # a different slice on the same position is not
+            other_slice = read_dicom_file(dicoms[1].filename)
+            other_slice.ImagePositionPatient = dicoms[0].ImagePositionPatient
+            filtered_dicoms = convert_generic.remove_duplicate_slices(dicoms + [duplicate, other_slice])
+            self.assertEqual(len(filtered_dicoms), len(dicoms) + 1)
+            self.assertIs(filtered_dicoms[-1], other_slice)
+
+    def test_write_timepoints_reorient(self):
+        temporary_directory = tempfile.mkdtemp()
+        try:
+            affine = numpy.array([[0, 0, -2.0, 10], [0.5, 0, 0, -20], [0, -0.6, 0, 30], [0, 0, 0, 1]])
+            for block_shape, squeeze in [((4, 5, 6), False), ((4, 5, 6), True), ((4, 1, 6), False), ((4, 1, 6), True)]:
+                data = numpy.random.randint(0, 100, size=block_shape + (3,)).astype(numpy.int16)
+                output_file = os.path.join(temporary_directory, 'test.nii.gz')
+                nii_image, reorientation = convert_generic.write_timepoints((data[..., index] for index in range(3)),
+                                                                            3, affine, output_file, 2000, 30,
+                                                                            squeeze=squeeze, reorient_nifti=True)
+
+                # the same as reorienting the full image in memory
+                full_data = data.squeeze() if squeeze else data
+                expected_image, expected_reorientation = image_reorientation.reorient_nifti(
+                    nibabel.Nifti1Image(full_data, affine))
+                self.assertEqual(reorientation, expected_reorientation)
+                written_image = nibabel.load(output_file)
+                numpy.testing.assert_allclose(written_image.affine, expected_image.affine)
+                numpy.testing.assert_array_equal(numpy.asanyarray(written_image.dataobj),
+                                                 numpy.asanyarray(expected_image.dataobj))
+                numpy.testing.assert_array_equal(numpy.asanyarray(nii_image.dataobj),
+                                                 numpy.asanyarray(expected_image.dataobj))
+                self.assertEqual(written_image.header['db_name'], b'?TR:2000.000 TE:30')
+        finally:
+            shutil.rmtree(temporary_directory)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+dicom2nifti
+
+@author: abrys
+"""
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel
+import numpy
+
+import dicom2nifti.image_reorientation as image_reorientation
+
+
+class TestImageReorientation(unittest.TestCase):
+    def test_reorient_image(self):
+        las_affine = numpy.diag([-0.5, 0.6, 2.0, 1.0])
+        las_affine[:3, 3] = [10, -20, 30]
+        las_data = numpy.arange(4 * 5 * 6 * 2, dtype=numpy.int16).reshape(4, 5, 6, 2)
+
+        # every permutation and flip of the las image should be reoriented to the las image
+        for axes in itertools.permutations(range(3)):
+            for flips in itertools.product([False, True], repeat=3):
+                data = las_data
+                affine = las_affine.copy()
+                for axis in range(3):
+                    if flips[axis]:
+                        data = numpy.flip(data, axis)
+                        affine[:3, 3] += affine[:3, axis] * (data.shape[axis] - 1)
+                        affine[:3, axis] = -affine[:3, axis]
+                data = numpy.transpose(data, list(axes) + [3])
+                affine[:, :3] = affine[:, list(axes)]
+
+                _, _, new_affine = image_reorientation.get_reorientation(affine, data.shape)
+                numpy.testing.assert_allclose(new_affine, las_affine)
+
+                reoriented = image_reorientation.reorient_image(nibabel.Nifti1Image(data, affine), None)
+                numpy.testing.assert_allclose(reoriented.affine, las_affine)
+                numpy.testing.assert_array_equal(numpy.asanyarray(reoriented.dataobj), las_data)
+
+    def test_reorient_image_file(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            affine = numpy.diag([0.5, -0.6, 2.0, 1.0])
+            data = numpy.random.randint(0, 100, size=(4, 5, 1)).astype(numpy.int16)
+            input_file = os.path.join(tmp_output_dir, 'input.nii.gz')
+            output_file = os.path.join(tmp_output_dir, 'output.nii.gz')
+            nibabel.Nifti1Image(data, affine).to_filename(input_file)
+
+            reoriented = image_reorientation.reorient_image(input_file, output_file)
+            written = nibabel.load(output_file)
+            numpy.testing.assert_allclose(written.affine, reoriented.affine)
+            numpy.testing.assert_array_equal(numpy.asanyarray(written.dataobj), data[::-1, ::-1, :])
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_reorient_las_image(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            affine = numpy.diag([-0.5, 0.6, 2.0, 1.0])
+            nifti_image = nibabel.Nifti1Image(numpy.zeros((4, 5, 6), dtype=numpy.int16), affine)
+            output, reorientation = image_reorientation.reorient_nifti(nifti_image)
+            self.assertIs(output, nifti_image)
+            self.assertIsNone(reorientation)
+
+            output, reorientation = image_reorientation.reorient_nifti(nibabel.Nifti1Image(numpy.zeros((4, 5, 6)),
+                                                                                           numpy.eye(4)))
+            self.assertEqual(reorientation, {'AXES': [0, 1, 2], 'FLIPS': [0]})
+
+            # a las file that is reoriented in place is not written again
+            nifti_file = os.path.join(tmp_output_dir, 'las.nii.gz')
+            nifti_image.to_filename(nifti_file)
+            os.utime(nifti_file, ns=(0, 0))
+            image_reorientation.reorient_image(nifti_file, nifti_file)
+            self.assertEqual(os.stat(nifti_file).st_mtime_ns, 0)
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_reorient_scaled_las_image(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            # a scaled integer las file written to a new file keeps its scaled values
+            raw_data = numpy.arange(4 * 5 * 6, dtype=numpy.int16).reshape(4, 5, 6)
+            nifti_image = nibabel.Nifti1Image(raw_data, numpy.diag([-0.5, 0.6, 2.0, 1.0]))
+            nifti_image.header.set_slope_inter(0.3, 0)
+            input_file = os.path.join(tmp_output_dir, 'input.nii.gz')
+            output_file = os.path.join(tmp_output_dir, 'output.nii.gz')
+            nifti_image.to_filename(input_file)
+            data = numpy.asanyarray(nibabel.load(input_file).dataobj)
+            numpy.testing.assert_allclose(data, raw_data * 0.3, rtol=1e-6)
+
+            image_reorientation.reorient_image(input_file, output_file)
+            numpy.testing.assert_array_equal(numpy.asanyarray(nibabel.load(output_file).dataobj), data)
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_reorient_header(self):
+        las_affine = numpy.diag([-0.5, 0.6, 2.0, 1.0])
+        las_data = numpy.arange(4 * 5 * 6 * 2, dtype=numpy.int16).reshape(4, 5, 6, 2)
+        rpi_affine = numpy.diag([0.5, -0.6, -2.0, 1.0])
+        rpi_affine[:3, 3] = [-1.5, 2.4, 10.0]
+
+        # the las image is returned as is, the reoriented image should have the same header
+        headers = []
+        for data, affine in [(las_data, las_affine), (las_data[::-1, ::-1, ::-1], rpi_affine)]:
+            nifti_image = nibabel.Nifti1Image(data, affine)
+            nifti_image.header.set_zooms((0.5, 0.6, 2.0, 2.5))
+            nifti_image.header.set_xyzt_units('mm', 'sec')
+            nifti_image.header['db_name'] = '?TR:2500.000 TE:30'
+            output, _ = image_reorientation.reorient_nifti(nifti_image)
+            numpy.testing.assert_allclose(output.affine, las_affine)
+            numpy.testing.assert_array_equal(numpy.asanyarray(output.dataobj), las_data)
+            headers.append(output.header)
+
+        for header in headers:
+            self.assertEqual(header.get_zooms(), (0.5, 0.6, 2.0, 2.5))
+            self.assertEqual(header.get_xyzt_units(), ('mm', 'sec'))
+            self.assertEqual(header['db_name'], b'?TR:2500.000 TE:30')
+        for field in ['dim', 'pixdim', 'xyzt_units', 'datatype', 'db_name', 'qform_code', 'sform_code']:
+            numpy.testing.assert_array_equal(headers[0][field], headers[1][field])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+dicom2nifti
+
+@author: abrys
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import nibabel
+import numpy
+
+import dicom2nifti.nifti_writer as nifti_writer
+import dicom2nifti.settings as settings
+from dicom2nifti.exceptions import ConversionError
+
+
+class TestNiftiWriter(unittest.TestCase):
+    def test_write_nifti(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            affine = numpy.diag([0.5, 0.6, 2.0, 1.0])
+            for data in [numpy.arange(5 * 6 * 7, dtype=numpy.int16).reshape(5, 6, 7),
+                         numpy.random.rand(4, 3, 2, 5).astype(numpy.float32),
+                         numpy.arange(4 * 3, dtype=numpy.uint8).reshape(4, 3),
+                         numpy.asfortranarray(numpy.arange(3 * 4 * 5, dtype=numpy.uint16).reshape(3, 4, 5))[::-1]]:
+                for extension in ['.nii', '.nii.gz']:
+                    expected_file = os.path.join(tmp_output_dir, 'expected' + extension)
+                    streamed_file = os.path.join(tmp_output_dir, 'streamed' + extension)
+                    nibabel.Nifti1Image(data, affine).to_filename(expected_file)
+                    nifti_writer.write_nifti(nibabel.Nifti1Image(data, affine), streamed_file)
+                    with open(expected_file, 'rb') as expected, open(streamed_file, 'rb') as streamed:
+                        self.assertEqual(expected.read(), streamed.read())
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_write_scaled_nifti(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            output_file = os.path.join(tmp_output_dir, 'scaled.nii.gz')
+            data = numpy.arange(4 * 3 * 2, dtype=numpy.float64).reshape(4, 3, 2) * 0.3 - 2.0
+            nifti_image = nibabel.Nifti1Image(data, numpy.eye(4))
+            nifti_image.header.set_data_dtype(numpy.int16)
+            nifti_image.header.set_slope_inter(0.3, -2.0)
+
+            # the scaled values are stored as int16 with the header scaling
+            nifti_writer.write_nifti(nifti_image, output_file)
+            written = nibabel.load(output_file)
+            self.assertEqual(written.get_data_dtype(), numpy.int16)
+            numpy.testing.assert_allclose((written.dataobj.slope, written.dataobj.inter), (0.3, -2.0))
+            numpy.testing.assert_allclose(written.get_fdata(), data, atol=1e-6)
+            numpy.testing.assert_array_equal(numpy.asanyarray(written.dataobj.get_unscaled()),
+                                             numpy.arange(4 * 3 * 2).reshape(4, 3, 2))
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_data_size_mismatch(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            output_file = os.path.join(tmp_output_dir, 'test.nii.gz')
+            template = nifti_writer.create_template((4, 3, 2), numpy.int16, numpy.eye(4))
+
+            with self.assertRaises(ConversionError) as exception:
+                with nifti_writer.NiftiWriter(output_file, template) as writer:
+                    writer.write(numpy.zeros((4, 3)))
+            self.assertEqual(str(exception.exception), 'NIFTI_DATA_SIZE_MISMATCH')
+            self.assertFalse(os.path.exists(output_file))
+
+            with self.assertRaises(ConversionError):
+                with nifti_writer.NiftiWriter(output_file, template) as writer:
+                    writer.write(numpy.zeros((4, 3, 3)))
+            self.assertFalse(os.path.exists(output_file))
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
+    def test_parallel_gzip(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        try:
+            data = numpy.random.randint(0, 100, size=(20, 30, 10, 3)).astype(numpy.int16)
+            affine = numpy.diag([0.5, 0.6, 2.0, 1.0])
+            expected_file = os.path.join(tmp_output_dir, 'expected.nii')
+            nibabel.Nifti1Image(data, affine).to_filename(expected_file)
+
+            settings.set_compression_threads(4)
+            settings.set_compression_level(6)
+            streamed_file = os.path.join(tmp_output_dir, 'streamed.nii.gz')
+            nifti_writer.write_nifti(nibabel.Nifti1Image(data, affine), streamed_file)
+            with open(expected_file, 'rb') as expected, gzip.open(streamed_file, 'rb') as streamed:
+                self.assertEqual(expected.read(), streamed.read())
+            numpy.testing.assert_array_equal(numpy.asanyarray(nibabel.load(streamed_file).dataobj), data)
+
+            # small blocks give a multi member gzip file
+            parallel_file = os.path.join(tmp_output_dir, 'parallel.gz')
+            with nifti_writer.ParallelGzipFile(parallel_file, block_size=1000) as gzip_file:
+                gzip_file.write(data.tobytes())
+                self.assertEqual(gzip_file.tell(), data.nbytes)
+            with gzip.open(parallel_file, 'rb') as parallel:
+                self.assertEqual(parallel.read(), data.tobytes())
+
+            empty_file = os.path.join(tmp_output_dir, 'empty.gz')
+            nifti_writer.ParallelGzipFile(empty_file).close()
+            with gzip.open(empty_file, 'rb') as empty:
+                self.assertEqual(empty.read(), b'')
+        finally:
+            settings.set_compression_threads(1)
+            settings.set_compression_level(1)
+            shutil.rmtree(tmp_output_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+dicom2nifti
+
+@author: abrys
+"""
+import unittest
+
+import nibabel
+import nibabel.affines
+import numpy
+import scipy.ndimage
+
+import dicom2nifti.resample as resample
+import dicom2nifti.settings as settings
+
+
+class TestResample(unittest.TestCase):
+    def test_resample_slabs(self):
+        affine = numpy.diag([0.7, 0.8, 2.5, 1.0])
+        affine[1, 2] = 0.6  # gantry tilt
+        data = numpy.random.randint(-500, 1000, size=(40, 35, 20)).astype(numpy.int16)
+        nifti_image = nibabel.Nifti1Image(data, affine)
+        slab_bytes = resample._SLAB_BYTES
+        try:
+            settings.set_resample_padding(-1000)
+            for order in [0, 1, 3]:
+                settings.set_resample_spline_interpolation_order(order)
+                # full volume reference
+                settings.set_resample_threads(1)
+                expected = resample.resample_nifti_images([nifti_image])
+                matrix, offset = nibabel.affines.to_matvec(numpy.linalg.inv(affine).dot(expected.affine))
+                reference = scipy.ndimage.affine_transform(data, matrix=matrix, offset=offset,
+                                                           output_shape=expected.shape, output=data.dtype,
+                                                           order=order, mode='constant', cval=-1000,
+                                                           prefilter=False)
+                numpy.testing.assert_array_equal(numpy.asanyarray(expected.dataobj), reference)
+
+                # small slabs in parallel
+                resample._SLAB_BYTES = expected.shape[0] * expected.shape[1] * 2 * 3
+                settings.set_resample_threads(4)
+                resampled = resample.resample_nifti_images([nifti_image])
+                numpy.testing.assert_array_equal(resampled.affine, expected.affine)
+                numpy.testing.assert_array_equal(numpy.asanyarray(resampled.dataobj), reference)
+                resample._SLAB_BYTES = slab_bytes
+        finally:
+            resample._SLAB_BYTES = slab_bytes
+            settings.set_resample_threads(4)
+            settings.set_resample_padding(0)
+            settings.set_resample_spline_interpolation_order(0)
+
+    def test_resample_4d(self):
+        affine = numpy.diag([0.7, 0.8, 2.5, 1.0])
+        affine[1, 2] = 0.6  # gantry tilt
+        data = numpy.random.randint(0, 1000, size=(20, 18, 10, 4)).astype(numpy.int16)
+        try:
+            settings.set_resample_padding(-1000)
+            for order in [0, 1]:
+                settings.set_resample_spline_interpolation_order(order)
+                resampled = resample.resample_nifti_images([nibabel.Nifti1Image(data, affine)])
+                self.assertEqual(resampled.ndim, 4)
+                # every time point is the same as resampling the volume on its own
+                for time_point in range(data.shape[3]):
+                    expected = resample.resample_nifti_images([nibabel.Nifti1Image(data[..., time_point].copy(),
+                                                                                   affine)])
+                    numpy.testing.assert_array_equal(resampled.affine, expected.affine)
+                    numpy.testing.assert_array_equal(numpy.asanyarray(resampled.dataobj)[..., time_point],
+                                                     numpy.asanyarray(expected.dataobj))
+        finally:
+            settings.set_resample_padding(0)
+            settings.set_resample_spline_interpolation_order(0)
+
+    def test_resample_cache(self):
+        affine = numpy.diag([0.7, 0.8, 2.5, 1.0])
+        affine[1, 2] = 0.6  # gantry tilt
+        try:
+            settings.set_resample_padding(-1000)
+            for order in [0, 1]:
+                settings.set_resample_spline_interpolation_order(order)
+                expected = []
+                datas = [numpy.random.randint(0, 1000, size=(20, 18, 10)).astype(numpy.int16) for _ in range(2)]
+                for data in datas:
+                    expected.append(resample.resample_nifti_images([nibabel.Nifti1Image(data, affine)]))
+
+                settings.set_resample_cache_size(10 * 1024 * 1024)
+                for data, expected_image in zip(datas, expected):
+                    resampled = resample.resample_nifti_images([nibabel.Nifti1Image(data, affine)])
+                    numpy.testing.assert_array_equal(resampled.affine, expected_image.affine)
+                    numpy.testing.assert_array_equal(numpy.asanyarray(resampled.dataobj),
+                                                     numpy.asanyarray(expected_image.dataobj))
+                self.assertEqual(len(resample._plan_cache), 1)
+                plan = list(resample._plan_cache.values())[0]
+                # only nearest neighbour interpolation keeps the index maps
+                self.assertEqual(plan.nbytes > 0, order == 0)
+
+                settings.set_resample_cache_size(0)
+                resample.clear_plan_cache()
+        finally:
+            settings.set_resample_cache_size(0)
+            resample.clear_plan_cache()
+            settings.set_resample_padding(0)
+            settings.set_resample_spline_interpolation_order(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -152,6 +152,24 @@ class TestConversionDicom(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_output_dir)
 
+    def test_jobs_option(self):
+        tmp_output_dir = tempfile.mkdtemp()
+        script_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   'scripts',
+                                   'dicom2nifti')
+        assert os.path.isfile(script_file)
+
+        try:
+            from importlib.machinery import SourceFileLoader
+            dicom2nifti_module = SourceFileLoader("dicom2nifti_script", script_file).load_module()
+            dicom2nifti_module.main(['-j', '2', test_data.SIEMENS_ANATOMICAL, tmp_output_dir])
+            assert os.path.isfile(os.path.join(tmp_output_dir, "4_dicom2nifti.nii.gz"))
+            dicom2nifti_module.main(['--jobs', '2', test_data.SIEMENS_ANATOMICAL, tmp_output_dir])
+            assert os.path.isfile(os.path.join(tmp_output_dir, "4_dicom2nifti.nii.gz"))
+
+        finally:
+            shutil.rmtree(tmp_output_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
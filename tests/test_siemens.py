@@ -8,6 +8,7 @@ import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
 import nibabel
 import numpy
@@ -166,6 +167,45 @@ class TestConversionSiemens(unittest.TestCase):
         assert not convert_siemens._is_mosaic(
             convert_siemens._classic_get_grouped_dicoms(read_dicom_directory(test_data.SIEMENS_ANATOMICAL)))
 
+    def test_mosaic_to_block(self):
+        sorted_mosaics = convert_siemens._get_sorted_mosaics(read_dicom_directory(test_data.SIEMENS_FMRI))
+        number_x, _, size_x, size_y, size_z = convert_siemens._get_mosaic_block_dimensions(sorted_mosaics[0])
+        mosaic_type = convert_siemens._get_mosaic_type(sorted_mosaics[0])
+        # the headers are parsed once and every mosaic is unpacked in place
+        with mock.patch('dicom2nifti.convert_siemens._get_mosaic_type',
+                        wraps=convert_siemens._get_mosaic_type) as get_mosaic_type, \
+                mock.patch('dicom2nifti.convert_siemens._get_mosaic_block_dimensions',
+                           wraps=convert_siemens._get_mosaic_block_dimensions) as get_block_dimensions, \
+                mock.patch('dicom2nifti.convert_siemens._unpack_mosaics',
+                           wraps=convert_siemens._unpack_mosaics) as unpack_mosaics:
+            full_block = convert_siemens._mosaics_to_block(sorted_mosaics)
+        self.assertEqual(get_mosaic_type.call_count, 1)
+        self.assertEqual(get_block_dimensions.call_count, 1)
+        self.assertEqual(unpack_mosaics.call_count, len(sorted_mosaics))
+        self.assertTrue(all(numpy.shares_memory(call[1]['out'], full_block) for call in unpack_mosaics.call_args_list))
+        self.assertEqual(full_block.shape, (size_x, size_y, size_z, len(sorted_mosaics)))
+        for index, mosaic in enumerate(sorted_mosaics):
+            block = convert_siemens._mosaic_to_block(mosaic)
+            numpy.testing.assert_array_equal(full_block[..., index], block)
+            # the tiles are filled row by row
+            mosaic_data = common.get_pixel_array(mosaic)
+            for tile in [0, number_x + 1, size_z - 1]:
+                z_index = tile if mosaic_type == convert_siemens.MosaicType.ASCENDING else size_z - tile - 1
+                tile_data = mosaic_data[size_y * (tile // number_x):size_y * (tile // number_x + 1),
+                                        size_x * (tile % number_x):size_x * (tile % number_x + 1)]
+                numpy.testing.assert_array_equal(block[:, :, z_index], tile_data.T)
+
+    def test_ascconv_headers(self):
+        mosaics = read_dicom_directory(test_data.SIEMENS_FMRI)
+        csa_header = convert_siemens._read_csa_header(mosaics[0][0x0029, 0x1020].value)
+        self.assertIn('### ASCCONV BEGIN', csa_header['MrPhoenixProtocol'][0])
+        ascconv_headers = convert_siemens._get_ascconv_protocol(mosaics[0])
+        self.assertEqual(ascconv_headers['sSliceArray.lSize'], '50')
+        self.assertEqual(ascconv_headers['sSliceArray.ucImageNumbTra'], '0x1')
+        # the protocol is parsed once for the series
+        self.assertIs(convert_siemens._get_ascconv_protocol(mosaics[1]), ascconv_headers)
+        self.assertEqual(convert_siemens._get_mosaic_block_dimensions(mosaics[1]), (8, 8, 80, 80, 50))
+
     def test_is_4d(self):
         assert convert_siemens._is_4d(read_dicom_directory(test_data.SIEMENS_DTI))
         assert convert_siemens._is_4d(read_dicom_directory(test_data.SIEMENS_FMRI))